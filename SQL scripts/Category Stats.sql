@@ -0,0 +1,34 @@
+-- running totals for each category (photos, uploaders, voters), read by the event details
+-- the server keeps them up to date, the sync daemon repairs any drift for recent categories
+CREATE TABLE categorystats (
+  category_id INT NOT NULL,
+  num_photos INT NOT NULL DEFAULT 0,
+  num_uploaders INT NOT NULL DEFAULT 0,
+  num_voters INT NOT NULL DEFAULT 0,
+  created_date DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  last_updated DATETIME NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (category_id),
+  CONSTRAINT fk_categorystats_category_id FOREIGN KEY (category_id) REFERENCES category (id)
+);
+
+-- existing categories
+INSERT INTO categorystats (category_id, num_photos, num_uploaders)
+  SELECT category_id, COUNT(id), COUNT(DISTINCT user_id) FROM photo WHERE active != 0 GROUP BY category_id;
+
+INSERT INTO categorystats (category_id, num_voters)
+  SELECT category_id, COUNT(DISTINCT user_id) FROM ballot GROUP BY category_id
+  ON DUPLICATE KEY UPDATE num_voters = VALUES(num_voters);
+
+-- the voters of each category, a user's first ballot in a category inserts their row
+-- and bumps categorystats.num_voters, the primary key makes that race free
+CREATE TABLE categoryvoter (
+  category_id INT NOT NULL,
+  user_id INT NOT NULL,
+  created_date DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (category_id, user_id),
+  CONSTRAINT fk_categoryvoter_category_id FOREIGN KEY (category_id) REFERENCES category (id),
+  CONSTRAINT fk_categoryvoter_user_id FOREIGN KEY (user_id) REFERENCES anonuser (id)
+);
+
+INSERT INTO categoryvoter (category_id, user_id)
+  SELECT DISTINCT category_id, user_id FROM ballot;
@@ -0,0 +1,9 @@
+-- the likes feed (/like) pages through a user's likes by category
+-- feedback.category_id is the photo's category, set when the feedback is created
+ALTER TABLE feedback ADD COLUMN category_id INT NULL AFTER photo_id,
+  ADD CONSTRAINT fk_feedback_cid FOREIGN KEY (category_id) REFERENCES category (id);
+
+-- existing feedback
+UPDATE feedback f JOIN photo p ON p.id = f.photo_id SET f.category_id = p.category_id WHERE f.category_id IS NULL;
+
+CREATE INDEX ix_feedback_user_like_category ON feedback (user_id, `like`, category_id, photo_id);
@@ -0,0 +1,3 @@
+-- /submissions pages through a user's categories & reads a page of their photos
+-- by (user_id, category_id), new installs get the index from the model (Photo.__table_args__)
+CREATE INDEX ix_photo_user_id_category_id ON photo (user_id, category_id);
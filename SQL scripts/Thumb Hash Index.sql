@@ -0,0 +1,3 @@
+-- /thumb/<thumb_hash> looks photos up by the hash of their upload
+-- new installs get the index from the model (PhotoMeta.thumb_hash)
+CREATE INDEX ix_photometa_thumb_hash ON photometa (thumb_hash);
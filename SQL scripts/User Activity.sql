@@ -0,0 +1,14 @@
+-- a summary of each user's play (ballots, last vote/upload day & streaks), read by the reward checks
+-- the server keeps it current, fill it from the existing data with daemon/backfill_user_activity.py
+CREATE TABLE useractivity (
+  user_id INT NOT NULL,
+  num_votes INT NOT NULL DEFAULT 0,
+  last_vote_day DATE NULL,
+  vote_streak INT NOT NULL DEFAULT 0,
+  last_upload_day DATE NULL,
+  upload_streak INT NOT NULL DEFAULT 0,
+  created_date DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  last_updated DATETIME NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (user_id),
+  CONSTRAINT fk_useractivity_userid FOREIGN KEY (user_id) REFERENCES anonuser (id)
+);
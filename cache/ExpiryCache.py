@@ -2,8 +2,11 @@
 Basic expiry cache implementation python.
 """
 
+import sys
 import time
+import heapq
 import threading
+from collections import OrderedDict
 
 SCHEDULE_TIMEOUT = 59
 
@@ -20,6 +23,12 @@ c.put("name", "ExpiryCache", 60) # with ttl
 # Get value
 c.get("name")
 
+# Bounded, least-recently-used entries are evicted to stay in budget
+c = ExpiryCache(max_entries=10000, max_bytes=64*1024*1024)
+
+# Lock-striped, keys are spread over shards that each have their own lock
+c = ShardedExpiryCache(num_shards=16, max_entries=10000, max_bytes=64*1024*1024)
+
 """
 
 
@@ -27,6 +36,28 @@ class ExpiryValueException(Exception):
     pass
 
 
+def approximate_size(value: object, depth: int=3) -> int:
+    """
+    rough estimate of the memory held by a cached value. We only
+    need to be in the right ballpark to keep a cache in budget, so
+    we walk containers a few levels deep and charge the shallow
+    size for everything else (ORM objects are charged their __dict__)
+    """
+    size = sys.getsizeof(value)
+    if depth == 0 or isinstance(value, (str, bytes, bytearray, int, float)):
+        return size
+
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += approximate_size(k, depth - 1) + approximate_size(v, depth - 1)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for v in value:
+            size += approximate_size(v, depth - 1)
+    elif hasattr(value, '__dict__'):
+        size += approximate_size(value.__dict__, depth - 1)
+    return size
+
+
 class ExpiryCacheObject(object):
     """
     ExpiryCache object: Contains basic cached object information.
@@ -34,12 +65,14 @@ class ExpiryCacheObject(object):
     @key: Key to be stored in cache.
     @value: Value to stored per key.
     @ttl: Time to live in secs
+    @size: approximate size of value in bytes (0 if we aren't tracking)
     """
 
-    def __init__(self, key: str, value: object, ttl=None) -> None:
+    def __init__(self, key: str, value: object, ttl=None, size: int=0) -> None:
         self.key = key
         self.value = value
         self.ttl = ttl
+        self.size = size
         self.timeout = time.time()
 
 
@@ -48,13 +81,38 @@ class ExpiryCache(object):
     Main cache handler, responsible for caching and
     exposes get and put api.
 
-    Main cache data structure used is python  dict
+    Main cache data structure used is an OrderedDict, kept in
+    least-recently-used order. If max_entries or max_bytes are
+    specified the cache is bounded and the least recently used
+    entries are evicted to make room.
+
+    Expiry deadlines are kept in a min-heap, so the cleaner only
+    touches entries that have actually expired. Heap entries are
+    (deadline, key) and are checked against the live entry when
+    popped, overwritten/removed keys just leave a stale heap entry.
     """
 
     def __init__(self, *args, **kwargs):
-        self._cache = {}
+        self._cache = OrderedDict()
         self.lock = threading.RLock()
-        self.schedule_cleaner()
+        self._max_entries = kwargs.get('max_entries', None)
+        self._max_bytes = kwargs.get('max_bytes', None)
+        self._current_bytes = 0
+        self._expiry_heap = []
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        if kwargs.get('schedule', True):
+            self.schedule_cleaner()
+
+    def is_bounded(self) -> bool:
+        return self._max_entries is not None or self._max_bytes is not None
+
+    def _remove(self, key: str) -> ExpiryCacheObject:
+        obj = self._cache.pop(key)
+        self._current_bytes -= obj.size
+        return obj
 
     def is_expired(self, obj: object) -> bool:
         """
@@ -67,7 +125,8 @@ class ExpiryCache(object):
                 return False
 
             if time.time() > obj.ttl + obj.timeout:
-                self._cache.pop(obj.key)
+                self._remove(obj.key)
+                self._expirations += 1
                 return True
             return False
 
@@ -78,31 +137,85 @@ class ExpiryCache(object):
 
     def expire_key(self, key: str) -> None:
         with self.lock:
-            obj = self._cache.pop(key)
+            obj = self._remove(key)
 
-    def timely_cache_cleaner(self) -> None:
+    def _compact_heap(self) -> None:
+        """rebuild the heap from live entries once stale entries dominate it"""
+        self._expiry_heap = [(obj.timeout + obj.ttl, obj.key) for obj in self._cache.values() if obj.ttl is not None]
+        heapq.heapify(self._expiry_heap)
+
+    def sweep_expired(self, now: float=None) -> int:
         """
-        Timely checks for expired object in cache and
-        clears object from cache.
+        remove everything whose deadline has passed, cost is
+        proportional to the number of expired (or stale) heap entries
+        :return: number of entries removed
         """
+        if now is None:
+            now = time.time()
 
+        num_expired = 0
         with self.lock:
-            all_obj = self._cache.values()
+            while len(self._expiry_heap) > 0 and self._expiry_heap[0][0] < now:
+                deadline, key = heapq.heappop(self._expiry_heap)
+                obj = self._cache.get(key)
+                if obj is None or obj.ttl is None or obj.timeout + obj.ttl > now:
+                    continue  # stale heap entry, key was removed or re-put
+                self._remove(key)
+                self._expirations += 1
+                num_expired += 1
+
+            if len(self._expiry_heap) > 2 * len(self._cache) + 1024:
+                self._compact_heap()
+        return num_expired
 
-            for obj in all_obj:
-                self.is_expired(obj)
+    def timely_cache_cleaner(self) -> None:
+        """
+        Timely checks for expired object in cache and
+        clears object from cache.
+        """
+        try:
+            self.sweep_expired()
+        finally:
             self.schedule_cleaner()
 
+    def _evict(self) -> None:
+        """drop least recently used entries until we are within budget"""
+        while len(self._cache) > 0:
+            over_entries = self._max_entries is not None and len(self._cache) > self._max_entries
+            over_bytes = self._max_bytes is not None and self._current_bytes > self._max_bytes
+            if not over_entries and not over_bytes:
+                return
+            key, obj = self._cache.popitem(last=False)
+            self._current_bytes -= obj.size
+            self._evictions += 1
+
     def put(self, key: str, value: object, ttl=None) -> None:
         """
         Insert value in cache
         """
 
+        if ttl is not None and type(ttl) not in [int, float]:
+            raise ExpiryValueException("ttl should be int or float.")
+
+        size = 0
+        if self._max_bytes is not None:
+            size = approximate_size(value)
+
         with self.lock:
-            if ttl is not None and type(ttl) not in [int, float]:
-                raise ExpiryValueException("ttl should be int or float.")
+            if key in self._cache:
+                self._remove(key)
 
-            self._cache[key] = ExpiryCacheObject(key, value, ttl)
+            if self._max_bytes is not None and size > self._max_bytes:
+                self._evictions += 1 # never going to fit, don't flush everything else trying
+                return
+
+            obj = ExpiryCacheObject(key, value, ttl, size)
+            self._cache[key] = obj
+            self._current_bytes += size
+            if ttl is not None:
+                heapq.heappush(self._expiry_heap, (obj.timeout + ttl, key))
+            if self.is_bounded():
+                self._evict()
 
     def get(self, key: str) -> object:
         """
@@ -111,12 +224,12 @@ class ExpiryCache(object):
 
         with self.lock:
             obj = self._cache.get(key)
-            if obj is None:
-                return None
-
-            if self.is_expired(obj):
+            if obj is None or self.is_expired(obj):
+                self._misses += 1
                 return None
 
+            self._cache.move_to_end(key)
+            self._hits += 1
             return obj.value
 
 
@@ -127,15 +240,104 @@ class ExpiryCache(object):
 
         with self.lock:
             obj = self._cache.get(key)
-            if obj is None:
+            if obj is None or self.is_expired(obj):
+                self._misses += 1
                 return None, None
 
-            if self.is_expired(obj):
-                return None, None
+            self._cache.move_to_end(key)
+            self._hits += 1
 
         return obj.value, obj.timeout
 
+    def stats(self) -> dict:
+        """counters for /config & /healthcheck reporting"""
+        with self.lock:
+            return {'entries': len(self._cache),
+                    'bytes': self._current_bytes,
+                    'max_entries': self._max_entries,
+                    'max_bytes': self._max_bytes,
+                    'hits': self._hits,
+                    'misses': self._misses,
+                    'evictions': self._evictions,
+                    'expirations': self._expirations}
+
 
-# instantiate a "global" instance of our cache
-_expiry_cache = ExpiryCache()
+class ShardedExpiryCache(object):
+    """
+    Lock-striped cache. Keys are hashed to one of 'num_shards'
+    ExpiryCache instances, each with its own lock, LRU order,
+    expiry heap and a 1/num_shards slice of the budget. Request
+    threads only contend when they hit the same shard. One timer
+    sweeps all the shards.
+    """
+
+    def __init__(self, *args, **kwargs):
+        num_shards = kwargs.get('num_shards', 16)
+        max_entries = kwargs.get('max_entries', None)
+        max_bytes = kwargs.get('max_bytes', None)
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+
+        shard_entries = None
+        if max_entries is not None:
+            shard_entries = max(1, -(-max_entries // num_shards))
+        shard_bytes = None
+        if max_bytes is not None:
+            shard_bytes = max(1, -(-max_bytes // num_shards))
+
+        self._shards = [ExpiryCache(max_entries=shard_entries, max_bytes=shard_bytes, schedule=False)
+                        for i in range(num_shards)]
+        if kwargs.get('schedule', True):
+            self.schedule_cleaner()
+
+    def _shard(self, key: str) -> ExpiryCache:
+        return self._shards[hash(key) % len(self._shards)]
+
+    def schedule_cleaner(self) -> None:
+        t = threading.Timer(SCHEDULE_TIMEOUT, self.timely_cache_cleaner)
+        t.setDaemon(True)
+        t.start()
+
+    def sweep_expired(self, now: float=None) -> int:
+        num_expired = 0
+        for shard in self._shards:
+            num_expired += shard.sweep_expired(now)
+        return num_expired
 
+    def timely_cache_cleaner(self) -> None:
+        try:
+            self.sweep_expired()
+        finally:
+            self.schedule_cleaner()
+
+    def expire_key(self, key: str) -> None:
+        self._shard(key).expire_key(key)
+
+    def put(self, key: str, value: object, ttl=None) -> None:
+        self._shard(key).put(key, value, ttl)
+
+    def get(self, key: str) -> object:
+        return self._shard(key).get(key)
+
+    def get_with_time(self, key: str) -> tuple:
+        return self._shard(key).get_with_time(key)
+
+    def stats(self) -> dict:
+        """counters summed over the shards, limits are the configured totals"""
+        d = {'entries': 0, 'bytes': 0, 'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+        for shard in self._shards:
+            shard_stats = shard.stats()
+            for k in d:
+                d[k] += shard_stats[k]
+        d['max_entries'] = self._max_entries
+        d['max_bytes'] = self._max_bytes
+        d['shards'] = len(self._shards)
+        return d
+
+
+# instantiate a "global" instance of our cache
+# bounded so a big category full of thumbnails can't grow a worker without limit
+_CACHE_MAX_ENTRIES = 20000
+_CACHE_MAX_BYTES = 128 * 1024 * 1024
+_CACHE_SHARDS = 16
+_expiry_cache = ShardedExpiryCache(num_shards=_CACHE_SHARDS, max_entries=_CACHE_MAX_ENTRIES, max_bytes=_CACHE_MAX_BYTES)
@@ -0,0 +1,297 @@
+"""
+Two level cache, the per-worker ExpiryCache in front of a
+Redis tier shared by all the gunicorn workers on the box.
+
+Usage:
+
+from cache.SharedCache import _shared_cache
+_shared_cache.put("ALL_CATEGORIES", cl, ttl=300)   # local + shared
+cl = _shared_cache.get("ALL_CATEGORIES")             # local, then shared
+_shared_cache.expire_key("ALL_CATEGORIES")           # every worker drops it
+
+Values are pickled into Redis along with their deadline, so a worker
+that promotes an entry from the shared tier keeps the original expiry.
+expire_key() deletes the shared copy and publishes the key on a
+channel, each worker has a listener thread that drops its local copy.
+The connections come from the leaderboards' redis pool, asked for on
+every call since the pool is rebuilt when redis moves.
+
+Redis also holds the leaderboards & ballot queues, so the shared tier
+is for small values every worker wants: put(..., local_only=True) keeps
+a value in the worker (e.g. per photo thumbnails) and values bigger
+than MAX_SHARED_BYTES are never copied to Redis.
+
+If Redis can't be reached we quietly run as a local-only cache and
+try to reconnect every RECONNECT_INTERVAL seconds.
+"""
+
+import time
+import pickle
+import threading
+from logsetup import logger
+from cache.ExpiryCache import _expiry_cache
+
+RECONNECT_INTERVAL = 30
+LISTEN_POLL_SECONDS = 1.0
+MAX_SHARED_BYTES = 512 * 1024
+KEY_PREFIX = 'iicache:'
+INVALIDATE_CHANNEL = 'iicache:invalidate'
+
+
+def default_redis_connection():
+    """
+    a client on the process wide redis pool the leaderboards use
+    (RewardMgr._redis_server). Imports are local since the models
+    import the cache.
+    """
+    from controllers import RewardMgr
+
+    return RewardMgr._redis_server.connection(None)
+
+
+def _timeout_errors() -> tuple:
+    try:
+        import redis
+        return (TimeoutError, redis.exceptions.TimeoutError)
+    except ImportError:
+        return (TimeoutError,)
+
+
+class SharedCache(object):
+    """
+    same get/put/get_with_time/expire_key/stats api as ExpiryCache
+    so callers can switch over without other changes
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._local = kwargs.get('local', None)
+        if self._local is None:
+            self._local = _expiry_cache
+        self._f_redis = kwargs.get('f_redis', default_redis_connection)
+        self._prefix = kwargs.get('prefix', KEY_PREFIX)
+        self._channel = kwargs.get('channel', INVALIDATE_CHANNEL)
+        self._listen = kwargs.get('listen', True)
+        self._max_shared_bytes = kwargs.get('max_shared_bytes', MAX_SHARED_BYTES)
+
+        self._lock = threading.Lock()
+        self._conn = None
+        self._last_attempt = 0
+        self._pubsub = None
+
+        self._shared_hits = 0
+        self._shared_misses = 0
+        self._shared_errors = 0
+        self._invalidations_received = 0
+
+    def _connection(self):
+        """
+        the redis connection, or None if we are currently running local-only.
+        It's asked for every time, the server hands out a new client when redis
+        moves & then we move our subscription over to it.
+        """
+        conn = self._conn
+        if conn is None:
+            with self._lock:
+                if self._conn is not None:
+                    return self._conn
+                now = time.time()
+                if now - self._last_attempt < RECONNECT_INTERVAL:
+                    return None
+                self._last_attempt = now
+                try:
+                    conn = self._f_redis()
+                    if self._listen:
+                        self._start_listener(conn)
+                    self._conn = conn
+                except Exception as e:
+                    self._shared_errors += 1
+                    logger.exception(msg='shared cache unavailable, running local only')
+                    return None
+            return conn
+
+        try:
+            current = self._f_redis()
+        except Exception as e:
+            logger.exception(msg='shared cache unavailable, running local only')
+            self._disconnect()
+            return None
+        if current is not conn:
+            with self._lock:
+                if self._conn is conn:
+                    old_pubsub = self._pubsub
+                    try:
+                        if self._listen:
+                            self._start_listener(current)
+                        self._conn = current
+                    except Exception as e:
+                        self._shared_errors += 1
+                        self._conn = None
+                        self._pubsub = None
+                        logger.exception(msg='shared cache resubscribe failed, running local only')
+                        current = None
+                    if old_pubsub is not None:
+                        try:
+                            old_pubsub.close()
+                        except Exception as e:
+                            pass
+        return current
+
+    def _disconnect(self, pubsub=None) -> None:
+        """
+        drop the connection (and our subscription) so the next call reconnects
+        :param pubsub: only disconnect if this is still the current subscription
+        """
+        with self._lock:
+            if pubsub is not None and pubsub is not self._pubsub:
+                return
+            self._conn = None
+            self._shared_errors += 1
+            old_pubsub, self._pubsub = self._pubsub, None
+        if old_pubsub is not None and old_pubsub is not pubsub:
+            try:
+                old_pubsub.close()
+            except Exception as e:
+                pass
+
+    def _start_listener(self, conn) -> None:
+        pubsub = conn.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self._channel)
+        self._pubsub = pubsub
+        t = threading.Thread(target=self._listen_for_invalidations, args=(pubsub,))
+        t.setDaemon(True)
+        t.start()
+
+    def _listen_for_invalidations(self, pubsub) -> None:
+        """
+        poll for invalidations, a quiet channel (a read timeout) is normal,
+        anything else means we may have missed some and have to resubscribe
+        """
+        timeouts = _timeout_errors()
+        try:
+            while pubsub is self._pubsub:
+                try:
+                    message = pubsub.get_message(timeout=LISTEN_POLL_SECONDS)
+                except timeouts:
+                    continue
+                if message is None or message.get('type') != 'message':
+                    continue
+                key = message['data']
+                if isinstance(key, bytes):
+                    key = key.decode('utf-8')
+                self._invalidations_received += 1
+                self._expire_local(key)
+            return # replaced by a newer subscription
+        except Exception as e:
+            if pubsub is self._pubsub:
+                logger.exception(msg='shared cache invalidation listener stopped')
+        # we may have missed invalidations, drop the connection so we resubscribe
+        self._disconnect(pubsub)
+        try:
+            pubsub.close()
+        except Exception as e:
+            pass
+
+    def _expire_local(self, key) -> None:
+        try:
+            self._local.expire_key(key)
+        except KeyError:
+            pass
+
+    def _shared_key(self, key) -> str:
+        return self._prefix + str(key)
+
+    def put(self, key: str, value: object, ttl=None, local_only: bool=False) -> None:
+        """
+        :param local_only: True -> only this worker keeps it, expire_key() still drops it
+        """
+        self._local.put(key, value, ttl)
+        if local_only:
+            return
+
+        conn = self._connection()
+        if conn is None:
+            return
+        try:
+            created = time.time()
+            deadline = None if ttl is None else created + ttl
+            data = pickle.dumps((deadline, created, value), protocol=pickle.HIGHEST_PROTOCOL)
+            if len(data) > self._max_shared_bytes:
+                logger.info(msg='shared cache, value for {0} is {1} bytes, local only'.format(key, len(data)))
+                return
+            if ttl is None:
+                conn.set(self._shared_key(key), data)
+            else:
+                conn.set(self._shared_key(key), data, px=max(1, int(ttl * 1000)))
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            logger.info(msg='shared cache, value for {0} not picklable, local only'.format(key))
+        except Exception as e:
+            logger.exception(msg='shared cache put failed')
+            self._disconnect()
+
+    def _get_shared(self, key: str) -> tuple:
+        conn = self._connection()
+        if conn is None:
+            return None, None
+        try:
+            data = conn.get(self._shared_key(key))
+        except Exception as e:
+            logger.exception(msg='shared cache get failed')
+            self._disconnect()
+            return None, None
+
+        if data is None:
+            self._shared_misses += 1
+            return None, None
+
+        deadline, created, value = pickle.loads(data)
+        now = time.time()
+        if deadline is not None and deadline <= now:
+            self._shared_misses += 1
+            return None, None
+
+        self._shared_hits += 1
+        self._local.put(key, value, None if deadline is None else deadline - now)
+        return value, created
+
+    def get(self, key: str) -> object:
+        value = self._local.get(key)
+        if value is not None:
+            return value
+        value, created = self._get_shared(key)
+        return value
+
+    def get_with_time(self, key: str) -> tuple:
+        value, created = self._local.get_with_time(key)
+        if value is not None:
+            return value, created
+        return self._get_shared(key)
+
+    def expire_key(self, key: str) -> None:
+        """
+        drops the key everywhere. Unlike ExpiryCache we don't raise
+        KeyError for a missing key, another worker may still have it.
+        """
+        self._expire_local(key)
+
+        conn = self._connection()
+        if conn is None:
+            return
+        try:
+            conn.delete(self._shared_key(key))
+            conn.publish(self._channel, str(key))
+        except Exception as e:
+            logger.exception(msg='shared cache invalidate failed')
+            self._disconnect()
+
+    def stats(self) -> dict:
+        d = self._local.stats()
+        d['shared_connected'] = self._conn is not None
+        d['shared_hits'] = self._shared_hits
+        d['shared_misses'] = self._shared_misses
+        d['shared_errors'] = self._shared_errors
+        d['invalidations_received'] = self._invalidations_received
+        return d
+
+
+# the "global" two level cache, fronted by the worker's _expiry_cache
+_shared_cache = SharedCache(local=_expiry_cache)
@@ -1,13 +1,412 @@
 """the controller for the ballot & voting model. """
 import errno
 import json
-from random import shuffle
+from random import shuffle, randint
 from sqlalchemy import exists
-from sqlalchemy import func
+from sqlalchemy import func, case
 from logsetup import logger, timeit
 from dbsetup import Configuration
 from models import usermgr, category, event, engagement, photo, voting
 from controllers import RewardMgr
+from cache.SharedCache import _shared_cache
+
+class BallotQueue:
+    """
+    Round #1 candidate photos for a category, kept in a Redis sorted set.
+    Members are 'pid:uid' (so the voter's own photos can be skipped without
+    touching the database) and the score is the number of ballots the photo
+    has been on, i.e. photos are bucketed by times-seen.
+
+    The set is built from one aggregate query when it's missing and rebuilt
+    every _QUEUE_TTL seconds (which repairs any drift), in between it's kept
+    current with a ZINCRBY for every ballot entry created, and photos are
+    added as they're activated & removed when they're de-activated.
+    Drawing a ballot reads a random window of the least seen bucket, O(log n + k).
+
+    For round #2 there is one queue per section, scored by VotingRound.times_voted.
+    """
+    _QUEUE_TTL = 10 * 60
+    _WINDOW = 4 # read count*_WINDOW members of a bucket to pick from
+
+    def __init__(self, cid: int, conn, section: int=None):
+        self._cid = cid
+        self._conn = conn
+        self._section = section
+
+    def queue_name(self) -> str:
+        if self._section is None:
+            return 'ballot_queue_category{0}'.format(self._cid)
+        return 'ballot_queue_category{0}_section{1}'.format(self._cid, self._section)
+
+    def built_key(self) -> str:
+        """set while the queue is built, an empty category has no sorted set to look for"""
+        return self.queue_name() + ':built'
+
+    def exists(self) -> bool:
+        return self._conn.exists(self.built_key())
+
+    @staticmethod
+    def member(pid: int, uid: int) -> str:
+        return '{0}:{1}'.format(pid, uid)
+
+    @staticmethod
+    def parse_member(m) -> (int, int):
+        if isinstance(m, bytes):
+            m = m.decode('utf-8')
+        pid, uid = m.split(':')
+        return int(pid), int(uid)
+
+    def build_from_rows(self, rows: list) -> None:
+        """
+        replace the queue, 'rows' are (pid, uid, times_seen). We build into a
+        scratch key and RENAME it so ballots never see a half built queue.
+        No rows drops the old queue, either way the built marker is set so an
+        empty category isn't rebuilt on every ballot.
+        zincrby() on an empty key is used as ZADD, its signature is the same across redis-py versions
+        """
+        name = self.queue_name()
+        scratch = name + ':build'
+        pipe = self._conn.pipeline(transaction=True)
+        pipe.delete(scratch)
+        for pid, uid, times_seen in rows:
+            pipe.zincrby(scratch, value=self.member(pid, uid), amount=times_seen)
+        if len(rows) > 0:
+            pipe.rename(scratch, name)
+            pipe.expire(name, self._QUEUE_TTL)
+        else:
+            pipe.delete(name)
+        pipe.set(self.built_key(), 1, ex=self._QUEUE_TTL)
+        pipe.execute()
+
+    @staticmethod
+    def sections_key(cid: int) -> str:
+        """set while the category's round #2 section queues are built, an empty section has no queue to look for"""
+        return 'ballot_queue_category{0}_sections'.format(cid)
+
+    @staticmethod
+    def sections_built(cid: int, conn) -> bool:
+        return conn.exists(BallotQueue.sections_key(cid))
+
+    @staticmethod
+    def build_sections_from_rows(cid: int, conn, rows: list) -> None:
+        """
+        build every round #2 section queue of the category, 'rows' are
+        (pid, uid, section, times_voted). The built marker is set last, with
+        the queues' TTL, so it never outlives them.
+        """
+        sections = {section: [] for section in range(voting._NUM_SECTONS_ROUND2)}
+        for pid, uid, section, times_voted in rows:
+            sections.setdefault(section, []).append((pid, uid, times_voted or 0))
+        for section, section_rows in sections.items():
+            BallotQueue(cid, conn, section=section).build_from_rows(section_rows)
+        conn.set(BallotQueue.sections_key(cid), 1, ex=BallotQueue._QUEUE_TTL)
+
+    @staticmethod
+    def build_sections(session, cid: int, conn) -> None:
+        """build every round #2 section queue of the category from one query"""
+        q = session.query(photo.Photo.id, photo.Photo.user_id, voting.VotingRound.section, voting.VotingRound.times_voted). \
+            join(voting.VotingRound, voting.VotingRound.photo_id == photo.Photo.id). \
+            filter(photo.Photo.category_id == cid). \
+            filter(photo.Photo.active == 1)
+        BallotQueue.build_sections_from_rows(cid, conn, q.all())
+
+    def build(self, session) -> None:
+        q = session.query(photo.Photo.id, photo.Photo.user_id, func.count(voting.BallotEntry.id)). \
+            outerjoin(voting.BallotEntry, voting.BallotEntry.photo_id == photo.Photo.id). \
+            filter(photo.Photo.category_id == self._cid). \
+            filter(photo.Photo.active == 1). \
+            group_by(photo.Photo.id, photo.Photo.user_id)
+        self.build_from_rows(q.all())
+
+    def add_photo(self, pid: int, uid: int) -> None:
+        """
+        the photo was just activated, put it in the least seen bucket so it's
+        drawn without waiting for the rebuild. ZADD NX never moves a photo that's
+        already queued (sent raw, redis-py 2.10 has no nx flag). The queue
+        lives as long as its built marker, a queue that isn't built is left
+        for build()
+        """
+        name = self.queue_name()
+        if not self.exists():
+            return
+
+        pipe = self._conn.pipeline(transaction=False)
+        pipe.execute_command('ZADD', name, 'NX', 0, self.member(pid, uid))
+        pipe.ttl(self.built_key())
+        results = pipe.execute()
+        if results[-1] is None or results[-1] < 0:
+            self._conn.delete(name) # the queue expired under us & we just created a partial one
+        else:
+            self._conn.expire(name, results[-1]) # the first photo of an empty category creates the set
+
+    def remove_photo(self, pid: int, uid: int) -> None:
+        """the photo was de-activated, stop drawing it"""
+        self._conn.zrem(self.queue_name(), self.member(pid, uid))
+
+    def next_bucket(self, score=None):
+        """:return: the lowest times-seen above 'score' (the lowest one if None), None if there isn't one"""
+        lo = '-inf' if score is None else '({0}'.format(score)
+        head = self._conn.zrangebyscore(self.queue_name(), lo, '+inf', start=0, num=1, withscores=True)
+        return head[0][1] if len(head) > 0 else None
+
+    def draw_bucket(self, uid: int, score, window: int, exclude: set) -> list:
+        """
+        read a random window of the 'score' bucket
+        :return: shuffled list of (pid, owner uid), none belonging to 'uid' or in 'exclude'
+        """
+        name = self.queue_name()
+        in_bucket = self._conn.zcount(name, score, score)
+        offset = randint(0, max(0, in_bucket - window))
+        members = self._conn.zrangebyscore(name, score, score, start=offset, num=window)
+        candidates = []
+        for m in members:
+            pid, owner = self.parse_member(m)
+            if owner != uid and pid not in exclude:
+                candidates.append((pid, owner))
+        shuffle(candidates)
+        return candidates
+
+    def draw(self, uid: int, count: int) -> list:
+        """
+        pick up to 'count' photos, least seen first, none belonging to 'uid'
+        :return: list of (pid, owner uid)
+        """
+        return [(pid, owner) for pid, owner, q in BallotQueue.draw_merged([self], uid, count)]
+
+    @staticmethod
+    def draw_merged(queues: list, uid: int, count: int) -> list:
+        """
+        pick up to 'count' photos from several queues (the round #2 sections)
+        as if they were one: least seen first across all of them, within a
+        bucket the queues are visited in the order given, none belonging to 'uid'
+        :return: list of (pid, owner uid, queue it came from)
+        """
+        picked = []
+        picked_pids = set()
+        window = count * BallotQueue._WINDOW
+        score = None
+        while len(picked) < count:
+            # the next bucket is the lowest head of any queue
+            heads = [head for head in (q.next_bucket(score) for q in queues) if head is not None]
+            if len(heads) == 0:
+                break
+            score = min(heads)
+            for q in queues:
+                for pid, owner in q.draw_bucket(uid, score, window, picked_pids)[:count - len(picked)]:
+                    picked.append((pid, owner, q))
+                    picked_pids.add(pid)
+                if len(picked) >= count:
+                    break
+        return picked
+
+    def draw_photos(self, session, uid: int, count: int) -> list:
+        """
+        draw() & read the Photo objects in one query, photos that have gone away or been
+        de-activated since the queue was built are dropped from it
+        """
+        if not self.exists():
+            self.build(session)
+
+        drawn = self.draw(uid, count)
+        if len(drawn) == 0:
+            return []
+        pl = session.query(photo.Photo).filter(photo.Photo.id.in_([pid for pid, owner in drawn])).filter(photo.Photo.active == 1).all()
+        if len(pl) < len(drawn):
+            found = {p.id for p in pl}
+            self._conn.zrem(self.queue_name(), *[self.member(pid, owner) for pid, owner in drawn if pid not in found])
+        return pl
+
+    def record_ballot(self, plist: list) -> None:
+        """the photos were just put on a ballot, move them up a bucket"""
+        name = self.queue_name()
+        if len(plist) == 0 or not self._conn.exists(name):
+            return # nothing to maintain, it'll be built from the database
+
+        pipe = self._conn.pipeline(transaction=False)
+        for p in plist:
+            pipe.zincrby(name, value=self.member(p.id, p.user_id), amount=1)
+        pipe.ttl(name)
+        results = pipe.execute()
+        if results[-1] is None or results[-1] < 0:
+            self._conn.delete(name) # the queue expired under us & we just created a partial one
+
+
+class VoteableCategoryIndex:
+    """
+    Everything active_voting_categories() needs to answer "which categories
+    can this user vote on", for every user at once: the VOTING/UPLOAD
+    categories, active photo counts per (category, user) and event
+    membership per category. It holds plain ints so it can be shared
+    between workers.
+
+    The categories & event membership are two small queries, cached for
+    _INDEX_TTL seconds; joining an event and category state changes expire
+    them. The photo counts are kept in Redis, one hash per category of
+    uid -> # active photos, and are moved by count_photo() as photos are
+    activated (or de-activated). Only reconcile_counts() aggregates the
+    photo table, when the hashes are missing (every _COUNTS_TTL seconds, or
+    sooner from the sync daemon), which also repairs any drift. Without
+    Redis the counts are read from the database.
+
+    Same rules as the query path:
+      VOTING - more than 3 active photos that aren't the user's
+      UPLOAD - the user has uploaded, and there are at least
+               UPLOAD_CATEGORY_PICS active photos that aren't the user's
+    and event categories are only open to the event's members.
+    """
+    _INDEX_TTL = 60
+    _USER_TTL = 30
+    _COUNTS_TTL = 60 * 60
+    _COUNTS_KEY = 'voteable_counts_category{0}'
+    _COUNTS_BUILT_KEY = 'voteable_counts_built'
+
+    def __init__(self, **kwargs):
+        self._states = kwargs.get('states', {})     # cid -> CategoryState value
+        self._totals = kwargs.get('totals', {})     # cid -> # active photos
+        self._by_user = kwargs.get('by_user', {})   # cid -> {uid: # active photos}
+        self._members = kwargs.get('members', {})   # cid -> set of uids, only for event categories with members
+
+    @staticmethod
+    def from_rows(category_rows: list, count_rows: list, member_rows: list):
+        """
+        :param category_rows: (cid, state)
+        :param count_rows: (cid, uid, # active photos)
+        :param member_rows: (cid, uid), uid is None for an event without members
+        :return: VoteableCategoryIndex
+        """
+        states = {cid: state for cid, state in category_rows}
+        totals = {}
+        by_user = {}
+        for cid, uid, num_photos in count_rows:
+            if cid not in states:
+                continue
+            totals[cid] = totals.get(cid, 0) + num_photos
+            by_user.setdefault(cid, {})[uid] = num_photos
+        members = {}
+        for cid, uid in member_rows:
+            if cid in states and uid is not None:
+                members.setdefault(cid, set()).add(uid)
+        return VoteableCategoryIndex(states=states, totals=totals, by_user=by_user, members=members)
+
+    @staticmethod
+    def read_categories(session) -> tuple:
+        """:return: (category_rows, member_rows) for from_rows()"""
+        open_states = (category.CategoryState.VOTING.value, category.CategoryState.UPLOAD.value)
+        category_rows = session.query(category.Category.id, category.Category.state). \
+            filter(category.Category.state.in_(open_states)).all()
+        member_rows = session.query(event.EventCategory.category_id, event.EventUser.user_id). \
+            join(category.Category, category.Category.id == event.EventCategory.category_id). \
+            outerjoin(event.EventUser, event.EventUser.event_id == event.EventCategory.event_id). \
+            filter(category.Category.state.in_(open_states)).all()
+        return [tuple(row) for row in category_rows], [tuple(row) for row in member_rows]
+
+    @staticmethod
+    def count_rows(session) -> list:
+        """:return: (cid, uid, # active photos) for the open categories, the one aggregate of the photo table"""
+        open_states = (category.CategoryState.VOTING.value, category.CategoryState.UPLOAD.value)
+        return session.query(photo.Photo.category_id, photo.Photo.user_id, func.count(photo.Photo.id)). \
+            join(category.Category, category.Category.id == photo.Photo.category_id). \
+            filter(category.Category.state.in_(open_states)). \
+            filter(photo.Photo.active == 1). \
+            group_by(photo.Photo.category_id, photo.Photo.user_id).all()
+
+    @staticmethod
+    def build(session):
+        """the index straight from the database"""
+        category_rows, member_rows = VoteableCategoryIndex.read_categories(session)
+        return VoteableCategoryIndex.from_rows(category_rows, VoteableCategoryIndex.count_rows(session), member_rows)
+
+    @staticmethod
+    def reconcile_counts(session, conn, category_rows: list=None) -> int:
+        """
+        (re)write the photo count hashes of the open categories from the database
+        :return: number of categories written
+        """
+        if category_rows is None:
+            category_rows, member_rows = VoteableCategoryIndex.read_categories(session)
+        counts = {cid: {} for cid, state in category_rows}
+        for cid, uid, num_photos in VoteableCategoryIndex.count_rows(session):
+            if cid in counts:
+                counts[cid][uid] = num_photos
+
+        pipe = conn.pipeline(transaction=True)
+        for cid, by_user in counts.items():
+            name = VoteableCategoryIndex._COUNTS_KEY.format(cid)
+            pipe.delete(name)
+            if len(by_user) > 0:
+                pipe.hmset(name, by_user)
+                pipe.expire(name, 2 * VoteableCategoryIndex._COUNTS_TTL) # closed categories age out
+        pipe.set(VoteableCategoryIndex._COUNTS_BUILT_KEY, 1, ex=VoteableCategoryIndex._COUNTS_TTL)
+        pipe.execute()
+        return len(counts)
+
+    @staticmethod
+    def count_photo(conn, cid: int, uid: int, delta: int=1) -> None:
+        """a photo was activated (+1) or de-activated (-1), move its category's count"""
+        if not conn.exists(VoteableCategoryIndex._COUNTS_BUILT_KEY):
+            return # reconcile_counts() will count it
+        name = VoteableCategoryIndex._COUNTS_KEY.format(cid)
+        pipe = conn.pipeline(transaction=False)
+        pipe.hincrby(name, uid, delta)
+        pipe.expire(name, 2 * VoteableCategoryIndex._COUNTS_TTL)
+        pipe.execute()
+
+    @staticmethod
+    def read_counts(session, conn, category_rows: list) -> list:
+        """:return: (cid, uid, # active photos) from the count hashes, reconciled first if they're missing"""
+        if not conn.exists(VoteableCategoryIndex._COUNTS_BUILT_KEY):
+            VoteableCategoryIndex.reconcile_counts(session, conn, category_rows)
+
+        cids = [cid for cid, state in category_rows]
+        pipe = conn.pipeline(transaction=False)
+        for cid in cids:
+            pipe.hgetall(VoteableCategoryIndex._COUNTS_KEY.format(cid))
+        count_rows = []
+        for cid, by_user in zip(cids, pipe.execute()):
+            for uid, num_photos in by_user.items():
+                count_rows.append((cid, int(uid), int(num_photos)))
+        return count_rows
+
+    @staticmethod
+    def read(session):
+        """the index, from the cached categories & the Redis photo counts"""
+        rows = _shared_cache.get(category.Category.VOTEABLE_INDEX_KEY)
+        if rows is None:
+            rows = VoteableCategoryIndex.read_categories(session)
+            _shared_cache.put(category.Category.VOTEABLE_INDEX_KEY, rows, VoteableCategoryIndex._INDEX_TTL)
+        category_rows, member_rows = rows
+
+        try:
+            conn = RewardMgr._redis_server.connection(session)
+            count_rows = VoteableCategoryIndex.read_counts(session, conn, category_rows)
+        except Exception as e:
+            RewardMgr._redis_server.connection_failed(e)
+            logger.exception(msg="error reading voteable category counts")
+            count_rows = VoteableCategoryIndex.count_rows(session)
+        return VoteableCategoryIndex.from_rows(category_rows, count_rows, member_rows)
+
+    def can_access(self, cid: int, uid: int) -> bool:
+        members = self._members.get(cid, None)
+        return members is None or uid in members
+
+    def voteable(self, uid: int) -> list:
+        """
+        :param uid: the voter
+        :return: <list> of category ids the user can vote on
+        """
+        cids = []
+        for cid, state in self._states.items():
+            if not self.can_access(cid, uid):
+                continue
+            mine = self._by_user.get(cid, {}).get(uid, 0)
+            others = self._totals.get(cid, 0) - mine
+            if state == category.CategoryState.VOTING.value:
+                if others > 3:
+                    cids.append(cid)
+            elif mine > 0 and others >= Configuration.UPLOAD_CATEGORY_PICS:
+                cids.append(cid)
+        return sorted(cids)
+
 
 class BallotManager:
     """
@@ -17,6 +416,10 @@ class BallotManager:
 
     _ballot = None
 
+    def __init__(self, **kwargs):
+        self._batched = kwargs.get('batched', True) # False -> original entry by entry tabulation
+        self._drawn_sections = {} # pid -> section, for the last round #2 ballot drawn from the queues
+
     def string_key_to_boolean(self, d: dict, keyname: str) -> int:
         """
         if key is not present, return a '0'
@@ -49,8 +452,8 @@ class BallotManager:
         # let's determine if the user has earned any badges for this vote
         # (Note: the current vote hasn't been cast yet)
         try:
-            q = session.query(func.count(voting.Ballot.user_id)).filter(voting.Ballot.user_id == uid)
-            num_votes = q.scalar()
+            ua = engagement.UserActivity.read(session, uid)
+            num_votes = 0 if ua is None else ua.num_votes
             # note: this is an ordered list!!
             for i in range(0, len(self._BADGES_FOR_VOTING)):
                 threshold, badge_award = self._BADGES_FOR_VOTING[i]
@@ -100,6 +503,104 @@ class BallotManager:
         :param json_ballots: the ballotentries from the request
         :return: list of ballotentries, added to session, ready for commit
         """
+        if self._batched:
+            return self.process_ballots_batched(session, au, c, section, json_ballots)
+        return self.process_ballots_by_entry(session, au, c, section, json_ballots)
+
+    def process_ballots_batched(self, session, au: usermgr.AnonUser, c: category.Category, section: int, json_ballots: str) -> list:
+        """
+        same result as process_ballots_by_entry(), but:
+            - ballotentries & photos are read in one query
+            - score/times_voted are incremented with one UPDATE ... CASE
+            - the leaderboard is updated in one pipelined Redis round trip
+            - rewards are evaluated once for the ballot
+        :return: list of ballotentries (in request order), added to session, ready for commit
+        """
+        if len(json_ballots) == 0:
+            return []
+
+        bids = [j_be['bid'] for j_be in json_ballots]
+        try:
+            q = session.query(voting.BallotEntry, photo.Photo). \
+                join(photo.Photo, photo.Photo.id == voting.BallotEntry.photo_id). \
+                filter(voting.BallotEntry.id.in_(bids))
+            be_photos = {be.id: (be, p) for be, p in q.all()}
+        except Exception as e:
+            logger.exception(msg="error reading ballotentries for ballot")
+            raise
+
+        bel = []
+        score_deltas = {}
+        vote_deltas = {}
+        for j_be in json_ballots:
+            bid = j_be['bid']
+            like = self.string_key_to_boolean(j_be, 'like')
+            offensive = self.string_key_to_boolean(j_be, 'offensive')
+
+            # if there is an 'tag' specified, then create a BallotEntryTag
+            # record and save it
+            try:
+                tags = self.create_ballotentry_for_tags(session, j_be)
+            except Exception as e:
+                logger.exception(msg="error while writing ballotentrytag")
+                raise
+
+            try:
+                be, p = be_photos[bid]
+                be.like = like
+                be.offensive = offensive
+                be.vote = j_be['vote']
+                score = self.calculate_score(j_be['vote'], c.round, section)
+                score_deltas[p.id] = score_deltas.get(p.id, 0) + score
+                vote_deltas[p.id] = vote_deltas.get(p.id, 0) + 1
+                bel.append(be)
+            except Exception as e:
+                logger.exception(msg="error while updating photo with score")
+                raise
+
+            try:
+                if like or offensive or tags is not None:
+                    fbm = RewardMgr.FeedbackManager(uid=au.id, pid=be.photo_id, like=like, offensive=offensive, tags=tags)
+                    fbm.create_feedback(session)
+            except Exception as e:
+                logger.exception(msg="error while updating feedback for ballotentry")
+                raise
+
+        pids = list(score_deltas.keys())
+        try:
+            # let the database do the arithmetic, concurrent votes on the same photo can't lose an increment
+            session.query(photo.Photo).filter(photo.Photo.id.in_(pids)). \
+                update({photo.Photo.score: photo.Photo.score + case(score_deltas, value=photo.Photo.id, else_=0),
+                        photo.Photo.times_voted: photo.Photo.times_voted + case(vote_deltas, value=photo.Photo.id, else_=0)},
+                       synchronize_session=False)
+            for be, p in be_photos.values():
+                session.expire(p, ['score', 'times_voted'])
+
+            # our UPDATE holds the row locks, so these are the scores the leaderboard should see
+            q = session.query(photo.Photo.id, photo.Photo.score, photo.Photo.user_id).filter(photo.Photo.id.in_(pids))
+            pl = q.all()
+        except Exception as e:
+            logger.exception(msg="error while updating photo with score")
+            raise
+
+        tm = RewardMgr.TallyMan()
+        try:
+            tm.update_leaderboard_photos(session, c, pl)  # leaderboard may not be defined yet!
+        except:
+            pass
+
+        try:
+            self.update_rewards_for_vote(session, au)
+        except Exception as e:
+            logger.exception(msg="error updating reward for user{0}".format(au.id))
+            raise
+
+        return bel
+
+    def process_ballots_by_entry(self, session, au: usermgr.AnonUser, c: category.Category, section: int, json_ballots: str) -> list:
+        """
+        the original tabulation, every ballotentry is read, scored & ranked on its own
+        """
         bel = []
         for j_be in json_ballots:
             bid = j_be['bid']
@@ -203,81 +704,104 @@ class BallotManager:
         # Voting Rounds are stored in the category, 0= Round #1, 1= Round #2
         photo_list = self.create_ballot_list(session, user_id, c, allow_upload)
         self.update_votinground(session, c, photo_list)
+        self.update_ballot_queue(session, c, photo_list)
         return self.add_photos_to_ballot(session, user_id, c, photo_list)
 
+    def ballot_queue(self, session, c: category.Category) -> BallotQueue:
+        return BallotQueue(c.id, RewardMgr._redis_server.connection(session))
+
+    def update_ballot_queue(self, session, c, plist):
+        try:
+            if c.round == 0:
+                self.ballot_queue(session, c).record_ballot(plist)
+                return
+
+            # round #2, only photos we drew from a section queue know their section
+            by_section = {}
+            for p in plist:
+                if p.id in self._drawn_sections:
+                    by_section.setdefault(self._drawn_sections[p.id], []).append(p)
+            conn = RewardMgr._redis_server.connection(session)
+            for section, pl in by_section.items():
+                BallotQueue(c.id, conn, section=section).record_ballot(pl)
+        except Exception as e:
+            RewardMgr._redis_server.connection_failed(e)
+            logger.exception(msg="error updating ballot queue for category {0}".format(c.id))
+
 
     def update_votinground(self, session, c, plist):
-        if c.round == 0:
+        if c.round == 0 or len(plist) == 0:
             return
-        for p in plist:
-            session.query(voting.VotingRound).filter(voting.VotingRound.photo_id == p.id).update(
-                {"times_voted": voting.VotingRound.times_voted + 1})
+        session.query(voting.VotingRound).filter(voting.VotingRound.photo_id.in_([p.id for p in plist])).update(
+            {"times_voted": voting.VotingRound.times_voted + 1}, synchronize_session=False)
         return
 
     def add_photos_to_ballot(self, session, uid: int, c: category.Category, plist: list) -> voting.Ballot:
 
+        # the user's first ballot in the category makes them a voter
+        category.CategoryVoter.add(session, c.id, uid)
+        engagement.UserActivity.record_vote(session, uid)
+
         self._ballot = voting.Ballot(c.id, uid)
-        session.add(self._ballot)
 
-        # now create the ballot entries and attach to the ballot
+        # see if the user has "liked" any of these photos, one query for the whole ballot
+        feedback = engagement.Feedback.get_feedback_for_photos(session, uid, [p.id for p in plist])
+
+        # now create the ballot entries and attach to the ballot, they hang onto
+        # the photos we've already read so the ballot doesn't read them again
         for p in plist:
             be = voting.BallotEntry(user_id=p.user_id, category_id=c.id, photo_id=p.id)
-            self._ballot.append_ballotentry(be)
-            session.add(be)
-            # see if the user has "liked" this photo
-            fb = engagement.Feedback.get_feedback(session, pid=p.id, uid=uid)
+            fb = feedback.get(p.id, None)
             if fb is not None:
                 be.like = fb.like
                 be.offensive = fb.offensive
+            be._photo = p
+            self._ballot.append_ballotentry(be)
 
+        # the entries cascade from the ballot, one flush writes them all & gives us the 'bid's
+        session.add(self._ballot)
+        session.flush()
         return self._ballot
 
 
-    def read_photos_by_ballots_round2(self, session, uid: int, current_category: category.Category, num_votes: int,
-                                      count: int) -> list:
-        """return a list of photos that qualify for the next round of balloting
-        for the specified category"""
-
-        # *****************************
-        # **** CONFIGURATION ITEMS ****
-        num_sections = voting._NUM_SECTONS_ROUND2  # the "stratification" of the photos that received votes or likes
-        max_votes = voting._ROUND2_TIMESVOTED  # The max # of votes we need to pick a winner
-        # ****************************
-
-        # create an array of our sections
-        section_list = []
-        for idx in range(num_sections):
-            section_list.append(idx)
-
-        ballot_photo_list = []
-        shuffle(section_list)  # randomize the section list
-        oversize = count * 20
-        for section in section_list:
-            query = session.query(photo.Photo).filter(photo.Photo.user_id != uid). \
-                filter(photo.Photo.category_id == current_category.id). \
-                filter(photo.Photo.active == 1). \
-                join(voting.VotingRound, voting.VotingRound.photo_id == photo.Photo.id). \
-                filter(voting.VotingRound.section == section). \
-                filter(voting.VotingRound.times_voted == num_votes).limit(oversize)
-            photo_list = query.all()
-            ballot_photo_list.extend(photo_list)  # accumulate ballots we've picked, can save us time later
-            # see if we encountered 4 in our journey
-            if len(ballot_photo_list) >= count:
-                return ballot_photo_list
-
-        # we tried everything, let's just grab some photos from any section (HOW TO RANDOMIZE THIS??)
-        if num_votes == voting._MAX_VOTING_ROUNDS:
-            for section in section_list:
-                query = session.query(photo.Photo).filter(photo.Photo.user_id != uid). \
-                    filter(photo.Photo.category_id == current_category.id). \
-                    filter(photo.Photo.active == 1). \
-                    join(voting.VotingRound, voting.VotingRound.photo_id == photo.Photo.id). \
-                    filter(voting.VotingRound.section == section).limit(oversize)
-                photo_list = query.all()
-                ballot_photo_list.extend(photo_list)  # accumulate ballots we've picked, can save us time later
-                if len(ballot_photo_list) >= count:
-                    return ballot_photo_list
-        return ballot_photo_list  # return what we have
+    def read_photos_round2_from_queues(self, session, uid: int, c: category.Category, count: int) -> list:
+        """
+        the section queues drawn as one: least voted first across all the sections and
+        within the same times_voted, sections in a random order. The same ordering as
+        read_photos_round2(), so a ballot doesn't depend on whether Redis is up.
+        """
+        conn = RewardMgr._redis_server.connection(session)
+        section_list = list(range(voting._NUM_SECTONS_ROUND2))
+        shuffle(section_list)
+        queues = [BallotQueue(c.id, conn, section=section) for section in section_list]
+        if not BallotQueue.sections_built(c.id, conn):
+            BallotQueue.build_sections(session, c.id, conn)
+
+        drawn = []
+        self._drawn_sections = {}
+        for pid, owner, q in BallotQueue.draw_merged(queues, uid, count):
+            drawn.append(pid)
+            self._drawn_sections[pid] = q._section
+
+        if len(drawn) == 0:
+            return []
+        return session.query(photo.Photo).filter(photo.Photo.id.in_(drawn)).filter(photo.Photo.active == 1).all()
+
+    def read_photos_round2(self, session, uid: int, c: category.Category, count: int) -> list:
+        """
+        the database version of the section queues, one query: least voted first and within
+        the same times_voted, sections in a random order.
+        """
+        section_list = list(range(voting._NUM_SECTONS_ROUND2))
+        shuffle(section_list)
+        section_rank = case({section: idx for idx, section in enumerate(section_list)}, value=voting.VotingRound.section, else_=len(section_list))
+        q = session.query(photo.Photo). \
+            join(voting.VotingRound, voting.VotingRound.photo_id == photo.Photo.id). \
+            filter(photo.Photo.category_id == c.id). \
+            filter(photo.Photo.user_id != uid). \
+            filter(photo.Photo.active == 1). \
+            order_by(voting.VotingRound.times_voted, section_rank).limit(count * 20)
+        return q.all()
 
     # create_ballot_list()
     # ======================
@@ -303,13 +827,20 @@ class BallotManager:
 
         # we need "count"
         count = voting._NUM_BALLOT_ENTRIES
-        photos_for_ballot = []
-        for num_votes in range(0, voting._MAX_VOTING_ROUNDS + 1):
+        try:
             if c.round == 0:
-                photo_list = self.read_photos_by_ballots_round1(session, user_id, c, num_votes, count)
-            else:
-                photo_list = self.read_photos_by_ballots_round2(session, user_id, c, num_votes, count)
+                return self.cleanup_list(self.ballot_queue(session, c).draw_photos(session, user_id, count), count)
+            return self.cleanup_list(self.read_photos_round2_from_queues(session, user_id, c, count), count)
+        except Exception as e:
+            RewardMgr._redis_server.connection_failed(e)
+            logger.exception(msg="ballot queue unavailable for category {0}, reading from database".format(c.id))
+
+        if c.round != 0:
+            return self.cleanup_list(self.read_photos_round2(session, user_id, c, count), count)
 
+        photos_for_ballot = []
+        for num_votes in range(0, voting._MAX_VOTING_ROUNDS + 1):
+            photo_list = self.read_photos_by_ballots_round1(session, user_id, c, num_votes, count)
             if photo_list is not None:
                 photos_for_ballot.extend(photo_list)
                 if len(photos_for_ballot) >= count:
@@ -435,3 +966,24 @@ class BallotManager:
                 category_list.extend(set_list)
 
         return category_list
+
+    def voteable_categories(self, session, user_id: int) -> list:
+        """
+        Same answer as active_voting_categories(), but from the cached
+        VoteableCategoryIndex instead of aggregating the photo table
+        on every request. The user's category ids are cached too.
+        :param session: database connection
+        :param user_id: user id, to filter the category list to only categories the user can access
+        :return: <list> of categories available to the user for voting
+        """
+        key = category.Category.VOTEABLE_USER_KEY.format(user_id)
+        cids = _shared_cache.get(key)
+        if cids is None:
+            cids = VoteableCategoryIndex.read(session).voteable(user_id)
+            _shared_cache.put(key, cids, VoteableCategoryIndex._USER_TTL)
+        if len(cids) == 0:
+            return []
+
+        # the state filter protects us from a category that closed since we cached
+        return session.query(category.Category).filter(category.Category.id.in_(cids)). \
+            filter(category.Category.state.in_((category.CategoryState.VOTING.value, category.CategoryState.UPLOAD.value))).all()
@@ -1,11 +1,15 @@
 """the controller for the event model. """
 import errno
+import time
+import threading
 from datetime import timedelta, datetime
 from sqlalchemy import func
 import redis
+from concurrent.futures import ThreadPoolExecutor
 from leaderboard.leaderboard import Leaderboard
+import dbsetup
 from logsetup import logger, timeit
-from cache.ExpiryCache import _expiry_cache
+from cache.SharedCache import _shared_cache
 from models import error
 from models import usermgr, category, engagement, photo, voting
 
@@ -242,18 +246,10 @@ class RewardManager():
         :return:
         """
         try:
-            dt_now = datetime.now()
-            early_date = dt_now - timedelta(hours=day_span*24 + 1)
-
-            # group by the YYYY-MM-DD and count the records some our starting date, it should match 'day-span' if we've been consistently voting
-            q = session.query(func.year(voting.Ballot.created_date), func.month(voting.Ballot.created_date), func.day(voting.Ballot.created_date)). \
-                filter(voting.Ballot.user_id == au.id). \
-                filter(voting.Ballot.created_date >= early_date). \
-                distinct(func.year(voting.Ballot.created_date), \
-                         func.month(voting.Ballot.created_date), \
-                         func.day(voting.Ballot.created_date) )
-            d = q.all()
-            return len(d) >= day_span+1 # picket fence
+            ua = engagement.UserActivity.read(session, au.id)
+            if ua is None:
+                return False
+            return ua.vote_streak_on(datetime.now().date()) >= day_span+1 # picket fence
         except Exception as e:
             raise
 
@@ -293,19 +289,10 @@ class RewardManager():
         :return:
         """
         try:
-            dt_now = datetime.now()
-            early_date = dt_now - timedelta(hours=day_span*24 + 1)
-
-            # group by YYYY-MM-DD and check that there's a record for every day since the start of this period
-            q = session.query(func.year(photo.PhotoMeta.created_date), func.month(photo.PhotoMeta.created_date), func.day(photo.PhotoMeta.created_date)). \
-                join(photo.Photo, photo.Photo.id == photo.PhotoMeta.id). \
-                filter(photo.Photo.user_id == au.id). \
-                filter(photo.PhotoMeta.created_date >= early_date). \
-                distinct(func.year(photo.PhotoMeta.created_date), \
-                         func.month(photo.PhotoMeta.created_date), \
-                         func.day(photo.PhotoMeta.created_date) )
-            d = q.all()
-            return len(d) >= day_span+1 # picket fence
+            ua = engagement.UserActivity.read(session, au.id)
+            if ua is None:
+                return False
+            return ua.upload_streak_on(datetime.now().date()) >= day_span+1 # picket fence
         except Exception as e:
             raise
 
@@ -340,6 +327,67 @@ class RewardManager():
             raise
         return None
 
+    @staticmethod
+    def activity_days(q) -> dict:
+        """
+        :param q: query of (user_id, day) rows, distinct & ordered by user then day
+        :return: uid -> (last day, streak)
+        """
+        d_days = {}
+        for uid, day in q.all():
+            d_days.setdefault(uid, []).append(day)
+        return {uid: engagement.UserActivity.streak_from_days(days) for uid, days in d_days.items()}
+
+    @staticmethod
+    def backfill_user_activity(session, uids: list) -> int:
+        """
+        build the users' activity summaries (engagement.UserActivity) from their
+        ballots & photos, a few grouped queries for the whole list. Every
+        value is recomputed, so it's safe to run again to repair a summary.
+        :param session:
+        :param uids: the users to build, daemon/backfill_user_activity.py does all of them
+        :return: number of summaries written
+        """
+        if len(uids) == 0:
+            return 0
+        try:
+            q = session.query(voting.Ballot.user_id, func.count(voting.Ballot.id)). \
+                filter(voting.Ballot.user_id.in_(uids)). \
+                group_by(voting.Ballot.user_id)
+            num_votes = dict(q.all())
+
+            vote_day = func.date(voting.Ballot.created_date)
+            q = session.query(voting.Ballot.user_id, vote_day).distinct(). \
+                filter(voting.Ballot.user_id.in_(uids)). \
+                order_by(voting.Ballot.user_id, vote_day)
+            vote_days = RewardManager.activity_days(q)
+
+            upload_day = func.date(photo.Photo.created_date)
+            q = session.query(photo.Photo.user_id, upload_day).distinct(). \
+                filter(photo.Photo.user_id.in_(uids)). \
+                order_by(photo.Photo.user_id, upload_day)
+            upload_days = RewardManager.activity_days(q)
+
+            q = session.query(engagement.UserActivity).filter(engagement.UserActivity.user_id.in_(uids))
+            d_ua = {ua.user_id: ua for ua in q.all()}
+
+            num_written = 0
+            for uid in uids:
+                if uid not in num_votes and uid not in upload_days and uid not in d_ua:
+                    continue # never played
+                ua = d_ua.get(uid, None)
+                if ua is None:
+                    ua = engagement.UserActivity(user_id=uid)
+                    session.add(ua)
+                ua.num_votes = num_votes.get(uid, 0)
+                ua.last_vote_day, ua.vote_streak = vote_days.get(uid, (None, 0))
+                ua.last_upload_day, ua.upload_streak = upload_days.get(uid, (None, 0))
+                num_written += 1
+            return num_written
+        except Exception as e:
+            logger.exception(msg='[rewardmgr] error building user activity')
+            raise
+
 
 class FeedbackManager():
 
@@ -380,6 +428,104 @@ class FeedbackManager():
             raise
 
 
+# thumbnails for a leaderboard page are read from disk in parallel
+_thumbnail_pool = ThreadPoolExecutor(max_workers=4)
+
+
+class RedisServer():
+    """
+    Process wide access to the Redis server. The server address is read from
+    the ServerList table and cached for 'address_ttl' seconds (or until a
+    connection failure), all connections come from one pool and Leaderboard
+    handles are kept per leaderboard name, so a vote doesn't cost a MySQL read,
+    a new connection and a new Leaderboard object.
+    """
+    _ADDRESS_TTL = 5 * 60
+
+    def __init__(self, **kwargs):
+        self._address_ttl = kwargs.get('address_ttl', self._ADDRESS_TTL)
+        self._f_address = kwargs.get('f_address', None) # (session) -> {'ip':, 'port':}, for testing
+        self._lock = threading.Lock()
+        self._address = None
+        self._address_time = 0
+        self._refreshing = False
+        self._conn = None
+        self._leaderboards = {}
+
+    def _read_address(self, session) -> dict:
+        if self._f_address is not None:
+            return self._f_address(session)
+        if session is not None:
+            return voting.ServerList().get_redis_server(session)
+
+        session = dbsetup.Session()
+        try:
+            return voting.ServerList().get_redis_server(session)
+        finally:
+            session.close()
+
+    def address(self, session) -> dict:
+        """
+        ServerList is read outside the lock, while one thread refreshes a stale
+        address the others carry on with it. Only the swap is done under the lock.
+        """
+        with self._lock:
+            now = time.time()
+            if self._address is not None and (now - self._address_time <= self._address_ttl or self._refreshing):
+                return self._address
+            self._refreshing = True
+
+        try:
+            d = self._read_address(session)
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+        with self._lock:
+            if self._address is not None and d != self._address:
+                logger.info(msg='redis server moved from {0} to {1}'.format(self._address, d))
+                self._drop_connection()
+            self._address = d
+            self._address_time = time.time()
+            return self._address
+
+    def _drop_connection(self) -> None:
+        if self._conn is not None:
+            try:
+                self._conn.connection_pool.disconnect()
+            except Exception as e:
+                pass
+        self._conn = None
+        self._leaderboards = {}
+
+    def connection(self, session) -> redis.Redis:
+        d = self.address(session)
+        with self._lock:
+            if self._conn is None:
+                pool = redis.ConnectionPool(host=d['ip'], port=d['port'])
+                self._conn = redis.Redis(connection_pool=pool)
+            return self._conn
+
+    def leaderboard(self, session, lbname: str) -> Leaderboard:
+        conn = self.connection(session)
+        with self._lock:
+            lb = self._leaderboards.get(lbname)
+            if lb is None:
+                lb = Leaderboard(lbname, redis_connection=conn, page_size=10)
+                self._leaderboards[lbname] = lb
+            return lb
+
+    def connection_failed(self, e: Exception) -> None:
+        """forget the address & connections if redis went away, we'll re-read ServerList next time"""
+        if isinstance(e, (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)):
+            with self._lock:
+                self._address = None
+                self._drop_connection()
+
+
+_redis_server = RedisServer()
+
+
 # this is the class that will orchestrate our voting. So it's job is to:
 #
 #  - transition categories to appropriate states
@@ -391,22 +537,21 @@ class FeedbackManager():
 class TallyMan():
     _redis_host = None
     _redis_port = None
-    _redis_conn = None
+    _redis_conn = None  # set directly (e.g. the sync daemon) to bypass the shared _redis_server
 
     _orientation = None
 
+    def redis_connection(self, session):
+        if self._redis_conn is not None:
+            return self._redis_conn
+        return _redis_server.connection(session)
+
     def leaderboard_exists(self, session, c: category.Category) -> bool:
         try:
-            if self._redis_conn is None:
-                sl = voting.ServerList()
-                d = sl.get_redis_server(session)
-                self._redis_host = d['ip']
-                self._redis_port = d['port']
-                self._redis_conn = redis.Redis(host=self._redis_host, port=self._redis_port)
-
             lbname = self.leaderboard_name(c)
-            return self._redis_conn.exists(lbname)
+            return self.redis_connection(session).exists(lbname)
         except Exception as e:
+            _redis_server.connection_failed(e)
             logger.exception(msg='error checking if leaderboard exists')
             raise
 
@@ -419,7 +564,10 @@ class TallyMan():
         session.add(c)
 
         try:
-            category._expiry_cache.expire_key('ALL_CATEGORIES')
+            _shared_cache.expire_key('ALL_CATEGORIES')
+            # COUNTING/CLOSED leaderboards are pinned, make sure the pinned copy has the final votes
+            _shared_cache.expire_key('LEADERBOARD_THUMBNAILS{0}'.format(cid))
+            category.Category.invalidate_voteable()
         except KeyError as ke:
             pass # cache entry not created yet, ignore error
 
@@ -434,6 +582,32 @@ class TallyMan():
 
         return str_lb
 
+    def leaderboard_version_name(self, c: category.Category) -> str:
+        return "{0}:version".format(self.leaderboard_name(c))
+
+    def leaderboard_version(self, session, c: category.Category) -> int:
+        """
+        the leaderboard's version counter, bumped on every update. A missing
+        counter is seeded from the clock so a flushed/rebuilt Redis can't
+        hand back a version number we've already cached.
+        :return: current version (a single GET when the counter exists)
+        """
+        conn = self.redis_connection(session)
+        version_name = self.leaderboard_version_name(c)
+        version = conn.get(version_name)
+        if version is None:
+            conn.setnx(version_name, int(time.time() * 1000))
+            version = conn.get(version_name)
+        return int(version)
+
+    def bump_leaderboard_version(self, session, c: category.Category) -> None:
+        conn = self.redis_connection(session)
+        version_name = self.leaderboard_version_name(c)
+        pipe = conn.pipeline(transaction=False)
+        pipe.setnx(version_name, int(time.time() * 1000))
+        pipe.incr(version_name)
+        pipe.execute()
+
     def update_leaderboard(self, session, c: category.Category, p: photo.Photo, check_exist=True) -> None:
         """
         update_leaderboard():
@@ -454,7 +628,35 @@ class TallyMan():
         try:
             lb = self.get_leaderboard_by_category(session, c, check_exist=True)
             lb.rank_member(p.id, p.score, str(p.user_id))
+            self.bump_leaderboard_version(session, c) # cached copies of this leaderboard are now stale
+        except Exception as e:
+            _redis_server.connection_failed(e)
+            logger.exception(msg="error updating the leaderboard")
+            raise
+
+    def update_leaderboard_photos(self, session, c: category.Category, pl: list) -> None:
+        """
+        update_leaderboard() for several photos (a ballot's worth) with one
+        Leaderboard handle and one pipelined Redis round trip, including the version bump
+        :param pl: list of (pid, score, uid) tuples
+        """
+        try:
+            lb = self.get_leaderboard_by_category(session, c, check_exist=True)
+            lbname = self.leaderboard_name(c)
+            version_name = self.leaderboard_version_name(c)
+            conn = lb.redis_connection
+            pipe = conn.pipeline(transaction=False)
+            for pid, score, uid in pl:
+                if isinstance(conn, redis.Redis):
+                    pipe.zadd(lbname, pid, score) # legacy redis.Redis argument order, same as Leaderboard.rank_member()
+                else:
+                    pipe.zadd(lbname, score, pid)
+                pipe.hset(lb._member_data_key(lbname), pid, str(uid))
+            pipe.setnx(version_name, int(time.time() * 1000))
+            pipe.incr(version_name)
+            pipe.execute()
         except Exception as e:
+            _redis_server.connection_failed(e)
             logger.exception(msg="error updating the leaderboard")
             raise
 
@@ -467,16 +669,16 @@ class TallyMan():
         via Redis directly.
         :param session:
         :param c: category we are checking for
-        :param check_exist - check if the leaderboard exists
+        :param check_exist - no longer checked, the result was never used & it cost a round trip
         :return: leaderboard object, empty if leaderboard hasn't been created
         """
         try:
-            if check_exist and not self.leaderboard_exists(session, c):
-                None
-
-            lb = Leaderboard(self.leaderboard_name(c), host=self._redis_host, port=self._redis_port, page_size=10)
-            return lb
+            lbname = self.leaderboard_name(c)
+            if self._redis_conn is not None:
+                return Leaderboard(lbname, redis_connection=self._redis_conn, page_size=10)
+            return _redis_server.leaderboard(session, lbname)
         except Exception as e:
+            _redis_server.connection_failed(e)
             logger.exception(msg="error getting leader board by category")
             return None
 
@@ -505,25 +707,134 @@ class TallyMan():
             logger.exception(msg='error reading thumbnail!')
             return None, None
 
-    def fetch_leaderboard(self, session, au: usermgr.AnonUser, c: category.Category) -> list:
+    def create_displaynames(self, session, uids: list) -> dict:
+        """
+        bulk version of create_displayname(), one query for all the users
+        :return: dictionary of uid -> display name
+        """
+        names = {uid: "anonymous{}".format(uid) for uid in uids}
+        if len(names) == 0:
+            return names
+
+        ul = session.query(usermgr.User).filter(usermgr.User.id.in_(list(names.keys()))).all()
+        for u in ul:
+            if u.screenname is not None:
+                names[u.id] = u.screenname
+            else:
+                names[u.id] = u.emailaddress.split('@')[0] # don't return the domain
+        return names
+
+    def read_photos(self, session, pids: list) -> dict:
+        """
+        one query for all the leaderboard photos
+        :return: dictionary of pid -> Photo
+        """
+        if len(pids) == 0:
+            return {}
+        pl = session.query(photo.Photo).filter(photo.Photo.id.in_(pids)).all()
+        return {p.id: p for p in pl}
+
+    def read_thumbnails(self, pl: list) -> list:
+        """
+        read the thumbnails for the photos concurrently
+        :return: list of utf-8 base64 thumbnails (None if unreadable) in the same order
+        """
+        def read_one(p: photo.Photo) -> str:
+            try:
+                return p.read_thumbnail_b64_utf8()
+            except Exception as e:
+                return None # already logged
+
+        self._orientation = 1 # all thumbnails normalized to '1' orientation
+        return list(_thumbnail_pool.map(read_one, pl))
+
+    def friend_set(self, session, uid: int, uids: list) -> set:
+        """
+        which of 'uids' are friends of 'uid', one query
+        """
+        if len(uids) == 0:
+            return set()
+        q = session.query(usermgr.Friend.myfriend_id). \
+            filter(usermgr.Friend.user_id == uid). \
+            filter(usermgr.Friend.myfriend_id.in_(uids)). \
+            filter(usermgr.Friend.active == 1)
+        return {row[0] for row in q.all()}
+
+    def build_leaderboard_core(self, session, dl: list) -> list:
+        """
+        turn the redis leaders into the viewer independent leaderboard,
+        every entry carries the 'uid' of the photo owner so the viewer's
+        relationships can be layered on by overlay_leaderboard()
+        """
+        entries = []
+        for d in dl:
+            try:
+                lb_pid = int(str(d['member'], 'utf-8'))     # photo.id
+                lb_uid = int(str(d['member_data'], 'utf-8')) # anonuser.id / userlogin.id
+            except Exception as e:
+                continue
+            if lb_uid == 0 or lb_pid == 0:  # we use a dummy value to persist leaderboard existance in daemon, filter it out
+                continue
+            entries.append((lb_pid, lb_uid, d['score'], d['rank']))
+
+        photos = self.read_photos(session, [e[0] for e in entries])
+        entries = [e for e in entries if e[0] in photos and photos[e[0]].active != 0] # de-activated photos might be offensive
+        names = self.create_displaynames(session, {e[1] for e in entries})
+        thumbnails = self.read_thumbnails([photos[e[0]] for e in entries])
+        hashes = photo.Photo.read_thumb_hashes(session, [e[0] for e in entries])
+
+        lb_core = []
+        for (lb_pid, lb_uid, lb_score, lb_rank), b64_utf8 in zip(entries, thumbnails):
+            if b64_utf8 is None:
+                continue
+            p = photos[lb_pid]
+            lb_core.append({'username': names[lb_uid], 'score': lb_score, 'rank': lb_rank, 'pid': lb_pid,
+                            'orientation': self._orientation, 'votes': p.times_voted, 'likes': p.likes,
+                            'image': b64_utf8, 'thumb': photo.Photo.thumb_url(hashes.get(lb_pid, None)), 'uid': lb_uid})
+        return lb_core
+
+    def overlay_leaderboard(self, session, au: usermgr.AnonUser, lb_core: list, thumb_urls: bool=False) -> list:
+        """
+        copy the shared leaderboard entries and add the 'you' / 'isfriend'
+        flags for this viewer (one friend query), the cached core is never modified
+        thumb_urls=True swaps the base64 'image' for the 'thumb' URL
+        """
+        friends = self.friend_set(session, au.id, list({d['uid'] for d in lb_core if d['uid'] != au.id}))
+        lb_list = []
+        for d in lb_core:
+            lb_dict = dict(d)
+            lb_uid = lb_dict.pop('uid')
+            if thumb_urls and lb_dict.get('thumb', None) is not None:
+                lb_dict.pop('image', None)
+            else:
+                lb_dict.pop('thumb', None)
+            if lb_uid == au.id:
+                lb_dict['you'] = True
+            else:
+                lb_dict['isfriend'] = lb_uid in friends
+            lb_list.append(lb_dict)
+        return lb_list
+
+    def fetch_leaderboard(self, session, au: usermgr.AnonUser, c: category.Category, thumb_urls: bool=False) -> list:
         """
         read the leaderboard object and construct a list of
         leaderboard dictionary elements for later jsonification
 
         Make note of the caching strategy:
 
-            1) Cache the raw leaderboard list from the redis server for 'ttl_leaderboard' (~24 hours)
-            2) cache hits on this compare with the current redis server leaderboard, if same
-               then use the cached leaderboard with photos and return
-            3) If NOT same, invalidate the caches (list and list w/thumbnails) and reconstruct
-            4) cache all this stuff on exit
-
-        NOTE: Could this be further optimized by realizing that leaderboards for categories that are no
-              longer "voting" can be cached without all these checks as they won't change?
+            1) The cached leaderboard is stored with the Redis version counter it was
+               built from. update_leaderboard() bumps the counter, so a cache hit costs
+               a single GET of the counter instead of fetching & comparing the leaders.
+            2) COUNTING & CLOSED leaderboards don't change, any cached copy is used
+               without checking Redis (change_category_state() drops it on the transition)
+            3) The cached leaderboard is viewer independent (built with one photo, one user
+               query & concurrent thumbnail reads), the viewer's 'you'/'isfriend' flags are
+               layered on per request with a single friend query.
 
         :param session: database
         :param au: user requesting leaderboard
         :param c: category for which leaderboard is request
+        :param thumb_urls: True -> entries have a 'thumb' URL instead of the base64 'image'
         :return: list of of leaderboard dictionary elements or None if leaderboard doesn't exist
         """
 
@@ -533,58 +844,30 @@ class TallyMan():
             logger.info(msg="retrieving leader board for category")
 
         try:
-            list_key = 'LEADERBOARD{0}'.format(c.id)
-            thumbnail_key = 'LEADERBOARD_THUMBNAILS{0}'.format(c.id)
+            core_key = 'LEADERBOARD_THUMBNAILS{0}'.format(c.id)
             ttl_leaderboard = 60 * 60 * 24 # 24 hours
-            cached_dl, cached_time = _expiry_cache.get_with_time(list_key)
-            lb = self.get_leaderboard_by_category(session, c, check_exist=True)
-            dl = lb.leaders(1, page_size=10, with_member_data=True)   # 1st page is top 25
+            cached = _shared_cache.get(core_key) # (version, viewer independent leaderboard)
 
-            # see if the current leaderboard matches the cached leaderboard
-            if cached_dl == dl and dl is not None:
-                lb_list = _expiry_cache.get(thumbnail_key)
-                if lb_list is not None:
-                    logger.info(msg="cache hit for leaderboard, category_id ={0}".format(c.id))
-                    return lb_list
+            if cached is not None and c.state in (category.CategoryState.COUNTING.value, category.CategoryState.CLOSED.value):
+                logger.info(msg="cache hit for pinned leaderboard, category_id ={0}".format(c.id))
+                return self.overlay_leaderboard(session, au, cached[1], thumb_urls)
 
-            _expiry_cache.put(list_key, dl, ttl=ttl_leaderboard) # 1 hour expiration of the non-photo list
-            if cached_dl is not None:
-                _expiry_cache.expire_key(thumbnail_key)
+            version = self.leaderboard_version(session, c)
+            if cached is not None and cached[0] == version:
+                logger.info(msg="cache hit for leaderboard, category_id ={0}".format(c.id))
+                return self.overlay_leaderboard(session, au, cached[1], thumb_urls)
 
-            lb_list = []
-            for d in dl:
-                lb_pid = int(str(d['member'], 'utf-8'))     # photo.id
-                try:
-                    lb_uid = int(str(d['member_data'], 'utf-8')) # anonuser.id / userlogin.id
-                except Exception as e:
-                    continue
-
-                lb_score = d['score']
-                lb_rank = d['rank']
-                if lb_uid == 0 or lb_pid == 0:  # we use a dummy value to persist leaderboard existance in daemon, filter it out
-                    continue
-
-                lb_name = self.create_displayname(session, lb_uid)
-                b64_utf8, p = self.read_thumbnail(session, lb_pid) # thumbnail image as utf-8 base64
-                if b64_utf8 is None:
-                    continue
-
-                lb_dict = {'username': lb_name, 'score': lb_score, 'rank': lb_rank, 'pid': lb_pid, 'orientation': self._orientation, 'pid': lb_pid}
-                lb_dict['votes'] = p.times_voted
-                lb_dict['likes'] = p.likes
-                if lb_uid == au.id:
-                    lb_dict['you'] = True
-                else:
-                    lb_dict['isfriend'] = usermgr.Friend.is_friend(session, au.id, lb_uid)
-
-                lb_dict['image'] = b64_utf8
-                lb_list.append(lb_dict)
+            # read the version before the leaders, if a vote lands in between we'll just rebuild next time
+            lb = self.get_leaderboard_by_category(session, c, check_exist=True)
+            dl = lb.leaders(1, page_size=10, with_member_data=True)   # 1st page is top 25
+            lb_core = self.build_leaderboard_core(session, dl)
 
-            # Wow! That was a lot of work, so let's stuff it in the cache and use it for 5 minutes
-            _expiry_cache.put(thumbnail_key, lb_list, ttl=ttl_leaderboard)
-            logger.info(msg="[fetch_leaderboard]caching leaderboard for category #{0}".format(c.id))
-            return lb_list
+            # Wow! That was a lot of work, so let's stuff it in the cache, the viewer's flags aren't in it
+            _shared_cache.put(core_key, (version, lb_core), ttl=ttl_leaderboard)
+            logger.info(msg="[fetch_leaderboard]caching leaderboard for category #{0}, version {1}".format(c.id, version))
+            return self.overlay_leaderboard(session, au, lb_core, thumb_urls)
         except Exception as e:
+            _redis_server.connection_failed(e)
             logger.exception(msg="error fetching leaderboard")
             if c is not None:
                 logger.info(msg="leaderboard error for category id ={}".format(c.id))
@@ -0,0 +1,310 @@
+"""the controller for making thumbnails off the request thread. """
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import dbsetup
+import logsetup
+from logsetup import logger
+from models import category, photo
+from controllers import BallotMgr, RewardMgr
+
+
+def make_thumbnail(binary_image: bytes, filepath: str, filename: str, stored_file: str=None, digest: str=None) -> dict:
+    """
+    runs in the process pool, so it only gets plain values & never touches the
+    database. Decodes the original, writes the thumbnail next to it and returns
+    the PhotoMeta column values for the parent to store. Streamed uploads are
+    read back from stored_file rather than sending the image to the process.
+    """
+    p = photo.Photo()
+    p.filepath = filepath
+    p.filename = filename
+    p._photoimage = photo.PhotoImage()
+    p._photoimage._binary_image = binary_image
+    if stored_file is not None:
+        p._photoimage._stored_file = stored_file
+        p._photoimage._size = os.path.getsize(stored_file)
+        p._photoimage._digest = digest
+    p.create_thumb_PIL(fn=None)
+
+    pm = p._photometa
+    return {'height': pm.height, 'width': pm.width, 'orientation': pm.orientation,
+            'gps': pm.gps, 'j_exif': pm.j_exif, 'thumb_hash': pm.thumb_hash}
+
+
+def init_pool_process() -> None:
+    """
+    the pool's initializer, runs first in each child. The async database log
+    handler's writer thread belongs to the parent, log to stderr here so the
+    child's errors aren't lost.
+    """
+    for lg in (logsetup.logger, logsetup.client_logger):
+        for h in list(lg.handlers):
+            lg.removeHandler(h)
+            if h is not logsetup.hndlr:
+                h.close()
+        h = logging.StreamHandler()
+        h.setFormatter(logsetup.formatter)
+        lg.addHandler(h)
+    logsetup.hndlr.close()
+
+
+class ThumbnailPipeline():
+    """
+    Uploads store the original and a Photo row that is 'pending'
+    (Photo.ACTIVE_PENDING, so it isn't picked for ballots), then hand the
+    photo to us. A job thread sends the decode/EXIF/resize/encode work to a
+    process pool (so it doesn't hold the GIL in the gunicorn worker), then
+    writes the PhotoMeta row and activates the photo. If the thumbnail can't
+    be made the photo is de-activated.
+
+    The process pool is created on the first submit(), its children come
+    from a forkserver rather than a fork of this worker, whose threads (log
+    writer, cache listener) may be holding locks. processes=False does the
+    work on the job thread. A broken pool (a child died) is replaced and the
+    photo retried, if it still can't be done the photo stays pending.
+
+    The pipeline holding a pending photo keeps its Photo.last_updated fresh
+    (a lease, renewed every _LEASE_SECONDS while we work through the queue),
+    requeue_stale() (run by the sync daemon) claims the photos whose lease
+    ran out, left behind by a restart or crash.
+    """
+    _MAX_WORKERS = 2
+    _POOL_RETRIES = 2
+    _STALE_MINUTES = 10
+    _LEASE_SECONDS = 60
+    _START_METHOD = 'forkserver'
+
+    def __init__(self, **kwargs):
+        self._max_workers = kwargs.get('max_workers', self._MAX_WORKERS)
+        self._use_processes = kwargs.get('processes', True)
+        self._f_session = kwargs.get('f_session', None)
+
+        self._lock = threading.Lock()
+        self._jobs = ThreadPoolExecutor(max_workers=self._max_workers)
+        self._processes = None
+        self._pending = {}  # pid -> Future
+        self._completed = 0
+        self._failed = 0
+        self._lease_time = time.time()
+
+    def _new_session(self):
+        if self._f_session is not None:
+            return self._f_session()
+        return dbsetup.Session()
+
+    def _process_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._processes is None:
+                self._processes = ProcessPoolExecutor(max_workers=self._max_workers,
+                                                      mp_context=multiprocessing.get_context(self._START_METHOD),
+                                                      initializer=init_pool_process)
+            return self._processes
+
+    def submit(self, p: photo.Photo):
+        """
+        queue the thumbnail for a photo that has been committed as pending
+        :param p: the photo, with its PhotoImage still attached
+        :return: Future, the result is True if the photo was activated
+        """
+        pi = p._photoimage
+        if pi._stored_file is not None:
+            args = (None, p.filepath, p.filename, pi._stored_file, pi._digest)
+        else:
+            args = (pi._binary_image, p.filepath, p.filename)
+        with self._lock:
+            f = self._jobs.submit(self._run, p.id, p.user_id, args)
+            self._pending[p.id] = f
+        return f
+
+    def _make_in_process(self, args: tuple) -> dict:
+        for attempt in range(self._POOL_RETRIES + 1):
+            pool = self._process_pool()
+            try:
+                return pool.submit(make_thumbnail, *args).result()
+            except BrokenProcessPool:
+                # a child died, start a new pool & try again
+                with self._lock:
+                    if self._processes is pool:
+                        self._processes = None
+                pool.shutdown(wait=False)
+                if attempt == self._POOL_RETRIES:
+                    raise
+
+    def _renew_leases(self) -> None:
+        """touch the rows of our pending photos, at most every _LEASE_SECONDS, so requeue_stale() leaves them to us"""
+        with self._lock:
+            if len(self._pending) == 0 or time.time() - self._lease_time < self._LEASE_SECONDS:
+                return
+            self._lease_time = time.time()
+            pids = list(self._pending.keys())
+
+        session = self._new_session()
+        try:
+            photo.Photo.touch_pending(session, pids)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.exception(msg='error renewing the lease on {0} pending photos'.format(len(pids)))
+        finally:
+            session.close()
+
+    def _run(self, pid: int, uid: int, args: tuple) -> bool:
+        ts = time.time()
+        self._renew_leases()
+        try:
+            if self._use_processes:
+                d_meta = self._make_in_process(args)
+            else:
+                d_meta = make_thumbnail(*args)
+            ok = self.finish(pid, d_meta)
+            logger.info(msg='TIMER:thumbnail:{0}:{1}'.format(pid, time.time() - ts))
+        except BrokenProcessPool as e:
+            # not the photo's fault, leave it pending for requeue_stale()
+            logger.exception(msg='process pool unavailable, photo #{0} left pending'.format(pid))
+            ok = False
+        except Exception as e:
+            logger.exception(msg='error making thumbnail for photo #{0}'.format(pid))
+            ok = self.finish(pid, None)
+        finally:
+            with self._lock:
+                self._pending.pop(pid, None)
+
+        if ok:
+            category.Category.invalidate_voteable_user(uid) # the photo can be voted on now
+        return ok
+
+    def finish(self, pid: int, d_meta: dict) -> bool:
+        """
+        store the thumbnail's metadata & activate the photo, or
+        de-activate it if we couldn't make a thumbnail (d_meta is None)
+        :return: True if the photo is now active
+        """
+        session = self._new_session()
+        try:
+            p = session.query(photo.Photo).get(pid)
+            if p is None or p.active != photo.Photo.ACTIVE_PENDING:
+                session.rollback()
+                return False # deleted or de-activated while we worked
+
+            if d_meta is None:
+                p.active = 0
+                last_photo = not photo.Photo.has_photos_in_category(session, p.category_id, p.user_id, exclude_pid=p.id)
+                category.CategoryStats.add(session, p.category_id, photos=-1, uploaders=-1 if last_photo else 0)
+                photo.Photo.invalidate_thumbnail_info(p.id)
+                with self._lock:
+                    self._failed += 1
+            else:
+                pm = photo.PhotoMeta(d_meta['height'], d_meta['width'], d_meta['thumb_hash'])
+                pm.orientation = d_meta['orientation']
+                pm.gps = d_meta['gps']
+                pm.j_exif = d_meta['j_exif']
+                p._photometa = pm
+                p.active = 1
+                with self._lock:
+                    self._completed += 1
+            cid, uid = p.category_id, p.user_id
+            session.commit()
+            self._photo_changed(session, pid, cid, uid, d_meta is not None)
+            return d_meta is not None
+        except Exception as e:
+            session.rollback()
+            logger.exception(msg='error updating photo #{0} after thumbnail'.format(pid))
+            return False
+        finally:
+            session.close()
+
+    def _photo_changed(self, session, pid: int, cid: int, uid: int, activated: bool) -> None:
+        """
+        the photo was activated (or de-activated), move it in the category's Redis
+        structures rather than have them rebuilt: the voteable category counts and
+        the round #1 ballot queue. A pending photo was never counted or queued.
+        """
+        try:
+            conn = RewardMgr._redis_server.connection(session)
+            bq = BallotMgr.BallotQueue(cid, conn)
+            if activated:
+                BallotMgr.VoteableCategoryIndex.count_photo(conn, cid, uid, 1)
+                bq.add_photo(pid, uid)
+            else:
+                bq.remove_photo(pid, uid)
+        except Exception as e:
+            RewardMgr._redis_server.connection_failed(e)
+            logger.exception(msg='error updating redis for photo #{0}, left for the rebuild'.format(pid))
+
+    def requeue_stale(self, session, minutes: int=None) -> int:
+        """
+        queue the photos whose lease hasn't been renewed for 'minutes', their
+        worker went away (restart, crash) before their thumbnail was made. Each
+        one is claimed by renewing its lease only if it's still stale (committed,
+        so one process wins), then the original is read back from the image
+        store, a photo without one is de-activated. Work done twice is
+        harmless, finish() only takes a photo that is still pending.
+        :return: number of photos queued
+        """
+        if minutes is None:
+            minutes = self._STALE_MINUTES
+        cutoff = datetime.now() - timedelta(minutes=minutes)
+        q = session.query(photo.Photo). \
+            filter(photo.Photo.active == photo.Photo.ACTIVE_PENDING). \
+            filter(photo.Photo.lease_time() < cutoff)
+
+        num_queued = 0
+        for p in q.all():
+            if self.is_pending(p.id):
+                continue
+            claimed = photo.Photo.touch_pending(session, [p.id], older_than=cutoff) == 1
+            session.commit()
+            if not claimed:
+                continue # its worker renewed the lease, or someone else claimed it
+            fn = p.create_full_filename('JPEG')
+            if not os.path.isfile(fn):
+                logger.warning(msg='original missing for pending photo #{0}'.format(p.id))
+                self.finish(p.id, None)
+                continue
+            pi = photo.PhotoImage()
+            pi._extension = 'JPEG'
+            pi._stored_file = fn
+            pi._size = os.path.getsize(fn)
+            p._photoimage = pi
+            self.submit(p)
+            num_queued += 1
+        return num_queued
+
+    def is_pending(self, pid: int) -> bool:
+        with self._lock:
+            return pid in self._pending
+
+    def wait(self, pid: int=None, timeout: float=None) -> bool:
+        """
+        wait for a photo's thumbnail (or everything queued if pid is None)
+        :return: True if the work finished within the timeout
+        """
+        with self._lock:
+            if pid is None:
+                futures = list(self._pending.values())
+            else:
+                futures = [self._pending[pid]] if pid in self._pending else []
+
+        end = None if timeout is None else time.time() + timeout
+        for f in futures:
+            remaining = None if end is None else max(0, end - time.time())
+            try:
+                f.result(timeout=remaining)
+            except Exception as e:
+                if not f.done():
+                    return False
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'pending': len(self._pending), 'completed': self._completed, 'failed': self._failed}
+
+
+# one pipeline per worker process
+_thumbnail_pipeline = ThumbnailPipeline()
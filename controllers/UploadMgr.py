@@ -0,0 +1,165 @@
+"""reading photo uploads from the request stream, without holding the whole body in memory. """
+import json
+import base64
+
+_CHUNK_SIZE = 64 * 1024
+
+
+def request_chunks(stream, chunk_size: int=_CHUNK_SIZE):
+    """the request body, chunk_size bytes at a time"""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+class Base64Decoder():
+    """
+    decodes base64 a piece at a time, carrying any partial quantum over to
+    the next piece. Line breaks (and the JSON escapes for them & '/') are
+    dropped, like base64.b64decode() does with its non-alphabet characters.
+    """
+
+    def __init__(self):
+        self._buf = b''
+
+    def decode(self, data: bytes) -> bytes:
+        data = self._buf + data
+        keep = b''
+        if data.endswith(b'\\'):
+            data, keep = data[:-1], b'\\' # escape split across pieces
+        data = data.replace(b'\\/', b'/').replace(b'\\n', b'').replace(b'\\r', b'')
+        data = b''.join(data.split())
+
+        n = len(data) // 4 * 4
+        self._buf = data[n:] + keep
+        if n == 0:
+            return b''
+        return base64.b64decode(data[:n])
+
+    def finish(self) -> bytes:
+        """whatever is left, raises binascii.Error if it isn't valid base64"""
+        data, self._buf = self._buf, b''
+        if len(data) == 0:
+            return b''
+        return base64.b64decode(data)
+
+
+class JsonImageStream():
+    """
+    A JSON upload ({"category_id": .., "extension": .., "image": "<base64>"})
+    read from a stream of chunks. image_chunks() skips ahead to the top level
+    'image' value and yields it decoded, a chunk at a time. fields() then
+    returns the rest of the object with 'image' as an empty string. Only the
+    small fields are kept in memory.
+    """
+    _MAX_FIELDS_BYTES = 64 * 1024
+
+    def __init__(self, chunks, key: str='image'):
+        self._chunks = iter(chunks)
+        self._key = key.encode('utf-8')
+        self._fields = bytearray() # the JSON, without the image
+        self._pending = b''        # unread part of the current chunk
+
+        # scanner state, we only need to find a top level key
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string = bytearray()
+        self._last_string = None
+        self._at_value = False
+
+    def _next_chunk(self) -> bool:
+        try:
+            self._pending = next(self._chunks)
+            return True
+        except StopIteration:
+            return False
+
+    def _keep(self, data: bytes) -> None:
+        self._fields += data
+        if len(self._fields) > self._MAX_FIELDS_BYTES:
+            raise ValueError('upload fields too large')
+
+    def _scan(self, c: int) -> bool:
+        """
+        :param c: the next byte of the JSON
+        :return: True if c opens the string value of our key
+        """
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+                self._string.append(c)
+            elif c == 0x5C: # \
+                self._escape = True
+            elif c == 0x22: # "
+                self._in_string = False
+                self._last_string = bytes(self._string)
+            else:
+                self._string.append(c)
+            return False
+
+        if c == 0x22:
+            if self._at_value:
+                return True
+            self._in_string = True
+            self._string = bytearray()
+            return False
+        if c in b' \t\r\n':
+            return False
+
+        key_done = c == 0x3A and self._depth == 1 and self._last_string == self._key # :
+        if c in b'{[':
+            self._depth += 1
+        elif c in b'}]':
+            self._depth -= 1
+        self._at_value = key_done
+        self._last_string = None
+        return False
+
+    def _seek_image(self) -> bool:
+        while True:
+            if len(self._pending) == 0 and not self._next_chunk():
+                return False
+            data = self._pending
+            for i in range(len(data)):
+                if self._scan(data[i]):
+                    self._keep(data[:i + 1])
+                    self._pending = data[i + 1:]
+                    return True
+            self._keep(data)
+            self._pending = b''
+
+    def image_chunks(self):
+        """generator of the decoded image, raises KeyError if there isn't one"""
+        if not self._seek_image():
+            raise KeyError(self._key.decode('utf-8'))
+
+        decoder = Base64Decoder()
+        while True:
+            if len(self._pending) == 0 and not self._next_chunk():
+                raise ValueError('unterminated image string')
+            data = self._pending
+            end = data.find(b'"')
+            if end < 0:
+                piece, self._pending = data, b''
+            else:
+                piece, self._pending = data[:end], data[end:] # closing quote goes to the fields
+            decoded = decoder.decode(piece)
+            if len(decoded) > 0:
+                yield decoded
+            if end >= 0:
+                break
+
+        decoded = decoder.finish()
+        if len(decoded) > 0:
+            yield decoded
+
+    def fields(self) -> dict:
+        """everything but the image, call once image_chunks() is done"""
+        self._keep(self._pending)
+        self._pending = b''
+        for chunk in self._chunks:
+            self._keep(chunk)
+        return json.loads(bytes(self._fields).decode('utf-8'))
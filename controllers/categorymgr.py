@@ -1,10 +1,11 @@
 """the controller for the category model. """
 from datetime import datetime
 from sqlalchemy import text
-from sqlalchemy import func
+from sqlalchemy import func, distinct
+from sqlalchemy import select, union_all
 from logsetup import logger
 from models import resources
-from models import usermgr, category, event, photo
+from models import usermgr, category, event, photo, voting
 
 # define some constants
 _CATEGORYLIST_MAXSIZE = 100
@@ -118,16 +119,50 @@ class CategoryManager():
                     filter(photo.Photo.id < pid). \
                     order_by(photo.Photo.id.desc())
 
-            photo_list = query.all()
+            photo_list = query.limit(self._PHOTOLIST_MAXSIZE).all()
         except Exception as e:
             raise
 
-        return photo_list[:self._PHOTOLIST_MAXSIZE]
+        return photo_list
+
+    def _photo_page(self, dir: str, pid: int, cid: int, limit: int):
+        """select for a page of a category's photos, just the columns we return"""
+        q = select(photo.Photo.row_columns()).where(photo.Photo.category_id == cid)
+        if dir == 'next':
+            q = q.where(photo.Photo.id > pid).order_by(photo.Photo.id.asc())
+        else:
+            q = q.where(photo.Photo.id < pid).order_by(photo.Photo.id.desc())
+        return q.limit(limit)
+
+    def category_photo_rows(self, session, dir: str, pid: int, cid: int) -> list:
+        """
+        category_photo_list() as rows of Photo.row_columns() rather than Photo
+        objects, for listings that only return them (see Photo.photo_dict())
+        """
+        return session.execute(self._photo_page(dir, pid, cid, self._PHOTOLIST_MAXSIZE)).fetchall()
+
+    def first_photo_pages(self, session, cids: list) -> dict:
+        """
+        the first page of photos for each of the categories in one query, a
+        UNION ALL of each category's page (each uses the category_id index)
+        :return: dictionary of category id -> list of rows, in photo id order
+        """
+        pages = {cid: [] for cid in cids}
+        if len(cids) == 0:
+            return pages
+
+        selects = [self._photo_page('next', 0, cid, self._PHOTOLIST_MAXSIZE) for cid in cids]
+        q = selects[0] if len(selects) == 1 else union_all(*selects)
+        for row in session.execute(q).fetchall():
+            pages[row.category_id].append(row)
+        for cid in cids:
+            pages[cid].sort(key=lambda row: row.id)
+        return pages
 
     def photo_dict(self, photo_list: list) -> list:
         d_photos = []
-        for photo in photo_list:
-            d_photos.append(photo.to_dict())
+        for p in photo_list:
+            d_photos.append(photo.Photo.photo_dict(p))
 
         return d_photos
 
@@ -154,7 +189,59 @@ class CategoryManager():
         stored_proc = 'CALL sp_CopyCategories(:cid)'
         results = session.execute(stored_proc, {'cid': cid})
 
-        num_photos = photo.Photo.count_by_category(session, cid)
-        return num_photos
+        # the stored procedure doesn't know about the counters
+        CategoryManager.reconcile_category_stats(session, [cid])
+        return category.CategoryStats.read_for_categories(session, [cid])[cid]['num_photos']
+
+    @staticmethod
+    def reconcile_category_stats(session, cids: list=None) -> int:
+        """
+        recompute the CategoryStats counters from the photo and ballot tables,
+        one grouped query each, and fix the ones that have drifted. An upload
+        that lands while we work can be overwritten, the next pass fixes that.
+        :param cids: categories to check, None for all of them
+        :return: number of categories repaired
+        """
+        q_photos = session.query(photo.Photo.category_id, func.count(photo.Photo.id), func.count(distinct(photo.Photo.user_id))). \
+            filter(photo.Photo.active != 0)
+        q_voters = session.query(voting.Ballot.category_id, func.count(distinct(voting.Ballot.user_id)))
+        q_ballot_users = session.query(voting.Ballot.category_id, voting.Ballot.user_id).distinct()
+        q_stats = session.query(category.CategoryStats)
+        if cids is not None:
+            if len(cids) == 0:
+                return 0
+            q_photos = q_photos.filter(photo.Photo.category_id.in_(cids))
+            q_voters = q_voters.filter(voting.Ballot.category_id.in_(cids))
+            q_ballot_users = q_ballot_users.filter(voting.Ballot.category_id.in_(cids))
+            q_stats = q_stats.filter(category.CategoryStats.category_id.in_(cids))
+
+        # voters that are missing their CategoryVoter row would be counted again on their next ballot
+        session.execute(category.CategoryVoter.__table__.insert().prefix_with('IGNORE').
+                        from_select(['category_id', 'user_id'], q_ballot_users.statement))
+
+        counts = {}
+        for cid, num_photos, num_uploaders in q_photos.group_by(photo.Photo.category_id).all():
+            counts[cid] = [num_photos, num_uploaders, 0]
+        for cid, num_voters in q_voters.group_by(voting.Ballot.category_id).all():
+            counts.setdefault(cid, [0, 0, 0])[2] = num_voters
+
+        stats = {cs.category_id: cs for cs in q_stats.all()}
+        for cid in stats.keys():
+            counts.setdefault(cid, [0, 0, 0]) # nothing left to count
+
+        repaired = 0
+        for cid, (num_photos, num_uploaders, num_voters) in counts.items():
+            cs = stats.get(cid, None)
+            if cs is None:
+                cs = category.CategoryStats(category_id=cid)
+                session.add(cs)
+            elif (cs.num_photos, cs.num_uploaders, cs.num_voters) == (num_photos, num_uploaders, num_voters):
+                continue
+            cs.num_photos = num_photos
+            cs.num_uploaders = num_uploaders
+            cs.num_voters = num_voters
+            repaired += 1
+
+        return repaired
 
 
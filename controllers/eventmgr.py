@@ -51,18 +51,18 @@ class EventManager():
         if list_of_events is None or len(list_of_events) == 0:
             return None
 
-        # now get the categories for the event list
+        # now get the categories for the event list, then the first
+        # page of photos for all of them, a query for each
+        event.Event.read_categories_for_events(session, list_of_events)
+        cm = categorymgr.CategoryManager()
+        pages = cm.first_photo_pages(session, list({c.id for e in list_of_events for c in e._cl}))
+
         d_events = []
         for event_obj in list_of_events:
-            event_obj.read_categories(session)
             d = event_obj.to_dict(uid=anonymous_user.id)
             d_events.append(d)
             for c in d['categories']:
-                cpl = categorymgr.CategoryManager().category_photo_list(session, dir='next', pid=0, cid=c['id'])
-                pl = []
-                for p in cpl:
-                    pl.append(p.to_dict())
-                c['photos'] = pl
+                c['photos'] = cm.photo_dict(pages[c['id']])
 
         return {'events': d_events}
 
@@ -135,12 +135,12 @@ class EventManager():
         try:
             e = session.query(event.Event).get(event_id)
             cl = e.read_categories(session)
+            stats = category.CategoryStats.read_for_categories(session, [c.id for c in cl])
             cl_dict = []
             for c in cl:
-                (num_photos, num_users) = EventManager.category_details(session, c)
                 c_dict = c.to_json()
-                c_dict['num_players'] = num_users
-                c_dict['num_photos'] = num_photos
+                c_dict['num_players'] = stats[c.id]['num_uploaders']
+                c_dict['num_photos'] = stats[c.id]['num_photos']
                 cl_dict.append(c_dict)
 
             e_dict = e.to_dict(anonymous_user.id)
@@ -153,9 +153,8 @@ class EventManager():
     @staticmethod
     def category_details(session, c: category.Category):
         try:
-            num_photos = photo.Photo.count_by_category(session, c.id)
-            num_users = photo.Photo.count_by_users(session, c.id)
-            return num_photos, num_users
+            stats = category.CategoryStats.read_for_categories(session, [c.id])[c.id]
+            return stats['num_photos'], stats['num_uploaders']
         except Exception as e:
             raise
 
@@ -171,11 +170,11 @@ class EventManager():
                 filter(category.Category.state.in_([category.CategoryState.UPLOAD.value, category.CategoryState.VOTING.value, category.CategoryState.COUNTING.value, category.CategoryState.UNKNOWN.value]))
             event_list = query.all()
 
-            # for each event, read in the categories
+            # the categories and creators for all the events, a query each
+            event.Event.read_categories_for_events(session, event_list)
+            event.Event.read_userinfo_for_events(session, event_list)
             eventlist_dict = []
             for event_instance in event_list:
-                event_instance.read_categories(session)
-                event_instance.read_userinfo(session)
                 eventlist_dict.append(event_instance.to_dict(anonymous_user.id))
 
             return eventlist_dict # a dictionary suitable for jsonification
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+build the user activity summaries (engagement.UserActivity) from the existing
+ballots & photos, a page of users at a time. Run it once after creating the
+useractivity table, the server keeps the summaries current from then on. It
+recomputes every summary, so it can be run again to repair them.
+
+usage: backfill_user_activity.py [start=<user id>]
+"""
+import sys
+import time
+import os
+
+lib_path = os.path.abspath(os.path.join('..'))
+sys.path.append(lib_path)
+
+from controllers import RewardMgr
+from models import usermgr
+import dbsetup
+from logsetup import logger
+
+_PAGE_SIZE_USERS = 500
+_THROTTLE_UPDATES_SECONDS = 0.010 # 10 milliseconds between pages
+
+
+def backfill(start_uid: int=0) -> int:
+    dbsetup.metadata.create_all(bind=dbsetup.ENGINE, checkfirst=True)
+
+    total_written = 0
+    max_uid = start_uid
+    while True:
+        session = dbsetup.Session()
+        try:
+            q = session.query(usermgr.AnonUser.id).filter(usermgr.AnonUser.id > max_uid). \
+                order_by(usermgr.AnonUser.id.asc()).limit(_PAGE_SIZE_USERS)
+            uids = [uid for (uid,) in q.all()]
+            if len(uids) == 0:
+                break
+            total_written += RewardMgr.RewardManager.backfill_user_activity(session, uids)
+            session.commit()
+            max_uid = uids[-1]
+            logger.info("user activity built through user #{0}, {1} summaries".format(max_uid, total_written))
+        except Exception as e:
+            session.rollback()
+            logger.exception(msg='failure building user activity after user #{}'.format(max_uid))
+            raise
+        finally:
+            session.close()
+        time.sleep(_THROTTLE_UPDATES_SECONDS) # brief pause so machine can catch it's breath
+
+    return total_written
+
+
+if __name__ == "__main__":
+    start_uid = 0
+    for arg in sys.argv[1:]:
+        kwarg = arg.split('=')
+        if kwarg[0] == 'start':
+            start_uid = int(kwarg[1])
+
+    print("{} user activity summaries written".format(backfill(start_uid)))
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""
+thumbnails used to be written with the upload's whole EXIF block (GPS
+location included). Strip it from the existing thumbnail files in place &
+drop their cached base64 copies, new thumbnails only carry their
+orientation. /thumb strips a file when it first looks it up, so this only
+saves that work & clears the base64 copies, it can run any time after the
+server is deployed.
+
+usage: strip_thumbnail_exif.py [root=<image store path>]
+"""
+import sys
+import os
+
+lib_path = os.path.abspath(os.path.join('..'))
+sys.path.append(lib_path)
+
+from models import photo
+from cache.SharedCache import _shared_cache
+import dbsetup
+from logsetup import logger
+
+
+def strip_thumbnails(root: str) -> int:
+    num_stripped = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for fn in filenames:
+            if not (fn.startswith('th_') and fn.endswith('.jpg')):
+                continue
+            t_fn = os.path.join(dirpath, fn)
+            try:
+                if not photo.Photo.strip_thumbnail_file(t_fn):
+                    continue
+                _shared_cache.expire_key(fn[len('th_'):-len('.jpg')]) # the b64 thumbnail is cached by photo filename
+                num_stripped += 1
+            except Exception as e:
+                logger.exception(msg='error stripping EXIF from {0}'.format(t_fn))
+
+    return num_stripped
+
+
+if __name__ == "__main__":
+    root = dbsetup.image_store(dbsetup.determine_environment(None))
+    for arg in sys.argv[1:]:
+        kwarg = arg.split('=')
+        if kwarg[0] == 'root':
+            root = kwarg[1]
+
+    print("{} thumbnails stripped".format(strip_thumbnails(root)))
@@ -7,7 +7,7 @@ import os
 lib_path = os.path.abspath(os.path.join('..'))
 sys.path.append(lib_path)
 
-from controllers import categorymgr
+from controllers import categorymgr, BallotMgr, RewardMgr, ThumbnailMgr
 from daemon import python_daemon
 import redis
 from models import category, usermgr, photo, voting
@@ -87,6 +87,52 @@ class sync_daemon(python_daemon.myDaemon):
         for c in cl:
             self.all_photos_by_category(session, tm, c)
 
+        self.reconcile_category_stats(session)
+        self.reconcile_voteable_counts(session)
+        self.requeue_stale_thumbnails(session)
+
+    def requeue_stale_thumbnails(self, session):
+        """
+        photos left pending by a server worker that restarted or crashed
+        before making their thumbnail, make them here
+        :param session:
+        :return:
+        """
+        pipeline = ThumbnailMgr.ThumbnailPipeline(processes=False)
+        num_queued = pipeline.requeue_stale(session)
+        if num_queued > 0:
+            pipeline.wait()
+            logger.info("made thumbnails for {0} stale photos {1}".format(num_queued, pipeline.stats()))
+
+    def reconcile_category_stats(self, session):
+        """
+        repair any drift in the category counters (CategoryStats) of
+        categories no older than 7 days, whatever state they're in
+        :param session:
+        :return:
+        """
+        earliest_category = datetime.now() + timedelta(days=-7)
+        q = session.query(category.Category.id).filter(category.Category.start_date > earliest_category)
+        cids = [cid for (cid,) in q.all()]
+        num_repaired = categorymgr.CategoryManager.reconcile_category_stats(session, cids)
+        if num_repaired > 0:
+            logger.info("repaired counters for {} categories".format(num_repaired))
+
+    def reconcile_voteable_counts(self, session):
+        """
+        rewrite the photo counts of the voteable category index from the
+        database, photos counted as they're activated may have drifted
+        :param session:
+        :return:
+        """
+        try:
+            conn = RewardMgr._redis_server.connection(session)
+            num_categories = BallotMgr.VoteableCategoryIndex.reconcile_counts(session, conn)
+            logger.info("reconciled voteable photo counts for {} categories".format(num_categories))
+        except Exception as e:
+            RewardMgr._redis_server.connection_failed(e)
+            logger.exception(msg="error reconciling voteable photo counts")
+
     def read_all_categories(self, session):
         """
         get a complete list of categories no older than 7 days
@@ -129,6 +129,18 @@ def image_store(environment: EnvironmentType) -> str:
 
     return None
 
+def thumbnail_accel_prefix(environment: EnvironmentType) -> str:
+    """
+    where nginx serves the image store from (an 'internal' location, see
+    deploy/nginx.conf), None if there's no nginx in front & we send the bytes
+    """
+    if environment is None:
+        environment = determine_environment(None)
+    if environment == EnvironmentType.PROD:
+        return '/thumbfiles'
+
+    return None
+
 def photo_dir(environment: EnvironmentType) -> str:
     """find out where we find our photo data, environment dependent"""
     hostname = determine_host()
@@ -2,6 +2,10 @@ import dbsetup
 from models import sql_logging
 import logging
 import traceback
+import threading
+import queue
+import atexit
+import time
 
 class SQLAlchemyHandler(logging.Handler):
     def emit(self, record):
@@ -23,3 +27,168 @@ class SQLAlchemyHandler(logging.Handler):
             session.commit()
         finally:
             session.close()
+
+
+'''
+    AsyncSQLAlchemyHandler()
+    queue-backed handler, the request thread only formats the record and
+    drops it on a bounded queue. A background thread drains the queue and
+    writes the rows to the 'logs' table with a single multi-row INSERT.
+
+    overflow policy:
+        'drop_new' - queue full, discard the incoming record
+        'drop_old' - queue full, discard the oldest queued record to make room
+'''
+
+DROP_NEW = 'drop_new'
+DROP_OLD = 'drop_old'
+
+class AsyncSQLAlchemyHandler(logging.Handler):
+    _MAX_QUEUE_SIZE = 10000     # records we'll buffer before dropping
+    _BATCH_SIZE = 200           # max rows per INSERT
+    _FLUSH_INTERVAL = 2.0       # seconds, max time a record waits in the queue
+
+    def __init__(self, **kwargs):
+        logging.Handler.__init__(self, level=kwargs.get('level', logging.NOTSET))
+        self._max_queue_size = kwargs.get('max_queue_size', self._MAX_QUEUE_SIZE)
+        self._batch_size = kwargs.get('batch_size', self._BATCH_SIZE)
+        self._flush_interval = kwargs.get('flush_interval', self._FLUSH_INTERVAL)
+        self._overflow = kwargs.get('overflow', DROP_NEW)
+        if self._overflow not in (DROP_NEW, DROP_OLD):
+            raise ValueError('overflow policy must be {0} or {1}'.format(DROP_NEW, DROP_OLD))
+
+        # dependency injection, so we can test without a database
+        self._write_rows = kwargs.get('f_write', self.write_rows)
+
+        self._queue = queue.Queue(maxsize=self._max_queue_size)
+        self._host = dbsetup.determine_host()
+        self._stats_lock = threading.Lock()
+        self._stats = {'queued': 0, 'written': 0, 'dropped': 0, 'batches': 0, 'errors': 0}
+        self._stop_event = threading.Event()
+        self._flush_request = threading.Event()
+        self._worker = threading.Thread(target=self._run, name='AsyncSQLAlchemyHandler')
+        self._worker.setDaemon(True)
+        self._worker.start()
+        if kwargs.get('register_atexit', True):
+            atexit.register(self.close)
+
+    def _count(self, key: str, n=1) -> None:
+        with self._stats_lock:
+            self._stats[key] += n
+
+    def stats(self) -> dict:
+        """snapshot of the handler counters, includes current queue depth"""
+        with self._stats_lock:
+            d = dict(self._stats)
+        d['pending'] = self._queue.qsize()
+        return d
+
+    def record_to_row(self, record) -> dict:
+        trace = None
+        if record.exc_info:
+            trace = ''.join(traceback.format_exception(*record.exc_info))
+            if len(trace) > 2000:
+                trace = trace[0:1999]
+
+        msg = str(record.msg)
+        if len(msg) > 500:
+            msg = msg[0:499]
+
+        return {'host': self._host,
+                'logger': record.name,
+                'level': record.levelname,
+                'trace': trace,
+                'msg': msg}
+
+    def emit(self, record):
+        try:
+            row = self.record_to_row(record)
+        except Exception:
+            self.handleError(record)
+            return
+
+        try:
+            self._queue.put_nowait(row)
+            self._count('queued')
+            return
+        except queue.Full:
+            pass
+
+        if self._overflow == DROP_OLD:
+            try:
+                self._queue.get_nowait()
+                self._count('dropped')
+                self._queue.put_nowait(row)
+                self._count('queued')
+                return
+            except (queue.Empty, queue.Full):
+                pass
+
+        self._count('dropped')
+
+    @staticmethod
+    def write_rows(rows: list) -> None:
+        """one round trip, executemany() is turned into a multi-row INSERT by the driver"""
+        with dbsetup.ENGINE.begin() as conn:
+            conn.execute(sql_logging.Log.__table__.insert(), rows)
+
+    def _drain(self, max_rows: int) -> list:
+        rows = []
+        while len(rows) < max_rows:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+
+    def _write_batch(self, rows: list) -> None:
+        if len(rows) == 0:
+            return
+        try:
+            self._write_rows(rows)
+            self._count('written', len(rows))
+            self._count('batches')
+        except Exception:
+            # can't log this through ourselves, we'd just feed the failure
+            self._count('errors')
+            self._count('dropped', len(rows))
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            deadline = time.time() + self._flush_interval
+            rows = []
+            while len(rows) < self._batch_size and not self._stop_event.is_set():
+                if self._flush_request.is_set():
+                    break
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    rows.append(self._queue.get(timeout=min(timeout, 0.25)))
+                except queue.Empty:
+                    continue
+            rows.extend(self._drain(self._batch_size - len(rows)))
+            self._write_batch(rows)
+            if self._flush_request.is_set() and self._queue.empty():
+                self._flush_request.clear()
+
+        # shutting down, write out whatever is left
+        rows = self._drain(self._batch_size)
+        while len(rows) > 0:
+            self._write_batch(rows)
+            rows = self._drain(self._batch_size)
+
+    def flush(self, timeout=5.0) -> None:
+        """ask the worker to write everything that's queued, wait (bounded) for it to happen"""
+        if not self._worker.is_alive():
+            return
+        self._flush_request.set()
+        give_up = time.time() + timeout
+        while self._flush_request.is_set() and time.time() < give_up:
+            time.sleep(0.01)
+
+    def close(self) -> None:
+        if self._worker.is_alive():
+            self._stop_event.set()
+            self._worker.join(timeout=10.0)
+        logging.Handler.close(self)
@@ -31,9 +31,11 @@ from models import admin
 from models import engagement
 from models import event
 from models import userprofile
+from models import resources
 
 from logsetup import logger, client_logger, timeit
-from controllers import categorymgr, eventmgr, BallotMgr, RewardMgr
+from cache.SharedCache import _shared_cache
+from controllers import categorymgr, eventmgr, BallotMgr, RewardMgr, ThumbnailMgr, UploadMgr
 
 
 app = Flask(__name__)
@@ -75,6 +77,10 @@ _jwt = JWT(app, usermgr.authenticate, usermgr.identity)
 _jwt.jwt_decode_handler(fix_jwt_decode_handler)
 _jwt.auth_response_callback = usermgr.auth_response_handler # so we can add to the response going back
 
+def wants_thumb_urls() -> bool:
+    """opt-in, ?thumbs=url sends thumbnail URLs (see /thumb) rather than base64 images in the JSON"""
+    return request.args.get('thumbs', None) == 'url'
+
 @app.route("/spec/swagger.json")
 @timeit()
 def spec():
@@ -168,12 +174,10 @@ def healthcheck():
     # check that database & redis are up
     session = dbsetup.Session()
     try:
-        lb_name = 'configtest'
-        rd = voting.ServerList().get_redis_server(session)
-        lb = Leaderboard(lb_name, host=rd['ip'], port=rd['port'], page_size=10)
-        lb.check_member('no one')
-        lb.delete_leaderboard()
+        session.execute('SELECT 1')
+        RewardMgr._redis_server.connection(session).ping() # pooled connection, cached server address
     except Exception as e:
+        RewardMgr._redis_server.connection_failed(e)
         logger.exception(msg=str(e))
         http_status = status.HTTP_500_INTERNAL_SERVER_ERROR
     finally:
@@ -273,6 +277,23 @@ def hello():
     htmlbody += "\n<br>Flask instance path = \"" + app.instance_path + "\"\n"
     htmlbody += "\n<br>Flask root path = \"" + app.root_path + "\"\n"
 
+    cache_stats = _shared_cache.stats()
+    htmlbody += "\n<h3>Cache (this worker)</h3>"
+    htmlbody += "\n&nbsp&nbsp<b>entries: </b>{0} (max {1}), <b>bytes: </b>{2} (max {3})<br>".\
+        format(cache_stats['entries'], cache_stats['max_entries'], cache_stats['bytes'], cache_stats['max_bytes'])
+    htmlbody += "\n&nbsp&nbsp<b>hits: </b>{0}, <b>misses: </b>{1}, <b>evictions: </b>{2}, <b>expirations: </b>{3}<br>".\
+        format(cache_stats['hits'], cache_stats['misses'], cache_stats['evictions'], cache_stats['expirations'])
+    htmlbody += "\n&nbsp&nbsp<b>shared tier connected: </b>{0}, <b>shared hits: </b>{1}, <b>shared misses: </b>{2}, <b>errors: </b>{3}, <b>invalidations: </b>{4}<br>".\
+        format(cache_stats['shared_connected'], cache_stats['shared_hits'], cache_stats['shared_misses'], cache_stats['shared_errors'], cache_stats['invalidations_received'])
+
+    thumb_stats = ThumbnailMgr._thumbnail_pipeline.stats()
+    htmlbody += "\n&nbsp&nbsp<b>thumbnails pending: </b>{0}, <b>completed: </b>{1}, <b>failed: </b>{2}<br>".\
+        format(thumb_stats['pending'], thumb_stats['completed'], thumb_stats['failed'])
+
+    res_stats = resources.RESOURCE_MAP.stats()
+    htmlbody += "\n&nbsp&nbsp<b>resource strings: </b>{0}, <b>tagged categories: </b>{1}, <b>version: </b>{2}, <b>hits: </b>{3}, <b>misses: </b>{4}<br>".\
+        format(res_stats['strings'], res_stats['categories_tagged'], res_stats['version'], res_stats['hits'], res_stats['misses'])
+
     hostname = 'unknown ??'
     try:
         hostname = os.uname()[1]
@@ -352,17 +373,18 @@ def hello():
     else:
         htmlbody += "\n<br><h3>Categories:</h3>"
         htmlbody += "\n<blockquote>"
+        stats = category.CategoryStats.read_for_categories(session, [c.get_id() for c in cl])
         for c in cl:
             htmlbody += "\n<br>state = <b>{}</b>".format(category.CategoryState.to_str(c.state))
             htmlbody += "\n<br>category_id = {}".format(c.get_id())
             htmlbody += "\n<br>description = <b><i>\"{}\"</b></i>".format(c.get_description())
             htmlbody += "\n<br>start date={} UTC".format(c.start_date)
-            num_photos = photo.Photo.count_by_category(session, c.get_id())
+            num_photos = stats[c.get_id()]['num_photos']
             htmlbody += "\n<br>number photos uploaded = <b>{}</b>".format(num_photos)
             if c.state == category.CategoryState.VOTING.value:
                 lb_list = tm.fetch_leaderboard(session, usermgr.AnonUser(uid=0), c) # dummy user id
                 htmlbody += "\n<br>round={0} (Voting Round #{1})".format(c.round, c.round+1)
-                num_voters = voting.Ballot.num_voters_by_category(session, c.get_id())
+                num_voters = stats[c.get_id()]['num_voters']
                 htmlbody += "\n<br>number users voting = <b>{}</b>".format(num_voters)
                 end_of_voting = c.start_date + timedelta(hours=(c.duration_vote + c.duration_upload))
                 start_of_voting = c.start_date + timedelta(hours=c.duration_upload)
@@ -760,6 +782,13 @@ def get_leaderboard():
         description: "Category of the leaderboard being requested"
         required: true
         type: integer
+      - in: query
+        name: thumbs
+        description: "'url' to get a thumbnail URL ('thumb') instead of the base64 image"
+        required: false
+        type: string
+        enum:
+          - url
     security:
       - JWT: []
     responses:
@@ -823,6 +852,9 @@ def get_leaderboard():
             image:
               type: string
               description: "base64 encoded thumbnail image of entry"
+            thumb:
+              type: string
+              description: "URL of the JPEG thumbnail, instead of image when thumbs=url"
     """
     if not request.args:
         return make_response(jsonify({'msg': error.error_string('NO_ARGS')}),status.HTTP_400_BAD_REQUEST)
@@ -838,7 +870,7 @@ def get_leaderboard():
         else:
             tm = RewardMgr.TallyMan()
             c = category.Category.read_category_by_id(cid, session)
-            lb_list = tm.fetch_leaderboard(session, au, c)
+            lb_list = tm.fetch_leaderboard(session, au, c, wants_thumb_urls())
             if lb_list is not None:
                 rsp = make_response(jsonify(lb_list), 200)
             else:
@@ -867,6 +899,13 @@ def get_ballot():
         description: "The category we want to vote on. If not specified, a random category will be returned."
         required: false
         type: integer
+      - in: query
+        name: thumbs
+        description: "'url' to get a thumbnail URL ('thumb') instead of the base64 image"
+        required: false
+        type: string
+        enum:
+          - url
     security:
       - JWT: []
     responses:
@@ -924,6 +963,9 @@ def get_ballot():
             image:
               type: string
               description: 'base64 encoded string of JPEG image data'
+            thumb:
+              type: string
+              description: 'URL of the JPEG thumbnail, instead of image when thumbs=url'
       - schema:
           id: Ballots
           type: array
@@ -1210,7 +1252,7 @@ def return_ballot(session, uid: int, cid: int, pid=None):
     try:
         bm = BallotMgr.BallotManager()
         if cid is None:
-            cl = bm.active_voting_categories(session, uid)
+            cl = bm.voteable_categories(session, uid)
             if cl is None or len(cl) == 0:
                 logger.info(msg="[return_ballot]no categories to vote from!")
                 return make_response(jsonify({'msg': error.error_string('NO_CATEGORY')}),
@@ -1229,8 +1271,8 @@ def return_ballot(session, uid: int, cid: int, pid=None):
             return make_response(jsonify({'msg': error.error_string('NO_BALLOT')}),
                                  status.HTTP_500_INTERNAL_SERVER_ERROR)
         else:
-            ballots.read_photos_for_ballots(session)
-            j_ballots = ballots.to_json()
+            ballots.read_photos_for_ballots(session, wants_thumb_urls())
+            j_ballots = ballots.to_json(wants_thumb_urls())
             d = {'category': c.to_json(), 'ballots': j_ballots}
             session.commit()
             if pid is not None:
@@ -1469,7 +1511,7 @@ def category_photo_list(cid: int, dir: str, pid: int):
     session = dbsetup.Session()
     try:
         cm = categorymgr.CategoryManager()
-        pl = cm.category_photo_list(session, dir, pid, cid)
+        pl = cm.category_photo_rows(session, dir, pid, cid)
         d_photos = cm.photo_dict(pl)
         rsp = make_response(jsonify({'photos':d_photos}), status.HTTP_200_OK)
 
@@ -1561,14 +1603,18 @@ def photo_upload():
         schema:
           $ref: '#/definitions/Error'
     """
-    if not request.json:
+    if not request.is_json:
         return make_response(jsonify({'msg': error.error_string('NO_JSON')}), status.HTTP_400_BAD_REQUEST)
 
+    # the base64 image is decoded & written to storage as it's read from the request
+    p = photo.Photo()
     pi = photo.PhotoImage()
     try:
-        pi._binary_image = base64.b64decode(request.json['image'])
-        pi._extension = request.json['extension']
-        cid = request.json['category_id']
+        body = UploadMgr.JsonImageStream(UploadMgr.request_chunks(request.stream))
+        pi = p.ingest_image(body.image_chunks())
+        d_fields = body.fields()
+        pi._extension = d_fields['extension']
+        cid = d_fields['category_id']
         u = current_identity
         uid = u.id
     except KeyError:
@@ -1576,24 +1622,28 @@ def photo_upload():
         uid = None
         pass
     except BaseException as e:
+        pi.discard()
         logger.exception(msg=str(e))
         return make_response(jsonify({'msg': error.error_string('MISSING_ARGS')}), status.HTTP_400_BAD_REQUEST)
 
     if cid is None or uid is None:
+        pi.discard()
         return make_response(jsonify({'msg': error.error_string('MISSING_ARGS')}), status.HTTP_400_BAD_REQUEST)
 
-    return store_photo(pi, uid, cid)
+    return store_photo(pi, uid, cid, p)
 
 
-def store_photo(pi: photo.PhotoImage, uid: int, cid: int):
+def store_photo(pi: photo.PhotoImage, uid: int, cid: int, p: photo.Photo=None):
     rsp = None
     session = dbsetup.Session()
     try:
-        p = photo.Photo()
-        d = p.save_user_image(session, pi, uid, cid)
+        if p is None:
+            p = photo.Photo()
+        d = p.save_user_image(session, pi, uid, cid, pipeline=ThumbnailMgr._thumbnail_pipeline)
         session.commit()
         if d['error'] is not None:
             return make_response(jsonify({'msg': error.iiServerErrors.error_message(d['error'])}), error.iiServerErrors.http_status(d['error']))
+        ThumbnailMgr._thumbnail_pipeline.submit(p) # the photo becomes voteable when its thumbnail is done
         num_photos_in_category = photo.Photo.count_by_category(session, cid, uid)
         rsp = make_response(jsonify({'msg': error.error_string('PHOTO_UPLOADED'), 'filename': d['arg'], 'pid':p.id}), status.HTTP_201_CREATED)
 
@@ -1671,17 +1721,17 @@ def jpeg_photo_upload(cid: int):
 #    if not request.json:
 #        return make_response(jsonify({'msg': error.error_string('NO_JSON')}), status.HTTP_400_BAD_REQUEST)
 
-    pi = photo.PhotoImage()
+    # the body goes straight to storage as it's read, it's never all in memory
+    p = photo.Photo()
     try:
-        pi._binary_image = request.data
-        pi._extension = 'JPEG'
         u = current_identity
         uid = u.id
+        pi = p.ingest_image(UploadMgr.request_chunks(request.stream))
     except BaseException as e:
         logger.exception(msg=str(e))
         return make_response(jsonify({'msg': error.error_string('MISSING_ARGS')}), status.HTTP_400_BAD_REQUEST)
 
-    return store_photo(pi, uid, cid)
+    return store_photo(pi, uid, cid, p)
 
 @app.route("/log", methods=['POST'])
 @jwt_required()
@@ -1935,7 +1985,8 @@ def download_photo(pid):
     """
     Preview Photo
     Download a watermarked thumbnail of a photo on the site.
-    Can be used to display images as URLs
+    Can be used to display images as URLs. The preview never changes, it's
+    sent with an ETag and If-None-Match is answered with a 304.
     ---
     tags:
       - image
@@ -1953,6 +2004,8 @@ def download_photo(pid):
     responses:
       200:
         description: "image found"
+      304:
+        description: "not modified"
       404:
         description: "image not found"
         schema:
@@ -1962,12 +2015,20 @@ def download_photo(pid):
     session = dbsetup.Session()
     rsp = None
     try:
-        image_binary = p.read_thumbnail_by_id_with_watermark(session, pid)
-        rsp = make_response(image_binary, status.HTTP_200_OK)
-        rsp.headers['Content-Type'] = 'image/jpeg'
-        # rsp.headers['Content-Disposition'] = 'attachment; filename=img.jpg'
+        info = photo.Photo.read_thumbnail_info(session, pid, active_only=False)
+        if info is not None:
+            etag = '"{0}"'.format(photo.Photo.preview_etag(info))
+            if etag in request.headers.get('If-None-Match', ''):
+                rsp = make_response('', status.HTTP_304_NOT_MODIFIED)
+            else:
+                rsp = make_response(p.read_preview(info), status.HTTP_200_OK)
+                rsp.headers['Content-Type'] = 'image/jpeg'
+                # rsp.headers['Content-Disposition'] = 'attachment; filename=img.jpg'
+            rsp.headers['ETag'] = etag
+            rsp.headers['Cache-Control'] = 'public, max-age=604800'
     except Exception as e:
         logger.exception(msg="[/preview] error reading thumbnail!")
+        rsp = None
     finally:
         session.close()
         if rsp is None:
@@ -1976,6 +2037,71 @@ def download_photo(pid):
     return rsp
 
 
+@app.route('/thumb/<string:key>', methods=['GET'])
+@cross_origin(origins='*')
+@timeit()
+def get_thumbnail(key: str):
+    """
+    Thumbnail
+    The JPEG thumbnail of a photo, the 'thumb' URL of ballot & leaderboard
+    entries requested with thumbs=url. The key is the photo's thumb_hash, photo
+    ids aren't accepted (they're sequential, anyone could walk them). A photo's
+    thumbnail never changes, so it's sent with a strong ETag & If-None-Match is
+    answered with a 304, Cache-Control is kept short so a photo de-activated
+    later drops out of caches. Behind nginx the bytes are sent by nginx (X-Accel-Redirect).
+    ---
+    tags:
+      - image
+    operationId: get-thumbnail
+    produces:
+      - image/jpeg
+    parameters:
+      - in: path
+        name: key
+        description: "the thumb_hash of the photo"
+        required: true
+        type: string
+    responses:
+      200:
+        description: "the JPEG thumbnail"
+      304:
+        description: "not modified"
+      404:
+        description: "thumbnail not found"
+        schema:
+          $ref: '#/definitions/Error'
+    """
+    session = dbsetup.Session()
+    rsp = None
+    try:
+        info = photo.Photo.read_thumbnail_info(session, key)
+        if info is not None:
+            etag = '"{0}"'.format(info['etag'])
+            cache_control = 'public, max-age=3600' # revalidated with the ETag after that
+            if etag in request.headers.get('If-None-Match', ''):
+                rsp = make_response('', status.HTTP_304_NOT_MODIFIED)
+            else:
+                accel_prefix = dbsetup.thumbnail_accel_prefix(dbsetup.determine_environment(None))
+                if accel_prefix is not None:
+                    mnt_point = dbsetup.image_store(dbsetup.determine_environment(None))
+                    rsp = make_response('', status.HTTP_200_OK)
+                    rsp.headers['X-Accel-Redirect'] = accel_prefix + '/' + os.path.relpath(info['thumb_file'], mnt_point)
+                else:
+                    rsp = make_response(photo.Photo.read_thumbnail_file(info['thumb_file']), status.HTTP_200_OK)
+                rsp.headers['Content-Type'] = 'image/jpeg'
+            rsp.headers['ETag'] = etag
+            rsp.headers['Cache-Control'] = cache_control
+    except Exception as e:
+        logger.exception(msg="[/thumb] error reading thumbnail!")
+        rsp = None
+    finally:
+        session.close()
+        if rsp is None:
+            rsp = make_response(jsonify({'msg': 'thumbnail not found'}), status.HTTP_404_NOT_FOUND)
+
+    return rsp
+
+
 @app.route('/base')
 @jwt_required()
 @timeit()
@@ -2257,7 +2383,7 @@ def my_submissions(dir: str, cid: int):
         type: integer
       - in: query
         name: num_categories
-        description: "The number of categories to fetch in a single call, if not specified all will be fetched"
+        description: "The number of categories to fetch in a single call, if not specified all will be fetched. If there are more the response has a 'cursor' for the next call"
         required: false
         type: integer
     security:
@@ -2333,6 +2459,19 @@ def my_submissions(dir: str, cid: int):
               type: array
               items:
                 $ref: '#/definitions/CategoryPhotos'
+            cursor:
+              $ref: '#/definitions/SubmissionCursor'
+      - schema:
+          id: SubmissionCursor
+          description: "only present if there are more categories, GET /submissions/<dir>/<cid>?num_categories= for the next page"
+          properties:
+            dir:
+              type: string
+              example: "next"
+            cid:
+              type: integer
+              description: "the last category of this page"
+              example: 2173
     """
     if dir is None or cid is None or dir not in ('next', 'prev'):
         return make_response(jsonify({'msg': error.error_string('MISSING_ARGS')}), status.HTTP_400_BAD_REQUEST)
@@ -2595,6 +2734,7 @@ def join_event():
         logger.info(msg="[/joinevent]user #{0} successfully joined event #{1}".format(current_identity.id, e.id))
         d_el = eventmgr.EventManager.event_details(session, current_identity._get_current_object(), e.id)
         session.commit()
+        category.Category.invalidate_voteable(current_identity.id) # new categories are open to this user
         return make_response(jsonify(d_el), status.HTTP_200_OK)
     except KeyError as ke:
         session.close()
@@ -2825,9 +2965,14 @@ def mylikes(dir: str, cid: int):
         description: "when paging, indicates the first category-identifier to start fetching new page, non-inclusive"
         type: integer
         required: true
+      - in: query
+        name: pid
+        description: "from the cursor, resume in category cid after this photo"
+        type: integer
+        required: false
     responses:
       200:
-        description: "list of photos that the user likes"
+        description: "list of photos that the user likes, a page is at most 50 photos"
         schema:
           id: liked-category-photos
         schema:
@@ -2891,14 +3036,37 @@ def mylikes(dir: str, cid: int):
               type: array
               items:
                 $ref: '#/definitions/LikedPhotos'
+            cursor:
+              $ref: '#/definitions/LikeCursor'
+      - schema:
+          id: LikeCursor
+          description: "only present if there are more likes, GET /like/<dir>/<cid>?pid=<pid> for the next page"
+          properties:
+            dir:
+              type: string
+              example: "next"
+            cid:
+              type: integer
+              example: 2173
+            pid:
+              type: integer
+              description: "only if the page ended part way through category cid"
+              example: 1380547
     """
     if dir != 'next' and dir != 'prev':
         return make_response(jsonify({'msg': 'input argument error'}), status.HTTP_400_BAD_REQUEST)
 
+    try:
+        pid = request.args.get('pid')
+        if pid is not None:
+            pid = int(pid)
+    except ValueError:
+        return make_response(jsonify({'msg': 'pid is not an integer value'}), status.HTTP_400_BAD_REQUEST)
+
     session = dbsetup.Session()
     try:
         au = current_identity._get_current_object()
-        r = userprofile.Submissions.get_user_likes(session, au, dir, cid)
+        r = userprofile.Submissions.get_user_likes(session, au, dir, cid, pid)
         if r is None:
             return make_response('', status.HTTP_204_NO_CONTENT)
         else:
@@ -17,7 +17,8 @@ else:
     client_logger.setLevel(logging.INFO)
 
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-hndlr = sql_handler.SQLAlchemyHandler()
+# log writes are queued and batched by a background thread, requests never wait on the logs table
+hndlr = sql_handler.AsyncSQLAlchemyHandler()
 if _DEBUG:
     hndlr.setLevel(logging.DEBUG)
 else:
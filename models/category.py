@@ -10,7 +10,7 @@ from dbsetup import Base
 from logsetup import logger
 from models import resources
 from models import usermgr
-from cache.ExpiryCache import _expiry_cache
+from cache.SharedCache import _shared_cache
 
 _CATEGORYLIST_MAXSIZE = 100
 
@@ -83,15 +83,12 @@ class Category(Base):
 
     @staticmethod
     def get_description_by_resource(rid: int) -> str:
-        session = dbsetup.Session()
         resource_string = None
         try:
-            r = resources.Resource.load_resource_by_id(session, rid, 'EN')
-            resource_string = r.resource_string
+            resource_string = resources.RESOURCE_MAP.get_string(rid, 'EN')
         except Exception as e:
             logger.exception(msg="error reading resource string for category")
         finally:
-            session.close()
             return resource_string
 
     def get_description(self) -> str:
@@ -136,7 +133,7 @@ class Category(Base):
 
             # if IISTAFF, bypass the cache
             if au.usertype != usermgr.UserType.IISTAFF.value:
-                cl = _expiry_cache.get("ALL_CATEGORIES")
+                cl = _shared_cache.get("ALL_CATEGORIES")
                 if cl is not None:
                     logger.info(msg="cache hit! Category list")
                     return cl
@@ -174,7 +171,7 @@ class Category(Base):
             assert(expire_ttl >= 0)
             if expire_ttl > 10: # just a sanity check in case ttl is negative
                 logger.info(msg='caching Categories for {0} seconds'.format(expire_ttl))
-                _expiry_cache.put("ALL_CATEGORIES", cl, ttl=expire_ttl)
+                _shared_cache.put("ALL_CATEGORIES", cl, ttl=expire_ttl)
             return cl
         except Exception as e:
             logger.exception(msg='error reading active categories')
@@ -233,6 +230,25 @@ class Category(Base):
     def is_voting(self) -> bool:
         return self.state == CategoryState.VOTING.value
 
+    VOTEABLE_INDEX_KEY = 'VOTEABLE_OPEN_CATEGORIES'
+    VOTEABLE_USER_KEY = 'VOTEABLE_CATEGORIES{0}'
+
+    @staticmethod
+    def invalidate_voteable(uid: int=None) -> None:
+        """
+        category states or event membership changed, drop the cached open
+        categories of the voteable category index (see BallotMgr.VoteableCategoryIndex)
+        and the user's cached answer
+        """
+        _shared_cache.expire_key(Category.VOTEABLE_INDEX_KEY)
+        if uid is not None:
+            Category.invalidate_voteable_user(uid)
+
+    @staticmethod
+    def invalidate_voteable_user(uid: int) -> None:
+        """drop the user's cached voteable categories, e.g. their photo can be voted on now"""
+        _shared_cache.expire_key(Category.VOTEABLE_USER_KEY.format(uid))
+
     @staticmethod
     def is_upload_by_id(session, cid: int) -> bool:
         c = Category.read_category_by_id(cid, session)
@@ -241,6 +257,94 @@ class Category(Base):
 
         return c.state == CategoryState.UPLOAD.value
 
+class CategoryStats(Base):
+    """
+    running totals for a category, so event & category details don't
+    COUNT(DISTINCT) the photo and ballot tables on every request.
+    num_photos/num_uploaders count photos that aren't de-activated, num_voters
+    counts users with a ballot (see CategoryVoter). They're bumped as photos are uploaded or
+    de-activated and ballots are created (in the same transaction), the
+    reconciliation job (CategoryManager.reconcile_category_stats) repairs drift.
+    """
+    __tablename__ = 'categorystats'
+
+    category_id     = Column(Integer, ForeignKey("category.id", name="fk_categorystats_category_id"), primary_key=True)
+    num_photos      = Column(Integer, nullable=False, default=0)
+    num_uploaders   = Column(Integer, nullable=False, default=0)
+    num_voters      = Column(Integer, nullable=False, default=0)
+
+    created_date = Column(DateTime, server_default=text('CURRENT_TIMESTAMP'), nullable=False)
+    last_updated = Column(DateTime, nullable=True, server_default=text('CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP'))
+
+    # one statement whether or not the category has a row yet
+    _ADD_SQL = text('INSERT INTO categorystats (category_id, num_photos, num_uploaders, num_voters) '
+                    'VALUES (:cid, GREATEST(:photos, 0), GREATEST(:uploaders, 0), GREATEST(:voters, 0)) '
+                    'ON DUPLICATE KEY UPDATE '
+                    'num_photos = GREATEST(num_photos + :photos, 0), '
+                    'num_uploaders = GREATEST(num_uploaders + :uploaders, 0), '
+                    'num_voters = GREATEST(num_voters + :voters, 0)')
+
+    def __init__(self, **kwargs):
+        self.category_id = kwargs.get('category_id', None)
+        self.num_photos = kwargs.get('num_photos', 0)
+        self.num_uploaders = kwargs.get('num_uploaders', 0)
+        self.num_voters = kwargs.get('num_voters', 0)
+
+    @staticmethod
+    def add(session, cid: int, photos: int=0, uploaders: int=0, voters: int=0) -> None:
+        """adjust the counters for a category, never below zero"""
+        if photos == 0 and uploaders == 0 and voters == 0:
+            return
+        session.execute(CategoryStats._ADD_SQL, {'cid': cid, 'photos': photos, 'uploaders': uploaders, 'voters': voters})
+
+    @staticmethod
+    def read_for_categories(session, cids: list) -> dict:
+        """
+        the counters for a list of categories in one query
+        :return: cid -> {'num_photos', 'num_uploaders', 'num_voters'}, zeros for categories without a row
+        """
+        d = {cid: {'num_photos': 0, 'num_uploaders': 0, 'num_voters': 0} for cid in cids}
+        if len(d) == 0:
+            return d
+        q = session.query(CategoryStats.category_id, CategoryStats.num_photos, CategoryStats.num_uploaders, CategoryStats.num_voters). \
+            filter(CategoryStats.category_id.in_(list(d.keys())))
+        for cid, num_photos, num_uploaders, num_voters in q.all():
+            d[cid] = {'num_photos': num_photos, 'num_uploaders': num_uploaders, 'num_voters': num_voters}
+        return d
+
+class CategoryVoter(Base):
+    """
+    the users with a ballot in a category. The primary key decides who the
+    category's new voters are, so CategoryStats.num_voters is bumped once
+    per voter without a SELECT, however many first ballots race.
+    """
+    __tablename__ = 'categoryvoter'
+
+    category_id     = Column(Integer, ForeignKey("category.id", name="fk_categoryvoter_category_id"), primary_key=True)
+    user_id         = Column(Integer, ForeignKey("anonuser.id", name="fk_categoryvoter_user_id"), primary_key=True)
+
+    created_date = Column(DateTime, server_default=text('CURRENT_TIMESTAMP'), nullable=False)
+
+    # INSERT IGNORE rather than ON DUPLICATE KEY UPDATE, with CLIENT_FOUND_ROWS
+    # (the MySQL dialects set it) an unchanged duplicate still reports a row
+    _ADD_SQL = text('INSERT IGNORE INTO categoryvoter (category_id, user_id) VALUES (:cid, :uid)')
+
+    def __init__(self, **kwargs):
+        self.category_id = kwargs.get('category_id', None)
+        self.user_id = kwargs.get('user_id', None)
+
+    @staticmethod
+    def add(session, cid: int, uid: int) -> bool:
+        """
+        the user has been given a ballot in the category, counted in
+        CategoryStats.num_voters if it's their first
+        :return: True if they're a new voter
+        """
+        if session.execute(CategoryVoter._ADD_SQL, {'cid': cid, 'uid': uid}).rowcount != 1:
+            return False
+        CategoryStats.add(session, cid, voters=1)
+        return True
+
 class CategoryTag(Base):
     __tablename__ = 'categorytag'
 
@@ -266,14 +370,7 @@ class CategoryTagList():
         :return:
         """
         try:
-            q = session.query(resources.Resource).\
-                join(CategoryTag, CategoryTag.resource_id == resources.Resource.resource_id).\
-                filter(CategoryTag.cid == cid).\
-                filter(resources.Resource.iso639_1 == 'EN')
-            res = q.all()
-            self._tags = []
-            for r in res:
-                self._tags.append(r.resource_string)
+            self._tags = resources.RESOURCE_MAP.get_tags(cid, session, 'EN')
             return self._tags
 
         except Exception as e:
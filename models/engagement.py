@@ -1,4 +1,6 @@
-from sqlalchemy import Column, Integer, DateTime, text, ForeignKey, Boolean, String
+from datetime import date, datetime, timedelta
+from sqlalchemy import Column, Integer, Date, DateTime, text, ForeignKey, Boolean, String, Index
+from sqlalchemy.orm.util import identity_key
 import dbsetup
 from dbsetup import Base
 from logsetup import logger
@@ -91,11 +93,110 @@ class Reward(Base):
             self.rewardtype = str(rewardtype)
 
 
+class UserActivity(Base):
+    """
+    a summary of the user's play, so the badge & consecutive day rewards are
+    a row read rather than COUNT()/DISTINCT day scans of the ballot and photo
+    tables. record_vote()/record_upload() keep it current as ballots and
+    photos are created, RewardManager.backfill_user_activity() builds it from
+    the existing data. num_votes counts ballots, a streak is the number of
+    consecutive days, ending on the last_*_day, with a ballot/upload.
+    """
+    __tablename__ = 'useractivity'
+
+    user_id = Column(Integer, ForeignKey("anonuser.id", name="fk_useractivity_userid"), primary_key=True, nullable=False)
+    num_votes = Column(Integer, default=0, nullable=False)
+    last_vote_day = Column(Date, nullable=True)
+    vote_streak = Column(Integer, default=0, nullable=False)
+    last_upload_day = Column(Date, nullable=True)
+    upload_streak = Column(Integer, default=0, nullable=False)
+
+    created_date = Column(DateTime, server_default=text('CURRENT_TIMESTAMP'), nullable=False)
+    last_updated = Column(DateTime, nullable=True, server_default=text('CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP'))
+
+    # MySQL applies the assignments left to right, so the streak is worked
+    # out against the old last day before it's moved forward
+    _VOTE_SQL = text('INSERT INTO useractivity (user_id, num_votes, last_vote_day, vote_streak) VALUES (:uid, 1, :day, 1) '
+                     'ON DUPLICATE KEY UPDATE num_votes = num_votes + 1, '
+                     'vote_streak = CASE WHEN last_vote_day >= :day THEN vote_streak '
+                     'WHEN last_vote_day = DATE_SUB(:day, INTERVAL 1 DAY) THEN vote_streak + 1 ELSE 1 END, '
+                     'last_vote_day = GREATEST(COALESCE(last_vote_day, :day), :day)')
+    _UPLOAD_SQL = text('INSERT INTO useractivity (user_id, last_upload_day, upload_streak) VALUES (:uid, :day, 1) '
+                       'ON DUPLICATE KEY UPDATE '
+                       'upload_streak = CASE WHEN last_upload_day >= :day THEN upload_streak '
+                       'WHEN last_upload_day = DATE_SUB(:day, INTERVAL 1 DAY) THEN upload_streak + 1 ELSE 1 END, '
+                       'last_upload_day = GREATEST(COALESCE(last_upload_day, :day), :day)')
+
+    def __init__(self, **kwargs):
+        self.user_id = kwargs.get('user_id', None)
+        self.num_votes = kwargs.get('num_votes', 0)
+        self.last_vote_day = kwargs.get('last_vote_day', None)
+        self.vote_streak = kwargs.get('vote_streak', 0)
+        self.last_upload_day = kwargs.get('last_upload_day', None)
+        self.upload_streak = kwargs.get('upload_streak', 0)
+
+    @staticmethod
+    def _record(session, sql, uid: int, day: date) -> None:
+        if day is None:
+            day = datetime.now().date()
+        session.execute(sql, {'uid': uid, 'day': day})
+        # anything we'd read earlier in this session is stale now
+        ua = session.identity_map.get(identity_key(UserActivity, uid), None)
+        if ua is not None:
+            session.expire(ua)
+
+    @staticmethod
+    def record_vote(session, uid: int, day: date=None) -> None:
+        """the user has been given a ballot"""
+        UserActivity._record(session, UserActivity._VOTE_SQL, uid, day)
+
+    @staticmethod
+    def record_upload(session, uid: int, day: date=None) -> None:
+        """the user has uploaded a photo"""
+        UserActivity._record(session, UserActivity._UPLOAD_SQL, uid, day)
+
+    @staticmethod
+    def read(session, uid: int):
+        """the user's summary (from the session if we've already read it), None if they haven't played"""
+        return session.query(UserActivity).get(uid)
+
+    @staticmethod
+    def current_streak(last_day: date, streak: int, day: date) -> int:
+        """a streak is still alive the day after its last day, after that it's broken"""
+        if last_day is None or last_day < day - timedelta(days=1):
+            return 0
+        return streak
+
+    def vote_streak_on(self, day: date) -> int:
+        return UserActivity.current_streak(self.last_vote_day, self.vote_streak, day)
+
+    def upload_streak_on(self, day: date) -> int:
+        return UserActivity.current_streak(self.last_upload_day, self.upload_streak, day)
+
+    @staticmethod
+    def streak_from_days(days: list) -> (date, int):
+        """
+        :param days: the distinct days with activity, in ascending order
+        :return: the last day and the length of the run of consecutive days ending on it
+        """
+        if len(days) == 0:
+            return None, 0
+        streak = 1
+        for i in range(len(days) - 1, 0, -1):
+            if days[i] - days[i-1] != timedelta(days=1):
+                break
+            streak += 1
+        return days[-1], streak
+
+
 class Feedback(Base):
     __tablename__ = 'feedback'
+    # the likes feed pages through a user's likes by category, see Submissions.get_user_likes()
+    __table_args__ = (Index('ix_feedback_user_like_category', 'user_id', 'like', 'category_id', 'photo_id'),)
 
     user_id = Column(Integer, ForeignKey("anonuser.id", name="fk_feedback_uid"), primary_key=True)
     photo_id = Column(Integer, ForeignKey("photo.id", name="fk_feedback_pid"), primary_key=True)
+    category_id = Column(Integer, ForeignKey("category.id", name="fk_feedback_cid"), nullable=True) # the photo's category
     like = Column(Boolean, nullable=False, default=False)
     offensive = Column(Boolean, nullable=False, default=False)
 
@@ -128,6 +229,8 @@ class Feedback(Base):
             return
 
         p = session.query(photo.Photo).get(pid)
+        if self.category_id is None:
+            self.category_id = p.category_id
         if self.like and not self._old_like:
             p.likes = p.likes + 1
         if not self.like and self._old_like:
@@ -144,6 +247,18 @@ class Feedback(Base):
         except Exception as e:
             raise
 
+    @staticmethod
+    def get_feedback_for_photos(session, uid: int, pids: list) -> dict:
+        """
+        the user's feedback for a set of photos in one query
+        :return: dictionary of photo_id -> Feedback, photos without feedback are missing
+        """
+        if len(pids) == 0:
+            return {}
+        q = session.query(Feedback).filter(Feedback.user_id == uid).\
+            filter(Feedback.photo_id.in_(pids))
+        return {fb.photo_id: fb for fb in q.all()}
+
 
 class FeedbackTag(Base):
     __tablename__ = 'feedbacktag'
@@ -42,6 +42,23 @@ class Event(Base):
             logger.exception(msg="error reading user information for Event {0}".format(self.id))
             raise
 
+    @staticmethod
+    def read_userinfo_for_events(session, event_list: list) -> None:
+        """read_userinfo() for a list of events in one query"""
+        uids = list({e.user_id for e in event_list})
+        if len(uids) == 0:
+            return
+        try:
+            q = session.query(usermgr.AnonUser.id, usermgr.AnonUser.usertype, usermgr.User.emailaddress). \
+                outerjoin(usermgr.User, usermgr.User.id == usermgr.AnonUser.id). \
+                filter(usermgr.AnonUser.id.in_(uids))
+            users = {uid: (usertype, emailaddress) for uid, usertype, emailaddress in q.all()}
+            for e in event_list:
+                e._usertype, e._username = users[e.user_id]
+        except Exception as e:
+            logger.exception(msg="error reading user information for Events {0}".format([e.id for e in event_list]))
+            raise
+
     def read_categories(self, session):
         """an event has a list of categories, read them in"""
         try:
@@ -54,6 +71,25 @@ class Event(Base):
             logger.exception(msg="error reading categories for Event {0}".format(self.id))
             raise
 
+    @staticmethod
+    def read_categories_for_events(session, event_list: list) -> None:
+        """read_categories() for a list of events in one query"""
+        for e in event_list:
+            e._cl = []
+        if len(event_list) == 0:
+            return
+        events = {e.id: e for e in event_list}
+        try:
+            q = session.query(EventCategory.event_id, category.Category). \
+                join(category.Category, EventCategory.category_id == category.Category.id). \
+                filter(EventCategory.event_id.in_(list(events.keys()))). \
+                order_by(category.Category.id.asc())
+            for event_id, c in q.all():
+                events[event_id]._cl.append(c)
+        except Exception as e:
+            logger.exception(msg="error reading categories for Events {0}".format(list(events.keys())))
+            raise
+
     def to_dict(self, uid: int) -> dict:
         d_cl = []
         if self._cl is not None:
@@ -3,8 +3,10 @@ import os, os.path, errno
 import uuid
 import base64
 import hashlib
+from datetime import datetime
 from io import BytesIO
 import json
+import threading
 import sqlalchemy
 from sqlalchemy import Column, Integer, String, DateTime, text, ForeignKey
 from sqlalchemy.orm import relationship
@@ -13,7 +15,8 @@ from PIL.ExifTags import TAGS, GPSTAGS
 import piexif
 from retrying import retry
 from logsetup import logger, timeit
-from cache.ExpiryCache import _expiry_cache
+from cache.SharedCache import _shared_cache
+from cache.ExpiryCache import ExpiryCache
 from dbsetup import Base
 import dbsetup
 from models import category
@@ -21,17 +24,103 @@ from models import error
 
 
 class PhotoImage():
-    """simple class to encapulate the image data"""
+    """
+    simple class to encapulate the image data, either in memory or,
+    for uploads streamed straight to storage (Photo.ingest_image), the
+    stored file with the MD5 we computed while writing it
+    """
     _binary_image = None
     _extension = None
+    _stored_file = None
+    _size = 0
+    _digest = None
     def __init__(self):
         pass
 
+    def has_image(self) -> bool:
+        if self._stored_file is not None:
+            return self._size > 0
+        return self._binary_image is not None
+
+    def open_image(self):
+        """a file object for PIL, BytesIO shares the bytes rather than copying them"""
+        if self._stored_file is not None:
+            return open(os.path.normpath(self._stored_file), 'rb')
+        return BytesIO(self._binary_image)
+
+    def md5_digest(self) -> str:
+        if self._digest is not None:
+            return self._digest
+        m = hashlib.md5()
+        if self._stored_file is not None:
+            with self.open_image() as f:
+                for chunk in iter(lambda: f.read(64 * 1024), b''):
+                    m.update(chunk)
+        else:
+            m.update(memoryview(self._binary_image))
+        self._digest = m.hexdigest().upper()
+        return self._digest
+
+    def discard(self) -> None:
+        """the upload was rejected, remove the file we streamed it to"""
+        if self._stored_file is None:
+            return
+        try:
+            os.remove(os.path.normpath(self._stored_file))
+        except OSError as e:
+            logger.exception(msg='error removing rejected upload {0}'.format(self._stored_file))
+        self._stored_file = None
+        self._size = 0
+
+
+# watermarked thumbnails (/preview) by ETag, the same photos get shared over & over
+_PREVIEW_CACHE_MAX_ENTRIES = 2000
+_PREVIEW_CACHE_MAX_BYTES = 32 * 1024 * 1024
+_preview_cache = ExpiryCache(max_entries=_PREVIEW_CACHE_MAX_ENTRIES, max_bytes=_PREVIEW_CACHE_MAX_BYTES)
+
+
+class WatermarkAssets():
+    """
+    everything we paste onto a thumbnail to watermark it. None of it depends
+    on the photo, so it's built once per process: the logo & the "imageimprov"
+    text, each already faded & with its alpha mask.
+
+    The text is drawn once into a strip 20 rows high, it's pasted with its
+    bottom on the bottom of the thumbnail (anything lower was drawn off the
+    image anyway). text_x is where the drawing origin is within the strip.
+    """
+    VERSION = 1 # bump when the watermark changes, it's in the preview ETag
+    TEXT = "imageimprov"
+    # image improv "yellow" is #FCBB15, or (252,187, 21)
+    TEXT_FILL = (255, 255, 255, 128)
+
+    # The fade is the min() in the lookup table, the number determines how
+    #  faded the image will be. That number is in the range [0, 256],
+    #  where 0 is black and 256 is white. A good value for fading our white
+    #  text is in the range [100, 200].
+    FADE = [min(x, 200) for x in range(256)]
+
+    def __init__(self, font: ImageFont, logo: Image):
+        self.logo_mask = logo.convert("L").point(self.FADE)
+        self.logo = logo.copy()
+        self.logo.putalpha(self.logo_mask)
+
+        pad = 20 # room for any glyph left of the origin
+        strip = Image.new("RGBA", (pad * 2 + len(self.TEXT) * 20, 20))
+        ImageDraw.ImageDraw(strip, "RGBA").text((pad, 0), self.TEXT, fill=self.TEXT_FILL, font=font)
+        strip.putalpha(strip.convert("L").point(self.FADE))
+        box = strip.getbbox()
+        if box is None:
+            box = (pad, 0, pad + 1, 20)
+        self.text = strip.crop((box[0], 0, box[2], 20))
+        self.text_x = pad - box[0]
+
 
 class Photo(Base):
     """our photo object, knows how to save photos"""
     __tablename__ = 'photo'
-    __table_args__ = {'extend_existing':True}
+    __table_args__ = (sqlalchemy.Index('ix_photo_user_id_category_id', 'user_id', 'category_id'),
+                      {'extend_existing':True})
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey("anonuser.id", name="fk_photo_user_id"),
@@ -54,12 +143,16 @@ class Photo(Base):
     _photometa = relationship("PhotoMeta", uselist=False,
                               backref="photo", cascade="all, delete-orphan")
 
+    ACTIVE_PENDING = 2  # 'active' value while the thumbnail is being made (see ThumbnailMgr), not voteable yet
+
     _uuid = None
     _sub_path = None
     _full_filename = None
     _mnt_point = None   # "root path" to prefix, where folders are to be created
     _orientation = None   # orientation of the photo/thumbnail image
     _photoimage = None
+    _watermark_assets = None    # WatermarkAssets, loaded on first use
+    _watermark_lock = threading.Lock()
 
     def __init__(self, *args, **kwargs):
         self.id = kwargs.get('pid')
@@ -84,6 +177,16 @@ class Photo(Base):
         num_users = q.count()
         return num_users
 
+    @staticmethod
+    def has_photos_in_category(session, cid: int, uid: int, exclude_pid: int=None) -> bool:
+        """does the user have a photo (that isn't de-activated) in the category"""
+        q = session.query(Photo.id).filter(Photo.user_id == uid).\
+            filter(Photo.category_id == cid).\
+            filter(Photo.active != 0)
+        if exclude_pid is not None:
+            q = q.filter(Photo.id != exclude_pid)
+        return q.limit(1).first() is not None
+
     def set_orientation(self, orientation: int) -> None:
         self._orientation = orientation
 
@@ -139,6 +242,50 @@ class Photo(Base):
             Photo.write_file(os.path.normpath(path_and_name), pi._binary_image)
         return
 
+    @staticmethod
+    def write_stream(path_and_name: str, chunks) -> tuple:
+        """
+        write the chunks to the file as they arrive, computing the MD5 as we go.
+        We can't retry like safe_write_file(), the stream is gone once read,
+        so the directory is made up front & a partial file is removed.
+        :return: (bytes written, MD5 hex digest)
+        """
+        fn = os.path.normpath(path_and_name)
+        try:
+            Photo.mkdir_p(os.path.dirname(fn))
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+        m = hashlib.md5()
+        size = 0
+        try:
+            with open(fn, 'wb') as f:
+                for chunk in chunks:
+                    m.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException as e:
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+            raise
+        return size, m.hexdigest().upper()
+
+    def ingest_image(self, chunks) -> PhotoImage:
+        """
+        an upload arriving as a stream of chunks goes straight to this
+        photo's storage path, see save_user_image()
+        :return: PhotoImage for the stored file
+        """
+        fn = self.create_storage_name('JPEG')
+        pi = PhotoImage()
+        pi._extension = 'JPEG'
+        pi._size, pi._digest = Photo.write_stream(fn, chunks)
+        pi._stored_file = fn
+        return pi
+
     def create_name(self) -> str:
         """create the filename for our photo"""
         self._uuid = uuid.uuid1()
@@ -233,29 +380,100 @@ class Photo(Base):
         except Exception as e:
             logger.exception(msg="Error with EXIF data parsing for file {0}/{1}".format(self.filepath, self.filename))
 
+    @staticmethod
+    def is_normalized_thumbnail(thumb: bytes) -> bool:
+        """
+        create_thumb_PIL() always writes a baseline JPEG, so anything that starts
+        with the JPEG SOI marker can be sent as-is. Anything else (legacy files,
+        PNGs, truncated writes) needs to go through PIL.
+        """
+        return thumb is not None and thumb[:3] == b'\xff\xd8\xff'
+
+    @staticmethod
+    def strip_exif(jpeg: bytes) -> bytes:
+        """
+        drop the APP1 (EXIF/XMP) segments from a JPEG without decoding it, older
+        thumbnails carry the upload's whole EXIF block, GPS location included
+        """
+        if jpeg[:2] != b'\xff\xd8':
+            return jpeg
+        keep = [jpeg[:2]]
+        i = 2
+        while i + 4 <= len(jpeg) and jpeg[i] == 0xFF:
+            marker = jpeg[i+1]
+            if marker == 0xDA: # start of scan, the rest is image data
+                break
+            length = (jpeg[i+2] << 8) + jpeg[i+3]
+            if marker != 0xE1:
+                keep.append(jpeg[i:i + 2 + length])
+            i += 2 + length
+        keep.append(jpeg[i:])
+        return b''.join(keep)
+
+    @staticmethod
+    def strip_thumbnail_file(t_fn: str) -> bool:
+        """
+        strip the EXIF from a stored thumbnail in place, for the ones written
+        before thumbnails only carried their orientation
+        :return: True if the file was rewritten
+        """
+        with open(t_fn, 'rb') as f:
+            thumb = f.read()
+        stripped = Photo.strip_exif(thumb)
+        if len(stripped) == len(thumb):
+            return False
+
+        # write alongside & swap, so a reader (nginx) never sees half a file
+        tmp_fn = t_fn + '.tmp'
+        with open(tmp_fn, 'wb') as f:
+            f.write(stripped)
+        os.replace(tmp_fn, t_fn)
+        return True
+
+    @staticmethod
+    def normalize_thumbnail(thumb: bytes) -> bytes:
+        """decode & re-encode as JPEG, only for thumbnails that aren't already usable"""
+        image = Image.open(BytesIO(thumb))
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        b = BytesIO()
+        image.save(b, format='JPEG')
+        return b.getvalue()
+
+    def read_thumbnail_bytes(self) -> bytes:
+        """read the stored thumbnail file, only decoding it if it isn't a JPEG"""
+        return Photo.read_thumbnail_file(self.create_thumb_filename())
+
+    @staticmethod
+    def read_thumbnail_file(t_fn: str) -> bytes:
+        with open(os.path.normpath(t_fn), 'rb') as f:
+            thumb = f.read()
+
+        if not Photo.is_normalized_thumbnail(thumb):
+            logger.info(msg="normalizing thumbnail {0}".format(t_fn))
+            return Photo.normalize_thumbnail(thumb)
+        return Photo.strip_exif(thumb)
+
     def read_thumbnail_b64_utf8(self) -> str:
         """
         Reads a thumbnail image, checking the cache first.
         The cache expiration is pretty long, could be an issue
         once we have lots & lots of users.
+        The thumbnail file is already a normalized JPEG, so the bytes
+        go straight to base64, no decode/re-encode.
         :return: base64 encoded thumbnail as a string
         """
         try:
-            b64_utf8 = _expiry_cache.get(self.filename)
+            b64_utf8 = _shared_cache.get(self.filename)
             if b64_utf8 is not None:
                 logger.info(msg="cache hit for thumb:{0}".format(self.filename))
                 return b64_utf8
 
-            t_fn = self.create_thumb_filename()
-            image = Image.open(os.path.normpath(t_fn) )
-
-            b = BytesIO()
-            image.save(b, format='JPEG')  # , exif=exif_bytes)
-            thumb = b.getvalue()
+            thumb = self.read_thumbnail_bytes()
             self.set_orientation(1)  # should always be '1'
             b64_bytes = base64.standard_b64encode(thumb)
             b64_utf8 = b64_bytes.decode('utf-8')
-            _expiry_cache.put(self.filename, b64_utf8, ttl=60*60*24*3) # keep for 3 days
+            _shared_cache.put(self.filename, b64_utf8, ttl=60*60*24*3, local_only=True) # keep for 3 days, one per photo is too many for redis
             return b64_utf8
 
         except Exception as e:
@@ -269,29 +487,52 @@ class Photo(Base):
     # the folder structure and save references in the
     # database
     #
-    # Note: We also create the thumbnail file as well
+    # Note: We also create the thumbnail file as well, unless a
+    #       thumbnail pipeline is supplied. Then the photo is saved as
+    #       pending and the caller submits it once the row is committed
     @timeit()
-    def save_user_image(self, session, pi: PhotoImage, uid: int, cid: int) -> dict:
+    def save_user_image(self, session, pi: PhotoImage, uid: int, cid: int, pipeline=None) -> dict:
         """everything we need to save a user's image to the image store"""
         err = None
-        if pi._binary_image is None or uid is None or cid is None:
+        if not pi.has_image() or uid is None or cid is None:
+            pi.discard()
             return {'error': error.iiServerErrors.INVALID_ARGS, 'arg': None}
 
         if not category.Category.is_upload_by_id(session, cid):
+            pi.discard()
             return {'error': error.iiServerErrors.INVALID_ARGS, 'arg': None}
 
         self._photoimage = pi
 
-        # okay we have arguments, lets create our file name
-        fn = self.create_storage_name('JPEG')
+        if pipeline is not None:
+            try:
+                with pi.open_image() as f:
+                    Image.open(f) # header only, still reject a bad image up front
+            except Exception as e:
+                pi.discard()
+                raise
 
-        # write to the folder
-        Photo.safe_write_file(fn, pi)
-        self.create_thumb_PIL(fn=None)
+        # streamed uploads were written to our storage path by ingest_image()
+        if pi._stored_file is None:
+            # okay we have arguments, lets create our file name
+            fn = self.create_storage_name('JPEG')
+
+            # write to the folder
+            Photo.safe_write_file(fn, pi)
+        if pipeline is None:
+            self.create_thumb_PIL(fn=None)
+        else:
+            self.active = Photo.ACTIVE_PENDING
 
         # okay, now we need to save all this information to the
         self.user_id  = uid
         self.category_id = cid
+
+        # keep the category's counters in step, the user's first photo makes them an uploader
+        new_uploader = not Photo.has_photos_in_category(session, cid, uid)
+        category.CategoryStats.add(session, cid, photos=1, uploaders=1 if new_uploader else 0)
+        from models import engagement # engagement imports us
+        engagement.UserActivity.record_upload(session, uid)
         session.add(self)
         return {'error': None, 'arg': self.filename}
 
@@ -322,13 +563,16 @@ class Photo(Base):
     # get the raw exif data, not decoding
     @timeit()
     def get_exif_dict(self, pil_img: Image) -> dict:
-        """retrieve the photos EXIF data as a dictionary"""
-        info = pil_img._getexif()
-        if info is None:
+        """
+        retrieve the photos EXIF data as a dictionary, this is the only
+        time we parse the EXIF block, everything else works off the dict
+        """
+        exif_bytes = pil_img.info.get('exif', None)
+        if exif_bytes is None:
             logger.warning(msg='no EXIF data in file, making dummy data file for {0}/{1}'.format(self.filepath, self.filename))
             return self.make_dummy_exif()
 
-        return piexif.load(pil_img.info["exif"])
+        return piexif.load(exif_bytes)
 
     # get the decoded exif data so we can pull out values
     @timeit()
@@ -367,40 +611,30 @@ class Photo(Base):
 
         :return: nothing
         """
-        if self._photoimage is None or self._photoimage._binary_image is None:
+        if self._photoimage is None or not self._photoimage.has_image():
             raise BaseException(errno.EINVAL, "no raw image")
 
-        file_jpegdata = BytesIO(self._photoimage._binary_image)
-        digest = None
+        digest = self._photoimage.md5_digest()
 
-        m = hashlib.md5()
-        m.update(file_jpegdata.getvalue())
-        digest = m.hexdigest()
-        digest = digest.upper()
-
-        pil_img = Image.open(file_jpegdata)
-        exif_dict = self.get_exif_dict(pil_img) # raw data from image
-        exif_data = self.get_exif_data(exif_dict) # key/value pairs reconstituted
-        self.samsung_fix(exif_dict, exif_data)
-        self.set_metadata(exif_data, pil_img.height, pil_img.width, digest) # set metadata about the hi-res Photo
-
-        # Our thumbnail will be scaled down and normalized to an orientation of '1'
-        rotate, flip = self.get_rotation_and_flip_PIL(exif_dict) # make sure we use Samsung fixed data!
-        scalefactor = self.compute_scalefactor(pil_img.height, pil_img.width)
-        new_size = (int(pil_img.width * scalefactor), int(pil_img.height*scalefactor))
-        exif_dict['0th'][0x112] = 1  # we are normalizing to '1' for all thumbnails
+        with self._photoimage.open_image() as file_jpegdata:
+            pil_img = Image.open(file_jpegdata)
+            exif_dict = self.get_exif_dict(pil_img) # raw data from image, parsed once
+            exif_data = self.get_exif_data(exif_dict) # key/value pairs reconstituted
+            self.samsung_fix(exif_dict, exif_data)
+            self.set_metadata(exif_data, pil_img.height, pil_img.width, digest) # set metadata about the hi-res Photo
+
+            # Our thumbnail will be scaled down and normalized to an orientation of '1'
+            th_img = self.scale_and_orient_PIL(pil_img, exif_dict) # make sure we use Samsung fixed data!
+
+        # the thumbnail is what everyone sees, so it only gets its orientation,
+        # which we are normalizing to '1' for all thumbnails. The upload's EXIF
+        # (GPS location included) stays with the original & photometa
         exif_bytes = None
         try:
-            exif_bytes = piexif.dump(exif_dict)
+            exif_bytes = piexif.dump({'0th': {piexif.ImageIFD.Orientation: 1}})
         except Exception as e:
             logger.exception(msg='Error dumping EXIF bytes for file {}'.format(self._full_filename))
 
-        th_img = pil_img.resize(new_size, resample=Image.LANCZOS)
-        if rotate is not None:
-            th_img = th_img.transpose(rotate)
-        if flip is not None:
-            th_img = th_img.transpose(flip)
-
         # from the supplied image, create a thumbnail
         # the original file has already been saved to the
         # filesystem, so we are just adding this file
@@ -474,6 +708,25 @@ class Photo(Base):
     #
     #     return ret_img
 
+    def scale_and_orient_PIL(self, pil_img: Image, exif_dict: dict) -> Image:
+        """
+        Scale the hi-res image down to thumbnail size and orientation '1'.
+        draft() has the JPEG decoder scale in the DCT domain (1/2, 1/4 or 1/8)
+        so we never decode the full resolution image, LANCZOS does the rest
+        from something no smaller than the thumbnail. Has to be called before
+        pil_img is loaded. Non-JPEG images ignore the draft.
+        :return: the thumbnail image
+        """
+        scalefactor = self.compute_scalefactor(pil_img.height, pil_img.width)
+        new_size = (int(pil_img.width * scalefactor), int(pil_img.height*scalefactor))
+        pil_img.draft(pil_img.mode, new_size)
+
+        th_img = pil_img.resize(new_size, resample=Image.LANCZOS)
+        transpose = self.get_transpose_PIL(exif_dict)
+        if transpose is not None:
+            th_img = th_img.transpose(transpose)
+        return th_img
+
     # since Google Cloud storage can be flakey, we need to retry a couple of times. Between each
     # retry we need a random backup, with a maxium wait and # of times we'll retry.
     # so we are waiting for an exception to be thrown, then we go into our retrying...
@@ -645,8 +898,28 @@ class Photo(Base):
 
         return rotate, flip
 
+    def get_transpose_PIL(self, exif_dict: dict):
+        """
+        same as get_rotation_and_flip_PIL() but as the single transpose
+        that does the rotation & flip together (see the table above)
+        :param exif_dict: extracted EXIF dict from image
+        :return: Image transpose method, or None if the image is already orientation '1'
+        """
+        try:
+            orientation = exif_dict['0th'][0x112]
+            return {2: Image.FLIP_LEFT_RIGHT,
+                    3: Image.ROTATE_180,
+                    4: Image.FLIP_TOP_BOTTOM,   # rotate 180 + flip
+                    5: Image.TRANSPOSE,         # rotate 270 + flip
+                    6: Image.ROTATE_270,
+                    7: Image.TRANSVERSE,        # rotate 90 + flip
+                    8: Image.ROTATE_90}.get(orientation, None)
+        except Exception as e:
+            logger.exception(msg="error with EXIF/Orientation data")
+        return None
+
     def get_watermark_font(self) -> ImageFont:
-        # Place the text at (10, 10) in the upper left corner. Text will be white.
+        # Text will be white, placed to the right of the logo at the bottom
         font_path = dbsetup.get_fontname(dbsetup.determine_environment(None))
         font = ImageFont.truetype(font=font_path, size=20)
         return font
@@ -656,62 +929,146 @@ class Photo(Base):
         path = dbsetup.resource_files(dbsetup.determine_environment(None))
         path += '/'
         im = Image.open(path + watermark_file)
+        im.load()
         return im
 
+    def get_watermark_assets(self) -> WatermarkAssets:
+        """the font & logo are read from disk once per process"""
+        with Photo._watermark_lock:
+            if Photo._watermark_assets is None:
+                Photo._watermark_assets = WatermarkAssets(self.get_watermark_font(), self.get_watermark_file())
+            return Photo._watermark_assets
+
     def apply_watermark(self, img: Image) -> Image:
-        # Create a new image for the watermark with an alpha layer (RGBA)
-        #  the same size as the original image
-        watermark = Image.new("RGBA", img.size)
+        wa = self.get_watermark_assets()
+        width, height = img.size
+        im_width, im_height = wa.logo.size
 
-        # Get an ImageDraw object so we can draw on the image
-        waterdraw = ImageDraw.ImageDraw(watermark, "RGBA")
+        # the text sits just right of the logo, its bottom 20 rows are on the image
+        img.paste(im=wa.text, box=(im_width + 5 - wa.text_x, height - 20), mask=wa.text)
+        img.paste(im=wa.logo, box=(0, height - im_height), mask=wa.logo_mask)
+        return img
 
-        font = self.get_watermark_font()
-        im = self.get_watermark_file()
+    @staticmethod
+    def preview_etag(info: dict) -> str:
+        """the ETag of the watermarked thumbnail for read_thumbnail_info()'s info"""
+        return 'wm{0}-{1}'.format(WatermarkAssets.VERSION, info['etag'])
 
-        width, height = img.size
-        im_width, im_height = im.size
-        # f_width, f_height = font.size
-        # image improv "yellow" is #FCBB15, or (252,187, 21)
-        waterdraw.text((im_width + 5, height - 20), "imageimprov", fill=(255, 255, 255, 128), font=font)
-
-        # Get the watermark image as grayscale and fade the image
-        # See <http://www.pythonware.com/library/pil/handbook/image.htm#Image.point>
-        #  for information on the point() function
-        # Note that the second parameter we give to the min function determines
-        #  how faded the image will be. That number is in the range [0, 256],
-        #  where 0 is black and 256 is white. A good value for fading our white
-        #  text is in the range [100, 200].
-        watermask = watermark.convert("L").point(lambda x: min(x, 200))
-        im_mask = im.convert("L").point(lambda x: min(x, 200))
-
-        # Apply this mask to the watermark image, using the alpha filter to
-        #  make it transparent
-        watermark.putalpha(watermask)
-        im.putalpha(im_mask)
-        im_x = 0 # width - (im_width + f_width)
-        im_y = height - im_height
-
-        # Paste the watermark (with alpha layer) onto the original image and save it
-        img.paste(im=watermark, box=None, mask=watermark)
-        img.paste(im=im, box=(im_x, im_y), mask=im_mask)
-        return img
+    def read_preview(self, info: dict) -> bytes:
+        """
+        the watermarked thumbnail for read_thumbnail_info()'s info. The thumbnail
+        never changes, so neither does this, it's memoized by its ETag
+        """
+        key = Photo.preview_etag(info)
+        thumb = _preview_cache.get(key)
+        if thumb is None:
+            main = Image.open(info['thumb_file'])
+            main = self.apply_watermark(main)
+            b = BytesIO()
+            main.save(b, 'JPEG')
+            thumb = b.getvalue()
+            _preview_cache.put(key, thumb)
+        return thumb
+
+    @staticmethod
+    def thumb_url(thumb_hash: str) -> str:
+        """
+        where the client can GET the thumbnail's JPEG bytes, instead of base64 in the JSON.
+        It's keyed by the thumbnail's hash, photo ids are sequential & would let anyone
+        walk every thumbnail. None if the photo has no thumb_hash (older photos)
+        """
+        if thumb_hash is None:
+            return None
+        return '/thumb/{0}'.format(thumb_hash)
+
+    @staticmethod
+    def lease_time():
+        """when a pending photo's lease was last renewed, see ThumbnailMgr"""
+        return sqlalchemy.func.coalesce(Photo.last_updated, Photo.created_date)
+
+    @staticmethod
+    def touch_pending(session, pids: list, older_than: datetime=None) -> int:
+        """
+        renew the lease the thumbnail pipeline holds on pending photos, one UPDATE
+        :param older_than: only photos whose lease is older, to claim stale ones
+        :return: number of photos renewed
+        """
+        if len(pids) == 0:
+            return 0
+        q = session.query(Photo).filter(Photo.id.in_(pids)).filter(Photo.active == Photo.ACTIVE_PENDING)
+        if older_than is not None:
+            q = q.filter(Photo.lease_time() < older_than)
+        return q.update({Photo.last_updated: sqlalchemy.func.now()}, synchronize_session=False)
+
+    @staticmethod
+    def read_thumb_hashes(session, pids: list) -> dict:
+        """:return: pid -> thumb_hash for the photos, one query"""
+        if len(pids) == 0:
+            return {}
+        q = session.query(PhotoMeta.id, PhotoMeta.thumb_hash).filter(PhotoMeta.id.in_(pids))
+        return {pid: thumb_hash for pid, thumb_hash in q.all()}
+
+    @staticmethod
+    def invalidate_thumbnail_info(pid: int, thumb_hash: str=None) -> None:
+        """the photo was de-activated, stop serving its thumbnail from the lookup cache"""
+        for key in [str(pid), thumb_hash]:
+            if key is not None:
+                _shared_cache.expire_key('THUMB_INFO{0}'.format(key.upper()))
+                _shared_cache.expire_key('THUMB_INFO_ANY{0}'.format(key.upper()))
+
+    @staticmethod
+    def read_thumbnail_info(session, key: str, active_only: bool=True) -> dict:
+        """
+        find the thumbnail for /thumb/<key>, where the key is a
+        PhotoMeta.thumb_hash. Only active photos are served, unless active_only
+        is False (/preview), which also looks photos up by id. Pending photos
+        never have a thumbnail. The lookup is cached, a photo's thumbnail never
+        changes, invalidate_thumbnail_info() drops it when a photo is de-activated.
+        :return: {'pid', 'thumb_file', 'etag'} or None if there's no such thumbnail
+        """
+        key = str(key).upper()
+        cache_key = '{0}{1}'.format('THUMB_INFO' if active_only else 'THUMB_INFO_ANY', key)
+        info = _shared_cache.get(cache_key)
+        if info is not None:
+            return info
+
+        q = session.query(Photo, PhotoMeta.thumb_hash)
+        if key.isdigit():
+            if active_only:
+                return None # ids are guessable, /thumb only takes the hash
+            q = q.outerjoin(PhotoMeta, PhotoMeta.id == Photo.id).filter(Photo.id == int(key))
+        elif len(key) == 32 and all(c in '0123456789abcdefABCDEF' for c in key):
+            q = q.join(PhotoMeta, PhotoMeta.id == Photo.id).filter(PhotoMeta.thumb_hash == key)
+            if active_only:
+                q = q.filter(Photo.active == 1)
+        else:
+            return None
+
+        row = q.first()
+        if row is None or row[0].active == Photo.ACTIVE_PENDING or (active_only and row[0].active != 1):
+            return None
+
+        p, thumb_hash = row
+        info = {'pid': p.id, 'thumb_file': p.create_thumb_filename(),
+                'etag': thumb_hash if thumb_hash is not None else 'pid{0}'.format(p.id)}
+        if active_only:
+            # /thumb may hand the file to nginx as stored, make sure the old EXIF is gone first
+            try:
+                Photo.strip_thumbnail_file(info['thumb_file'])
+            except FileNotFoundError:
+                return None
+        _shared_cache.put(cache_key, info, ttl=60*60)
+        return info
 
     def read_thumbnail_by_id_with_watermark(self, session, pid: int) -> bytes:
-        # Open the original image
-        # read our test file
         if pid is None:
             return None
 
         try:
-            p = session.query(Photo).get(pid)
-            t_fn = p.create_thumb_filename()
-            main = Image.open(t_fn)
-            main = self.apply_watermark(main)
-            b = BytesIO()
-            main.save(b, 'JPEG')
-            thumb = b.getvalue()
-            return thumb
+            info = Photo.read_thumbnail_info(session, pid, active_only=False)
+            if info is None:
+                return None
+            return self.read_preview(info)
         except Exception as e:
             logger.exception(msg='error generating watermarked thumbnail! pid={}'.format(pid))
             return None
@@ -727,9 +1084,19 @@ class Photo(Base):
     #     return d
     #
 
+    @staticmethod
+    def row_columns() -> list:
+        """the columns photo_dict() needs, for listings that don't need Photo objects"""
+        return [Photo.id, Photo.category_id, Photo.times_voted, Photo.likes, Photo.score]
+
+    @staticmethod
+    def photo_dict(p) -> dict:
+        """to_dict() for a Photo, or a query row with its id/times_voted/likes/score columns"""
+        return {'pid': p.id, 'votes': p.times_voted, 'likes': p.likes, 'score': p.score, 'url': 'preview/{0}'.format(p.id)}
+
     def to_dict(self) -> dict:
         try:
-            d = {'pid': self.id, 'votes': self.times_voted, 'likes': self.likes, 'score': self.score, 'url': 'preview/{0}'.format(self.id)}
+            d = Photo.photo_dict(self)
             return d
         except Exception as e:
             if self.id is not None:
@@ -746,7 +1113,7 @@ class PhotoMeta(Base):
     orientation = Column(String(500), nullable=True, index=True)
     gps         = Column(String(200), nullable=True)
     j_exif      = Column(String(2000), nullable=True)
-    thumb_hash  = Column(String(64), nullable=True)
+    thumb_hash  = Column(String(64), nullable=True, index=True)   # MD5 of the upload, also the thumbnail's ETag
 
     created_date = Column(DateTime, server_default=text('CURRENT_TIMESTAMP'), nullable=False)
     last_updated = Column(DateTime, nullable=True, server_default=text('CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP') )
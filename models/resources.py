@@ -1,10 +1,12 @@
 """ for language mapping"""
-from sqlalchemy import Column, Integer, String, DateTime, text
+import time
+import threading
+from datetime import timedelta
+from sqlalchemy import Column, Integer, String, DateTime, text, or_
 from logsetup import logger
+import dbsetup
 from dbsetup import Base
 
-RESOURCE_MAP = None
-
 
 class Resource(Base):
     """manages language mapping"""
@@ -39,9 +41,7 @@ class Resource(Base):
     @staticmethod
     def load_resources(session):
         """load resources. get it all (probably for caching)"""
-        # let's read the entire table in
-        global RESOURCE_MAP
-        RESOURCE_MAP = session.query(Resource).all()
+        RESOURCE_MAP.load(session)
 
     @staticmethod
     def create_resource(rid: int, language: str, resource_str: str):
@@ -75,3 +75,160 @@ class Resource(Base):
             logger.exception(msg="error creating new resource")
             session.close()
             raise
+
+
+class ResourceMap():
+    """
+    The resource strings, and which resources tag each category, in memory.
+    Category descriptions & tags are read for every category in every list,
+    so they're dictionary reads here instead of a query (and a session) each.
+
+    The first lookup reads both tables, after that every REFRESH_INTERVAL
+    seconds we read just the strings changed since the newest last_updated
+    we've seen (less a little overlap for rows committed late, re-reading is
+    harmless) and the (category, resource) pairs of every tag, two int columns,
+    so deleted tags drop out. Every FULL_RELOAD_INTERVAL seconds the strings
+    are read again from scratch, which drops deleted ones.
+    Strings we don't have yet (created since the refresh) are read on a miss,
+    a string that isn't there is remembered for MISS_TTL seconds. A category
+    without tags is read once & remembered until the next refresh.
+    """
+    REFRESH_INTERVAL = 60
+    FULL_RELOAD_INTERVAL = 15 * 60
+    MISS_TTL = 60
+    _OVERLAP = timedelta(seconds=60)
+
+    def __init__(self, **kwargs):
+        self._f_session = kwargs.get('f_session', None)
+        self._refresh_interval = kwargs.get('refresh_interval', self.REFRESH_INTERVAL)
+        self._full_reload_interval = kwargs.get('full_reload_interval', self.FULL_RELOAD_INTERVAL)
+        self._miss_ttl = kwargs.get('miss_ttl', self.MISS_TTL)
+        self._lock = threading.Lock()
+        self._strings = {}      # (resource_id, iso639_1) -> resource_string
+        self._missing = {}      # (resource_id, iso639_1) -> time.time() we looked & it wasn't there
+        self._tags = {}         # category id -> [resource_id]
+        self._version = None    # newest last_updated we've read
+        self._checked = 0       # time.time() of the last refresh
+        self._loaded = 0        # time.time() of the last full read
+        self._hits = 0
+        self._misses = 0
+
+    def _new_session(self):
+        if self._f_session is not None:
+            return self._f_session()
+        return dbsetup.Session()
+
+    @staticmethod
+    def _newest(version, rows) -> object:
+        for row in rows:
+            ts = row.last_updated if row.last_updated is not None else row.created_date
+            if ts is not None and (version is None or ts > version):
+                version = ts
+        return version
+
+    def _read(self, session, since) -> None:
+        """since=None reads every string, the maps are swapped in whole so readers never see half of one"""
+        from models import category # category imports us
+
+        q = session.query(Resource)
+        if since is not None:
+            q = q.filter(or_(Resource.last_updated >= since - self._OVERLAP, Resource.created_date >= since - self._OVERLAP))
+        rows = q.all()
+        strings = {} if since is None else dict(self._strings)
+        for r in rows:
+            strings[(r.resource_id, r.iso639_1)] = r.resource_string
+
+        tags = {}
+        for cid, rid in session.query(category.CategoryTag.cid, category.CategoryTag.resource_id).all():
+            tags.setdefault(cid, []).append(rid)
+
+        now = time.time()
+        self._strings = strings
+        self._missing = {}
+        self._tags = tags
+        if since is None:
+            self._version = None
+            self._loaded = now
+        self._version = self._newest(self._version, rows)
+        self._checked = now
+
+    def load(self, session) -> None:
+        """read everything"""
+        with self._lock:
+            self._read(session, None)
+
+    def refresh(self, session=None) -> None:
+        """read what has changed since the last time, everything the first time & every FULL_RELOAD_INTERVAL"""
+        with self._lock:
+            close = session is None
+            if close:
+                session = self._new_session()
+            try:
+                full = self._version is None or time.time() - self._loaded > self._full_reload_interval
+                self._read(session, None if full else self._version)
+            except Exception as e:
+                self._checked = time.time() # try again next interval, we still have what we had
+                logger.exception(msg='error refreshing resource map')
+            finally:
+                if close:
+                    session.close()
+
+    def _refresh_if_due(self, session) -> None:
+        if time.time() - self._checked > self._refresh_interval:
+            self.refresh(session)
+
+    def get_string(self, rid: int, lang: str='EN', session=None) -> str:
+        """the resource string, or None if there isn't one"""
+        self._refresh_if_due(session)
+        s = self._strings.get((rid, lang))
+        if s is not None:
+            self._hits += 1
+            return s
+
+        self._misses += 1
+        missed = self._missing.get((rid, lang))
+        if missed is not None and time.time() - missed < self._miss_ttl:
+            return None
+
+        close = session is None
+        if close:
+            session = self._new_session()
+        try:
+            r = Resource.load_resource_by_id(session, rid, lang)
+            if r is None:
+                self._missing[(rid, lang)] = time.time()
+                return None
+            self._strings[(rid, lang)] = r.resource_string
+            return r.resource_string
+        finally:
+            if close:
+                session.close()
+
+    def get_tags(self, cid: int, session, lang: str='EN') -> list:
+        """the tag strings for a category"""
+        from models import category # category imports us
+
+        self._refresh_if_due(session)
+        rids = self._tags.get(cid)
+        if rids is None:
+            self._misses += 1
+            rids = [ct.resource_id for ct in session.query(category.CategoryTag).filter(category.CategoryTag.cid == cid).all()]
+            self._tags[cid] = rids
+        else:
+            self._hits += 1
+
+        tags = []
+        for rid in rids:
+            s = self.get_string(rid, lang, session)
+            if s is not None:
+                tags.append(s)
+        return tags
+
+    def stats(self) -> dict:
+        return {'strings': len(self._strings), 'categories_tagged': len(self._tags),
+                'version': None if self._version is None else str(self._version),
+                'hits': self._hits, 'misses': self._misses}
+
+
+# one per worker process, loaded on first use
+RESOURCE_MAP = ResourceMap()
@@ -11,6 +11,8 @@ from flask import jsonify
 from models import admin
 from dbsetup import Session, Base
 from logsetup import logger
+from cache.ExpiryCache import _expiry_cache
+from cache.SharedCache import _shared_cache
 
 
 class UserType(Enum):
@@ -42,9 +44,39 @@ class AnonUser(Base):
     usertype = Column(Integer, default=UserType.PLAYER.value)
     created_date = Column(DateTime, server_default=text('CURRENT_TIMESTAMP'), nullable=False)
 
+    # identity() snapshots, per worker & short lived, see invalidate_identity()
+    IDENTITY_KEY = 'IDENTITY{0}'
+    IDENTITY_TTL = 30
+
     def __init__(self, *args, **kwargs):
         self.id = kwargs.get('uid')
 
+    def snapshot(self) -> dict:
+        """the column values, so we can cache the user without holding on to an ORM object"""
+        return {'id': self.id, 'guid': self.guid, 'base_id': self.base_id,
+                'usertype': self.usertype, 'created_date': self.created_date}
+
+    @staticmethod
+    def from_snapshot(d: dict):
+        """
+        a new detached AnonUser for every request, so a handler that adds it
+        to its session doesn't share an instance with other requests (and
+        doesn't INSERT it)
+        """
+        au = AnonUser(uid=d['id'])
+        au.guid = d['guid']
+        au.base_id = d['base_id']
+        au.usertype = d['usertype']
+        au.created_date = d['created_date']
+        orm.make_transient_to_detached(au)
+        return au
+
+    @staticmethod
+    def invalidate_identity(uid: int) -> None:
+        """the user's usertype/base_id/login changed, every worker drops its identity snapshot"""
+        if uid is not None:
+            _shared_cache.expire_key(AnonUser.IDENTITY_KEY.format(uid))
+
     @staticmethod
     def find_anon_user(session: orm.Session, m_guid: str):
         """find the anonymous user by their guid identifier"""
@@ -154,6 +186,7 @@ class User(Base):
     def change_password(self, session: orm.Session, password: str) -> None:
         """update the users password"""
         self.hashedPWD = pbkdf2_sha256.hash(password, rounds=1000, salt_size=16)
+        AnonUser.invalidate_identity(self.id)
 
     @staticmethod
     def create_user(session: orm.Session, guid: str, username: str, password: str):
@@ -183,6 +216,7 @@ class User(Base):
 
         # Now write the new users to the database
         session.add(new_user)
+        AnonUser.invalidate_identity(new_user.id)
         return new_user # return the "root" user, which is the anon users for this account
 
 #
@@ -228,11 +262,21 @@ def identity(payload: dict):
     """extract the user identifier from the JWT payload and find
     our user account"""
     # called with decrypted payload to establish identity
-    # based on a user id
+    # based on a user id. Every authenticated request comes through here,
+    # so we keep a snapshot of the user for a little while
     user_id = payload['identity']
+    key = AnonUser.IDENTITY_KEY.format(user_id)
+    d = _expiry_cache.get(key)
+    if d is not None:
+        return AnonUser.from_snapshot(d)
+
     session = Session()
-    anonymous_user = AnonUser.get_anon_user_by_id(session, user_id)
-    session.close()
+    try:
+        anonymous_user = AnonUser.get_anon_user_by_id(session, user_id)
+        if anonymous_user is not None:
+            _expiry_cache.put(key, anonymous_user.snapshot(), ttl=AnonUser.IDENTITY_TTL)
+    finally:
+        session.close()
     return anonymous_user
 
 def auth_response_handler(access_token, identity):
@@ -379,6 +423,7 @@ class UserAuth(Base):
             registered_user = User.create_user(session, guid, service_provider_email, oauth2_accesstoken)
             session.commit()
             if registered_user is not None:
+                AnonUser.invalidate_identity(registered_user.id)
                 logger.info(msg='Created account for serviceprovider {0}, email {1}'.format(service_provider, service_provider_email))
             else:
                 logger.error(msg='Error creating account for serviceprovider {0}, email {1}'.format(service_provider, service_provider_email))
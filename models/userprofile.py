@@ -1,5 +1,6 @@
 from dbsetup import Base
 import os, os.path, errno
+from sqlalchemy import or_, and_
 import dbsetup
 from models import category, usermgr, photo
 from models import engagement, voting
@@ -25,49 +26,54 @@ class Submissions():
         self._photos_for_categories = kwargs.get('p_cat', self.photos_for_categories)
 
     def categories_with_user_photos(self, session, dir: str, cid: int, num_categories: int) -> list:
-
+        """
+        the next page of categories the user has photos in, after (or before) cid.
+        The paging is done in SQL on the photo table's (user_id, category_id) index,
+        then just those categories are read
+        """
+        q = session.query(photo.Photo.category_id).filter(photo.Photo.user_id == self._uid)
         if dir == 'next':
-            e = session.query(category.Category.id).filter(category.Category.id > cid). \
-                join(photo.Photo, photo.Photo.category_id == category.Category.id). \
-                filter(photo.Photo.user_id == self._uid). \
-                order_by(category.Category.id.asc()). \
-                distinct(category.Category.id)
-
-            q = session.query(category.Category).filter(category.Category.id.in_(e)). \
-                order_by(category.Category.id.asc())
+            q = q.filter(photo.Photo.category_id > cid).order_by(photo.Photo.category_id.asc())
         else:
-            e = session.query(category.Category.id).filter(category.Category.id < cid). \
-                join(photo.Photo, photo.Photo.category_id == category.Category.id). \
-                filter(photo.Photo.user_id == self._uid). \
-                order_by(category.Category.id.desc()) . \
-                distinct(category.Category.id)
+            q = q.filter(photo.Photo.category_id < cid).order_by(photo.Photo.category_id.desc())
+        q = q.group_by(photo.Photo.category_id)
+        if num_categories is not None:
+            q = q.limit(num_categories)
 
-            q = session.query(category.Category).filter(category.Category.id.in_(e)). \
-                order_by(category.Category.id.desc())
-
-        cl = q.all()
-        if cl is None or len(cl) == 0:
+        cids = [row[0] for row in q.all()]
+        if len(cids) == 0:
             return None
 
-        if num_categories is None or num_categories >= len(cl):
-            return cl
-
-        return cl[:num_categories]
-
-    def photos_for_categories(self, session, dir: str, cid: int) -> list:
+        categories = {c.id: c for c in session.query(category.Category).filter(category.Category.id.in_(cids)).all()}
+        return [categories[c_id] for c_id in cids if c_id in categories]
 
+    def photos_for_categories(self, session, dir: str, cid: int, end_cid: int=None) -> list:
+        """
+        the user's photos in categories after (or before) cid, up to & including
+        end_cid (the last category of the page), ordered by category. Just the
+        columns we return, not Photo objects
+        """
+        q = session.query(photo.Photo.id, photo.Photo.category_id, photo.Photo.times_voted,
+                          photo.Photo.likes, photo.Photo.score).filter(photo.Photo.user_id == self._uid)
         if dir == 'next':
-            q = session.query(photo.Photo).filter(photo.Photo.user_id == self._uid) .\
-                join(category.Category, category.Category.id == photo.Photo.category_id). \
-                filter(category.Category.id > cid)
+            q = q.filter(photo.Photo.category_id > cid)
+            if end_cid is not None:
+                q = q.filter(photo.Photo.category_id <= end_cid)
+            q = q.order_by(photo.Photo.category_id.asc(), photo.Photo.id.asc())
         else:
-            q = session.query(photo.Photo).filter(photo.Photo.user_id == self._uid) .\
-                join(category.Category, category.Category.id == photo.Photo.category_id). \
-                filter(category.Category.id < cid)
+            q = q.filter(photo.Photo.category_id < cid)
+            if end_cid is not None:
+                q = q.filter(photo.Photo.category_id >= end_cid)
+            q = q.order_by(photo.Photo.category_id.desc(), photo.Photo.id.asc())
         pl = q.all()
         return pl
 
     def get_user_submissions(self, session, dir: str, cid: int, num_categories: int) -> dict:
+        """
+        a page of the user's submissions, num_categories categories (all if None)
+        after/before cid. If there are more the 'cursor' is where the next page
+        starts: /submissions/<cursor dir>/<cursor cid>
+        """
         if self._uid is None:
             raise Exception("no user specified")
 
@@ -81,99 +87,114 @@ class Submissions():
         user_info = {'id': self._uid, 'created_date': str(anonymous_user.created_date)}
         return_dict = {'user': user_info}
 
-        # get all the categories we care about
-        category_list = self._categories_with_user_photos(session, dir, cid, num_categories)
-        if category_list is not None:
-            photo_list = self._photos_for_categories(session, dir, cid)
-            for c in category_list:
-                # create category's photo list
-                category_photo_list = []
-                for photo in photo_list:
-                    if photo.category_id == c.id:
-                        p_element = photo.to_dict()
-                        category_photo_list.append(p_element)
-
-                if category_photo_list:
-                    category_dict = {'id':c.id, 'description':c.get_description(), 'end': str(c.end_date), 'start': str(c.start_date), 'state': category.CategoryState.to_str(c.state)}
-                    category_submission = {'category': category_dict, 'photos': category_photo_list}
-                    return_dict.setdefault('submissions',[]).append(category_submission)
-
+        # get the page of categories, ask for one more so we know if there's another page
+        category_list = self._categories_with_user_photos(session, dir, cid, None if num_categories is None else num_categories + 1)
+        if category_list is None:
+            return return_dict
+
+        more = num_categories is not None and len(category_list) > num_categories
+        if more:
+            category_list = category_list[:num_categories]
+
+        # just the photos for this page, grouped by category in one pass
+        end_cid = category_list[-1].id if more else None
+        category_photos = {}
+        for p in self._photos_for_categories(session, dir, cid, end_cid):
+            category_photos.setdefault(p.category_id, []).append(photo.Photo.photo_dict(p))
+
+        for c in category_list:
+            category_photo_list = category_photos.get(c.id)
+            if category_photo_list:
+                category_dict = {'id':c.id, 'description':c.get_description(), 'end': str(c.end_date), 'start': str(c.start_date), 'state': category.CategoryState.to_str(c.state)}
+                category_submission = {'category': category_dict, 'photos': category_photo_list}
+                return_dict.setdefault('submissions',[]).append(category_submission)
+
+        if more:
+            return_dict['cursor'] = {'dir': dir, 'cid': category_list[-1].id}
         return return_dict
 
     @staticmethod
-    def get_user_likes(session, au: usermgr.AnonUser, dir: str, cid: int) -> list:
+    def liked_photos(session, uid: int, dir: str, cid: int, pid: int=None, limit: int=_MAX_PHOTOS_TO_RETURN) -> list:
         """
-        returns a list of the photos a user "likes" as list of
-        jsonifyable dictionary elements
-
-        dir - next/prev direction from specified photo_id (pid)
-        cid - category to start next/prev search, non-inclusive
-        :return:
+        the next 'limit' photos the user likes after (or before) category cid,
+        ordered by category then photo. If pid is specified we resume in category
+        cid after photo pid. The feedback is read through its (user_id, like,
+        category_id, photo_id) index, so this costs the same however many photos
+        the user likes. Returns rows, not Photo objects
         """
+        q = session.query(photo.Photo.id, engagement.Feedback.category_id, photo.Photo.times_voted,
+                          photo.Photo.likes, photo.Photo.score). \
+            select_from(engagement.Feedback). \
+            join(photo.Photo, photo.Photo.id == engagement.Feedback.photo_id). \
+            filter(engagement.Feedback.user_id == uid). \
+            filter(engagement.Feedback.like == True)
+
+        fb = engagement.Feedback
         if dir == 'next':
-            q = session.query(photo.Photo).filter(photo.Photo.category_id > cid). \
-                join(engagement.Feedback, engagement.Feedback.photo_id == photo.Photo.id). \
-                filter(engagement.Feedback.like > 0). \
-                filter(engagement.Feedback.user_id == au.id)
-            pl = q.all()
-
-            # now get the categories...
-            q = session.query(category.Category). \
-                filter(category.Category.id > cid). \
-                join(photo.Photo, photo.Photo.category_id == category.Category.id). \
-                join(engagement.Feedback, engagement.Feedback.photo_id == photo.Photo.id). \
-                filter(engagement.Feedback.like > 0). \
-                filter(engagement.Feedback.user_id == au.id). \
-                order_by(category.Category.id.asc())
-
+            if pid is None:
+                q = q.filter(fb.category_id > cid)
+            else:
+                q = q.filter(or_(fb.category_id > cid, and_(fb.category_id == cid, fb.photo_id > pid)))
+            q = q.order_by(fb.category_id.asc(), fb.photo_id.asc())
         else:
-            q = session.query(photo.Photo).filter(photo.Photo.category_id < cid). \
-                join(engagement.Feedback, engagement.Feedback.photo_id == photo.Photo.id). \
-                filter(engagement.Feedback.like > 0). \
-                filter(engagement.Feedback.user_id == au.id)
-            pl = q.all()
-
-            # now get the categories...
-            q = session.query(category.Category). \
-                filter(category.Category.id < cid). \
-                join(photo.Photo, photo.Photo.category_id == category.Category.id). \
-                join(engagement.Feedback, engagement.Feedback.photo_id == photo.Photo.id). \
-                filter(engagement.Feedback.like > 0). \
-                filter(engagement.Feedback.user_id == au.id). \
-                order_by(category.Category.id.desc())
-
-        # okay we have a list of photos, now we need the categories for these photos...
-        if pl is None:
-            return None
-        if len(pl) == 0:
-            return None
+            if pid is None:
+                q = q.filter(fb.category_id < cid)
+            else:
+                q = q.filter(or_(fb.category_id < cid, and_(fb.category_id == cid, fb.photo_id < pid)))
+            q = q.order_by(fb.category_id.desc(), fb.photo_id.desc())
 
-        # okay we have some photos, which means we have some categories to fetch
-        cl = q.all()
-        if cl is None:
-            return None
-        if len(cl) == 0:
+        return q.limit(limit).all()
+
+    @staticmethod
+    def get_user_likes(session, au: usermgr.AnonUser, dir: str, cid: int, pid: int=None) -> dict:
+        """
+        returns a page of the photos a user "likes", grouped by category, as
+        jsonifyable dictionary elements. A page is at most _MAX_PHOTOS_TO_RETURN
+        photos & ends on a whole category, unless one category has more photos
+        than that. If there are more the 'cursor' says where the next page starts.
+
+        dir - next/prev direction from specified category
+        cid - category to start next/prev search, non-inclusive
+        pid - resume in category cid after this photo (from a cursor)
+        :return: {'likes': [], 'cursor': {'dir', 'cid', 'pid'}} or None if there are no more
+        """
+        rows = Submissions.liked_photos(session, au.id, dir, cid, pid, _MAX_PHOTOS_TO_RETURN + 1)
+        if len(rows) == 0:
             return None
 
-        # okay we have photos and categories, so we need to create our dictionary
+        cursor = None
+        if len(rows) > _MAX_PHOTOS_TO_RETURN:
+            next_row = rows[_MAX_PHOTOS_TO_RETURN]
+            rows = rows[:_MAX_PHOTOS_TO_RETURN]
+            if rows[-1].category_id != next_row.category_id:
+                cursor = {'dir': dir, 'cid': rows[-1].category_id}
+            else:
+                # the last category doesn't fit, leave it for the next page
+                whole = [r for r in rows if r.category_id != next_row.category_id]
+                if len(whole) > 0:
+                    rows = whole
+                    cursor = {'dir': dir, 'cid': rows[-1].category_id}
+                else:
+                    cursor = {'dir': dir, 'cid': next_row.category_id, 'pid': rows[-1].id}
+
+        # group by category in one pass, the rows are in category order
+        cids = []
+        category_photos = {}
+        for p in rows:
+            if p.category_id not in category_photos:
+                cids.append(p.category_id)
+            p_element = {'pid': p.id, 'votes': p.times_voted, 'likes': p.likes, 'score': p.score,
+                         'url': 'preview/{0}'.format(p.id), 'username':'tbd', 'isfriend': False}
+            category_photos.setdefault(p.category_id, []).append(p_element)
+
+        categories = {c.id: c for c in session.query(category.Category).filter(category.Category.id.in_(cids)).all()}
         r = []
-        num_photos = 0
-        for c in cl:
-            c_dict = c.to_json() # get jsonifyable dictionary
-            p_dicts = []
-            for p in pl:
-                if c.id == p.category_id:
-                    p_element = {'pid': p.id, 'votes': p.times_voted, 'likes': p.likes, 'score': p.score,
-                                 'url': 'preview/{0}'.format(p.id), 'username':'tbd', 'isfriend': False}
-                    p_dicts.append(p_element)
-
-            # okay, if we have photos, create a dictionary element
-            if len(p_dicts) > 0:
-                element = {'category': c_dict, 'photos': p_dicts}
-                r.append(element)
-                num_photos = num_photos + len(p_dicts)
-                if num_photos >= _MAX_PHOTOS_TO_RETURN:
-                    return dict({'likes':r})
-
-        return dict({'likes': r})
-
+        for c_id in cids:
+            c = categories.get(c_id)
+            if c is not None:
+                r.append({'category': c.to_json(), 'photos': category_photos[c_id]})
+
+        d = dict({'likes': r})
+        if cursor is not None:
+            d['cursor'] = cursor
+        return d
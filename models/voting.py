@@ -58,9 +58,24 @@ class Ballot(Base):
     def append_ballotentry(self, be) -> None:
         self._ballotentries.append(be)
 
-    def read_photos_for_ballots(self, session) -> None:
+    def read_photos_for_ballots(self, session, thumb_urls: bool=False) -> None:
+        """
+        make sure every entry has its photo, entries created by
+        add_photos_to_ballot() already do, the rest are read in one query.
+        thumb_urls=True also reads the thumb_hashes for the 'thumb' URLs, one query
+        """
+        if thumb_urls:
+            hashes = photo.Photo.read_thumb_hashes(session, [be.photo_id for be in self._ballotentries])
+            for be in self._ballotentries:
+                be._thumb_hash = hashes.get(be.photo_id, None)
+
+        missing = [be.photo_id for be in self._ballotentries if be._photo is None]
+        if len(missing) == 0:
+            return
+        photos = {p.id: p for p in session.query(photo.Photo).filter(photo.Photo.id.in_(missing)).all()}
         for be in self._ballotentries:
-            be._photo = session.query(photo.Photo).get(be.photo_id)
+            if be._photo is None:
+                be._photo = photos.get(be.photo_id, None)
 
     def append_tags_to_entries(self, c: category.Category) -> None:
         if len(c._categorytags) == 0:
@@ -81,11 +96,11 @@ class Ballot(Base):
 
         return str_ballots
 
-    def to_json(self) -> list:
+    def to_json(self, thumb_urls: bool=False) -> list:
 
         ballots = []
         for be in self._ballotentries:
-            ballots.append(be.to_json())
+            ballots.append(be.to_json(thumb_urls))
         return ballots
 
     @staticmethod
@@ -113,6 +128,7 @@ class BallotEntry(Base):
     _b64image = None
     _binary_image = None
     _tags = None
+    _thumb_hash = None
 
     def __init__(self, **kwargs):
         self.id = kwargs.get('ballotentry_id', None)
@@ -127,20 +143,26 @@ class BallotEntry(Base):
         self._binary_image = None
 
 
-    def to_json(self) -> dict:
+    def to_json(self, thumb_urls: bool=False) -> dict:
+        """
+        :param thumb_urls: True -> 'thumb' is the URL of the thumbnail rather than 'image' the base64 thumbnail,
+        needs the _thumb_hash from Ballot.read_photos_for_ballots(), photos without one still get 'image'
+        """
         if self._photo is None:
             return None
 
-        self._b64image = self._photo.read_thumbnail_b64_utf8()
-
         votes = self._photo.times_voted
         likes = self._photo.likes
         score = self._photo.score
         try:
-            if self._tags is None:
-                d = dict({'bid': self.id, 'orientation': 1, 'votes': votes, 'likes': likes, 'score': score,'image': self._b64image})
+            d = dict({'bid': self.id, 'orientation': 1, 'votes': votes, 'likes': likes, 'score': score})
+            if self._tags is not None:
+                d['tags'] = self._tags.to_str()
+            if thumb_urls and self._thumb_hash is not None:
+                d['thumb'] = photo.Photo.thumb_url(self._thumb_hash)
             else:
-                d = dict({'bid':self.id, 'orientation': 1, 'votes': votes, 'likes': likes, 'score': score, 'tags': self._tags.to_str(), 'image':self._b64image})
+                self._b64image = self._photo.read_thumbnail_b64_utf8()
+                d['image'] = self._b64image
         except Exception as e:
             raise
 
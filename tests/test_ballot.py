@@ -1,14 +1,306 @@
+from unittest import TestCase
 import initschema
 import datetime
+import dbsetup
+import sqlalchemy
 
 from models import resources
 from models import usermgr
-from models import category, voting, photo
+from models import category, voting, photo, engagement
 from tests import DatabaseTest
 import os
 from leaderboard.leaderboard import Leaderboard
 from controllers import BallotMgr
 
+
+class FakeZSetRedis(object):
+    """the sorted set commands BallotQueue uses, in memory"""
+
+    def __init__(self):
+        self.zsets = {}
+        self.ttls = {}
+        self.strings = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def exists(self, name):
+        return name in self.zsets or name in self.strings
+
+    def delete(self, name):
+        self.zsets.pop(name, None)
+        self.strings.pop(name, None)
+        self.ttls.pop(name, None)
+
+    def set(self, name, value, ex=None):
+        self.strings[name] = value
+        self.ttls[name] = ex
+
+    def rename(self, src, dst):
+        self.zsets[dst] = self.zsets.pop(src)
+        self.ttls.pop(dst, None)
+
+    def expire(self, name, seconds):
+        self.ttls[name] = seconds
+
+    def ttl(self, name):
+        if not self.exists(name):
+            return -2
+        return self.ttls.get(name, -1)
+
+    def zincrby(self, name, value, amount=1):
+        z = self.zsets.setdefault(name, {})
+        z[value] = z.get(value, 0) + amount
+
+    def zrem(self, name, *values):
+        for v in values:
+            self.zsets.get(name, {}).pop(v, None)
+
+    def execute_command(self, *args):
+        assert(args[0] == 'ZADD' and args[2] == 'NX')
+        z = self.zsets.setdefault(args[1], {})
+        if args[4] not in z:
+            z[args[4]] = args[3]
+
+    def _sorted(self, name):
+        return sorted(self.zsets.get(name, {}).items(), key=lambda kv: (kv[1], kv[0]))
+
+    def zrange(self, name, start, end, withscores=False):
+        items = self._sorted(name)
+        items = items[start:] if end == -1 else items[start:end + 1]
+        return [(k.encode('utf-8'), float(v)) for k, v in items] if withscores else [k.encode('utf-8') for k, v in items]
+
+    def zcount(self, name, lo, hi):
+        return len([1 for k, v in self._sorted(name) if lo <= v <= hi])
+
+    def zrangebyscore(self, name, lo, hi, start=None, num=None, withscores=False):
+        exclusive = isinstance(lo, str) and lo.startswith('(')
+        lo = float(lo[1:]) if exclusive else float(lo)
+        hi = float('inf') if hi == '+inf' else float(hi)
+        items = [(k, v) for k, v in self._sorted(name) if (v > lo if exclusive else v >= lo) and v <= hi]
+        if start is not None:
+            items = items[start:start + num]
+        return [(k.encode('utf-8'), float(v)) for k, v in items] if withscores else [k.encode('utf-8') for k, v in items]
+
+
+class FakePipeline(object):
+    def __init__(self, conn):
+        self._conn = conn
+        self._calls = []
+
+    def __getattr__(self, name):
+        def queue_call(*args, **kwargs):
+            self._calls.append((name, args, kwargs))
+        return queue_call
+
+    def execute(self):
+        return [getattr(self._conn, name)(*args, **kwargs) for name, args, kwargs in self._calls]
+
+
+class FakeHashRedis(object):
+    """the hash & string commands VoteableCategoryIndex uses, in memory"""
+
+    def __init__(self):
+        self.store = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def exists(self, name):
+        return name in self.store
+
+    def delete(self, name):
+        self.store.pop(name, None)
+
+    def expire(self, name, seconds):
+        pass
+
+    def set(self, name, value, ex=None):
+        self.store[name] = value
+
+    def hmset(self, name, mapping):
+        self.store.setdefault(name, {}).update({str(k): v for k, v in mapping.items()})
+
+    def hincrby(self, name, key, amount=1):
+        h = self.store.setdefault(name, {})
+        h[str(key)] = int(h.get(str(key), 0)) + amount
+
+    def hgetall(self, name):
+        return {k.encode('utf-8'): str(v).encode('utf-8') for k, v in self.store.get(name, {}).items()}
+
+
+class TestBallotQueue(TestCase):
+
+    class P(object):
+        def __init__(self, pid, uid):
+            self.id = pid
+            self.user_id = uid
+
+    def test_draw_least_seen_first(self):
+        bq = BallotMgr.BallotQueue(1, FakeZSetRedis())
+        rows = [(pid, 100 + pid % 3, 0 if pid < 10 else 5) for pid in range(1, 40)]
+        bq.build_from_rows(rows)
+
+        drawn = bq.draw(uid=999, count=4)
+        assert(len(drawn) == 4)
+        assert(all(pid < 10 for pid, owner in drawn))
+        assert(len(set(drawn)) == 4)
+
+    def test_draw_excludes_voter(self):
+        bq = BallotMgr.BallotQueue(1, FakeZSetRedis())
+        rows = [(pid, 7 if pid <= 5 else 8, 0) for pid in range(1, 10)]
+        bq.build_from_rows(rows)
+        for i in range(20):
+            drawn = bq.draw(uid=7, count=4)
+            assert(len(drawn) == 4)
+            assert(all(owner != 7 for pid, owner in drawn))
+
+    def test_draw_spills_into_next_bucket(self):
+        bq = BallotMgr.BallotQueue(1, FakeZSetRedis())
+        bq.build_from_rows([(1, 10, 0), (2, 11, 0), (3, 12, 3), (4, 13, 7), (5, 14, 9)])
+        drawn = bq.draw(uid=99, count=4)
+        assert(sorted(pid for pid, owner in drawn) == [1, 2, 3, 4])
+
+    def test_record_ballot(self):
+        conn = FakeZSetRedis()
+        bq = BallotMgr.BallotQueue(1, conn)
+        bq.build_from_rows([(1, 10, 0), (2, 11, 0), (3, 12, 0), (4, 13, 0), (5, 14, 0)])
+        bq.record_ballot([self.P(1, 10), self.P(2, 11), self.P(3, 12), self.P(4, 13)])
+        drawn = bq.draw(uid=99, count=1)
+        assert(drawn == [(5, 14)])
+
+        # queue went away, don't create a partial one
+        conn.delete(bq.queue_name())
+        bq.record_ballot([self.P(1, 10)])
+        assert(not conn.exists(bq.queue_name()))
+
+    def test_section_queues_separate(self):
+        conn = FakeZSetRedis()
+        q0 = BallotMgr.BallotQueue(1, conn, section=0)
+        q1 = BallotMgr.BallotQueue(1, conn, section=1)
+        assert(q0.queue_name() != q1.queue_name())
+        q0.build_from_rows([(1, 10, 0), (2, 11, 0)])
+        q1.build_from_rows([(3, 12, 0), (4, 13, 0)])
+        assert(sorted(pid for pid, owner in q0.draw(uid=99, count=4)) == [1, 2])
+        assert(sorted(pid for pid, owner in q1.draw(uid=99, count=4)) == [3, 4])
+
+    def test_draw_merged_least_seen_across_sections(self):
+        conn = FakeZSetRedis()
+        big = BallotMgr.BallotQueue(1, conn, section=0)
+        small = BallotMgr.BallotQueue(1, conn, section=1)
+        big.build_from_rows([(pid, 100, 1) for pid in range(1, 30)])
+        small.build_from_rows([(50, 100, 0), (51, 100, 2)])
+
+        # the big section comes first, but the small section's unseen photo is drawn before any of its photos
+        drawn = BallotMgr.BallotQueue.draw_merged([big, small], uid=999, count=4)
+        assert(drawn[0][0] == 50 and drawn[0][2] is small)
+        assert(all(q is big for pid, owner, q in drawn[1:]))
+        assert(len(drawn) == 4)
+
+        # everything, in times-seen order
+        drawn = BallotMgr.BallotQueue.draw_merged([big, small], uid=999, count=40)
+        assert(len(drawn) == 31 and drawn[-1][0] == 51)
+
+    def test_sections_built_marker(self):
+        conn = FakeZSetRedis()
+        assert(not BallotMgr.BallotQueue.sections_built(1, conn))
+        # only the last section has photos, the others have no queue at all
+        last = voting._NUM_SECTONS_ROUND2 - 1
+        BallotMgr.BallotQueue.build_sections_from_rows(1, conn, [(1, 10, last, 0), (2, 11, last, None)])
+        assert(BallotMgr.BallotQueue.sections_built(1, conn))
+        assert(BallotMgr.BallotQueue(1, conn, section=0).queue_name() not in conn.zsets)
+        assert(sorted(pid for pid, owner in BallotMgr.BallotQueue(1, conn, section=last).draw(uid=99, count=4)) == [1, 2])
+        assert(not BallotMgr.BallotQueue.sections_built(2, conn))
+
+    def test_drawn_sections_per_manager(self):
+        bm1 = BallotMgr.BallotManager()
+        bm2 = BallotMgr.BallotManager()
+        bm1._drawn_sections[1] = 0
+        assert(bm2._drawn_sections == {})
+
+    def test_add_activated_photo(self):
+        conn = FakeZSetRedis()
+        bq = BallotMgr.BallotQueue(1, conn)
+        bq.add_photo(50, 150)
+        assert(not bq.exists()) # left for build()
+
+        bq.build_from_rows([(pid, 100, 3) for pid in range(1, 10)])
+        bq.add_photo(50, 150)
+        assert([pid for pid, owner in bq.draw(uid=999, count=1)] == [50]) # least seen
+
+        bq.record_ballot([self.P(50, 150)] * 5)
+        bq.add_photo(50, 150) # already queued, keeps its times-seen
+        assert(50 not in [pid for pid, owner in bq.draw(uid=999, count=4)])
+
+        bq.remove_photo(50, 150)
+        assert(bq.member(50, 150) not in conn.zsets[bq.queue_name()])
+
+    def test_empty_category(self):
+        conn = FakeZSetRedis()
+        bq = BallotMgr.BallotQueue(1, conn)
+        bq.build_from_rows([(1, 10, 0)])
+        bq.build_from_rows([]) # the category emptied
+        assert(bq.draw(uid=1, count=4) == [])
+        assert(bq.queue_name() not in conn.zsets)
+        assert(bq.exists()) # built, nothing to rebuild until it expires
+
+        # its first photo is drawn straight away & lives as long as the marker
+        bq.add_photo(2, 11)
+        assert(bq.draw(uid=1, count=4) == [(2, 11)])
+        assert(conn.ttl(bq.queue_name()) == conn.ttl(bq.built_key()))
+
+
+class TestVoteableCategoryIndex(TestCase):
+
+    VOTING = category.CategoryState.VOTING.value
+    UPLOAD = category.CategoryState.UPLOAD.value
+
+    def test_voting_needs_others_photos(self):
+        idx = BallotMgr.VoteableCategoryIndex.from_rows([(1, self.VOTING), (2, self.VOTING)],
+                                                        [(1, 10, 3), (1, 11, 1), (2, 10, 4)], [])
+        assert(idx.voteable(11) == [2])     # only 3 photos in category 1 that aren't user 11's
+        assert(idx.voteable(10) == [])      # only 1 photo that isn't user 10's
+        assert(idx.voteable(99) == [1, 2])
+
+    def test_upload_needs_own_photo(self):
+        n = dbsetup.Configuration.UPLOAD_CATEGORY_PICS
+        idx = BallotMgr.VoteableCategoryIndex.from_rows([(1, self.UPLOAD)], [(1, 10, 1), (1, 11, n)], [])
+        assert(idx.voteable(10) == [1])
+        assert(idx.voteable(11) == [])     # only 1 photo that isn't theirs
+        assert(idx.voteable(99) == [])     # hasn't uploaded
+
+    def test_event_members_only(self):
+        idx = BallotMgr.VoteableCategoryIndex.from_rows([(1, self.VOTING), (2, self.VOTING)],
+                                                        [(1, 10, 5), (2, 10, 5)],
+                                                        [(1, 20), (1, 21), (2, None)])
+        assert(idx.voteable(20) == [1, 2])
+        assert(idx.voteable(30) == [2])     # category 2's event has no members, open to all
+
+    def test_ignores_closed_categories(self):
+        idx = BallotMgr.VoteableCategoryIndex.from_rows([(1, self.VOTING)], [(1, 10, 5), (2, 10, 5)], [(2, 30)])
+        assert(idx.voteable(30) == [1])
+
+    def test_counts_moved_by_deltas(self):
+        conn = FakeHashRedis()
+        BallotMgr.VoteableCategoryIndex.count_photo(conn, 1, 10)
+        assert(len(conn.store) == 0) # not built yet, reconciliation will count it
+
+        conn.set(BallotMgr.VoteableCategoryIndex._COUNTS_BUILT_KEY, 1)
+        conn.hmset(BallotMgr.VoteableCategoryIndex._COUNTS_KEY.format(1), {10: 3, 11: 1})
+        category_rows = [(1, self.VOTING), (2, self.VOTING)]
+        idx = BallotMgr.VoteableCategoryIndex.from_rows(category_rows, BallotMgr.VoteableCategoryIndex.read_counts(None, conn, category_rows), [])
+        assert(idx.voteable(11) == [])      # only 3 photos that aren't user 11's
+
+        BallotMgr.VoteableCategoryIndex.count_photo(conn, 1, 12)
+        BallotMgr.VoteableCategoryIndex.count_photo(conn, 2, 12)
+        idx = BallotMgr.VoteableCategoryIndex.from_rows(category_rows, BallotMgr.VoteableCategoryIndex.read_counts(None, conn, category_rows), [])
+        assert(idx.voteable(11) == [1])
+        assert(idx.voteable(12) == [1])     # category 2 only has their own photo
+
+        BallotMgr.VoteableCategoryIndex.count_photo(conn, 1, 12, -1)
+        idx = BallotMgr.VoteableCategoryIndex.from_rows(category_rows, BallotMgr.VoteableCategoryIndex.read_counts(None, conn, category_rows), [])
+        assert(idx.voteable(11) == [])
+
 class TestBallot(DatabaseTest):
 
     def test_write_ballot(self):
@@ -97,6 +389,58 @@ class TestBallot(DatabaseTest):
         self.teardown()
         return
 
+    def test_create_ballot_bulk(self):
+        self.setup()
+
+        file_pointer = open(self.create_photo_fullpath('TEST7.JPG'), 'rb')
+        photo_image = photo.PhotoImage()
+        photo_image._binary_image = file_pointer.read()
+        photo_image._extension = 'JPEG'
+        file_pointer.close()
+
+        r = resources.Resource.load_resource_by_id(self.session, rid=5555, lang='EN')
+        if r is None:
+            r = resources.Resource.create_resource(rid=5555, language='EN', resource_str='Kittens')
+            resources.Resource.write_resource(self.session, r)
+
+        s_date = datetime.datetime.now()
+        e_date = s_date + datetime.timedelta(days=1)
+        c = category.Category.create_category(r.resource_id, s_date, e_date, category.CategoryState.UPLOAD)
+        category.Category.write_category(self.session, c)
+
+        voter = usermgr.AnonUser.create_anon_user(self.session, 'AFA3540CCDD24B8686E3DDD75D84FF99')
+        pl = []
+        for idx in range(8):
+            guid = 'AFA3540CCDD24B8686E3DDD75D84FF' + '{0:02d}'.format(idx)
+            anonymous_user = usermgr.AnonUser.create_anon_user(self.session, guid)
+            fo = photo.Photo()
+            fo.category_id = c.id
+            fo.save_user_image(self.session, photo_image, anonymous_user.id, c.id)
+            pl.append(fo)
+            self.session.add(engagement.Feedback(uid=voter.id, pid=fo.id, like=True))
+        self.session.flush()
+
+        statements = []
+        def count_select(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append(statement)
+
+        sqlalchemy.event.listen(self.session.bind, 'before_cursor_execute', count_select)
+        try:
+            b = BallotMgr.BallotManager().add_photos_to_ballot(self.session, voter.id, c, pl[:4])
+            b.read_photos_for_ballots(self.session)
+        finally:
+            sqlalchemy.event.remove(self.session.bind, 'before_cursor_execute', count_select)
+
+        assert(len(statements) == 1) # just the feedback
+        assert(len(b._ballotentries) == 4)
+        for be in b._ballotentries:
+            assert(be.id is not None)
+            assert(be._photo is not None and be._photo.id == be.photo_id)
+            assert(be.like)
+
+        self.teardown()
+
     def test_leaderboard(self):
 
         # create new leaderboard
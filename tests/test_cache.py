@@ -0,0 +1,213 @@
+from unittest import TestCase
+import time
+import threading
+from cache.ExpiryCache import ExpiryCache, ShardedExpiryCache, ExpiryValueException, approximate_size
+
+
+class TestExpiryCache(TestCase):
+
+    def test_put_get(self):
+        c = ExpiryCache()
+        c.put('name', 'ExpiryCache')
+        assert(c.get('name') == 'ExpiryCache')
+        assert(c.get('nothere') is None)
+
+        d = c.stats()
+        assert(d['hits'] == 1)
+        assert(d['misses'] == 1)
+
+    def test_bad_ttl(self):
+        c = ExpiryCache()
+        try:
+            c.put('name', 'ExpiryCache', ttl='forever')
+            assert(False)
+        except ExpiryValueException:
+            pass
+
+    def test_expiry(self):
+        c = ExpiryCache()
+        c.put('name', 'ExpiryCache', ttl=0.01)
+        time.sleep(0.05)
+        assert(c.get('name') is None)
+        assert(c.stats()['expirations'] == 1)
+
+    def test_expire_key(self):
+        c = ExpiryCache()
+        c.put('name', 'ExpiryCache')
+        c.expire_key('name')
+        assert(c.get('name') is None)
+        try:
+            c.expire_key('name')
+            assert(False)
+        except KeyError:
+            pass
+
+    def test_lru_max_entries(self):
+        c = ExpiryCache(max_entries=3)
+        c.put('a', 1)
+        c.put('b', 2)
+        c.put('c', 3)
+        c.get('a') # 'b' is now least recently used
+        c.put('d', 4)
+
+        assert(c.get('b') is None)
+        assert(c.get('a') == 1)
+        assert(c.get('c') == 3)
+        assert(c.get('d') == 4)
+        assert(c.stats()['evictions'] == 1)
+        assert(c.stats()['entries'] == 3)
+
+    def test_lru_max_bytes(self):
+        thumb = 'x' * 10000
+        budget = approximate_size(thumb) * 3
+        c = ExpiryCache(max_bytes=budget)
+        for i in range(10):
+            c.put('thumb{0}'.format(i), thumb)
+
+        d = c.stats()
+        assert(d['bytes'] <= budget)
+        assert(d['entries'] == 3)
+        assert(d['evictions'] == 7)
+        assert(c.get('thumb9') == thumb)
+        assert(c.get('thumb0') is None)
+
+    def test_replace_accounts_bytes(self):
+        c = ExpiryCache(max_bytes=1024*1024)
+        c.put('key', 'x' * 1000)
+        c.put('key', 'x' * 100)
+        assert(c.stats()['bytes'] == approximate_size('x' * 100))
+        c.expire_key('key')
+        assert(c.stats()['bytes'] == 0)
+
+    def test_oversize_value_not_cached(self):
+        c = ExpiryCache(max_bytes=1000)
+        c.put('small', 'x')
+        c.put('huge', 'x' * 5000)
+        assert(c.get('huge') is None)
+        assert(c.get('small') == 'x')
+
+    def test_approximate_size_containers(self):
+        lb_list = [{'username': 'someone', 'image': 'x' * 5000}, {'username': 'another', 'image': 'y' * 5000}]
+        assert(approximate_size(lb_list) > 10000)
+
+    def test_cleaner(self):
+        c = ExpiryCache()
+        for i in range(100):
+            c.put(i, i, ttl=0.01)
+        c.put('keeper', 'keeper')
+        time.sleep(0.05)
+        c.timely_cache_cleaner()
+        assert(c.stats()['entries'] == 1)
+
+    def test_sweep_skips_overwritten_key(self):
+        c = ExpiryCache(schedule=False)
+        c.put('key', 'short', ttl=0.01)
+        c.put('key', 'long', ttl=60) # old heap entry is now stale
+        time.sleep(0.05)
+        assert(c.sweep_expired() == 0)
+        assert(c.get('key') == 'long')
+
+    def test_sweep_only_expired(self):
+        c = ExpiryCache(schedule=False)
+        for i in range(50):
+            c.put(i, i, ttl=0.01)
+        for i in range(50, 100):
+            c.put(i, i, ttl=60)
+        time.sleep(0.05)
+        assert(c.sweep_expired() == 50)
+        assert(c.stats()['entries'] == 50)
+        assert(c.stats()['expirations'] == 50)
+
+    def test_sweep_removed_keys(self):
+        c = ExpiryCache(max_entries=10, schedule=False)
+        for i in range(100):
+            c.put(i, i, ttl=0.01) # most get evicted, leaving stale heap entries
+        c.expire_key(99)
+        time.sleep(0.05)
+        assert(c.sweep_expired() == 9)
+        assert(c.stats()['entries'] == 0)
+
+
+class TestShardedExpiryCache(TestCase):
+
+    def test_put_get(self):
+        c = ShardedExpiryCache(num_shards=4, schedule=False)
+        for i in range(100):
+            c.put('key{0}'.format(i), i)
+        for i in range(100):
+            assert(c.get('key{0}'.format(i)) == i)
+        v, t = c.get_with_time('key1')
+        assert(v == 1 and t is not None)
+        assert(c.get('nothere') is None)
+
+        d = c.stats()
+        assert(d['entries'] == 100)
+        assert(d['hits'] == 101)
+        assert(d['misses'] == 1)
+        assert(d['shards'] == 4)
+
+    def test_expire_key(self):
+        c = ShardedExpiryCache(num_shards=4, schedule=False)
+        c.put('name', 'ExpiryCache')
+        c.expire_key('name')
+        assert(c.get('name') is None)
+        try:
+            c.expire_key('name')
+            assert(False)
+        except KeyError:
+            pass
+
+    def test_bounded(self):
+        c = ShardedExpiryCache(num_shards=4, max_entries=40, schedule=False)
+        for i in range(1000):
+            c.put(i, i)
+        d = c.stats()
+        assert(d['entries'] <= 40)
+        assert(d['max_entries'] == 40)
+
+    def test_sweep(self):
+        c = ShardedExpiryCache(num_shards=4, schedule=False)
+        for i in range(100):
+            c.put(i, i, ttl=0.01)
+        c.put('keeper', 'keeper')
+        time.sleep(0.05)
+        assert(c.sweep_expired() == 100)
+        assert(c.stats()['entries'] == 1)
+
+
+class TestCacheContention(TestCase):
+    """
+    microbenchmark, N threads hammering the cache with a read heavy
+    mix (like request threads reading thumbnails). Prints throughput
+    for the single lock cache and the striped one, we don't assert
+    on timing since CI boxes vary.
+    """
+    num_threads = 8
+    ops_per_thread = 20000
+
+    def hammer(self, c) -> float:
+        for i in range(1000):
+            c.put('thumb{0}'.format(i), 'x' * 100, ttl=60)
+
+        def worker(tid: int):
+            for i in range(self.ops_per_thread):
+                key = 'thumb{0}'.format((i * 7 + tid) % 1000)
+                if i % 10 == 0:
+                    c.put(key, 'x' * 100, ttl=60)
+                else:
+                    c.get(key)
+
+        threads = [threading.Thread(target=worker, args=(tid,)) for tid in range(self.num_threads)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        return (self.num_threads * self.ops_per_thread) / elapsed
+
+    def test_contention_benchmark(self):
+        single = self.hammer(ExpiryCache(max_entries=20000, max_bytes=128*1024*1024, schedule=False))
+        striped = self.hammer(ShardedExpiryCache(num_shards=16, max_entries=20000, max_bytes=128*1024*1024, schedule=False))
+        print('\ncache contention, {0} threads: single lock {1:.0f} ops/sec, 16 shards {2:.0f} ops/sec'.format(self.num_threads, single, striped))
+        assert(single > 0 and striped > 0)
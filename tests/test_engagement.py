@@ -127,6 +127,37 @@ class TestEngagement(DatabaseTest):
         assert(str(engagement.RewardType.LIGHTBULB) == 'LIGHTBULB')
         assert(str(engagement.RewardType.TEST) == 'TEST')
 
+    def test_user_activity_streaks(self):
+        self.setup()
+        session = dbsetup.Session()
+        au = self.create_anon_user(session)
+        today = datetime.date.today()
+        assert(engagement.UserActivity.read(session, au.id) is None)
+
+        # three days running, twice on the last day
+        for days_ago in [2, 1, 0, 0]:
+            engagement.UserActivity.record_vote(session, au.id, today - datetime.timedelta(days=days_ago))
+        engagement.UserActivity.record_upload(session, au.id, today - datetime.timedelta(days=3))
+        session.commit()
+
+        ua = engagement.UserActivity.read(session, au.id)
+        assert(ua.num_votes == 4)
+        assert(ua.last_vote_day == today and ua.vote_streak_on(today) == 3)
+        assert(ua.vote_streak_on(today + datetime.timedelta(days=1)) == 3)
+        assert(ua.vote_streak_on(today + datetime.timedelta(days=2)) == 0)
+        assert(ua.upload_streak == 1 and ua.upload_streak_on(today) == 0)
+
+        # a missed day starts the streak again
+        engagement.UserActivity.record_vote(session, au.id, today + datetime.timedelta(days=2))
+        session.commit()
+        ua = engagement.UserActivity.read(session, au.id)
+        assert(ua.num_votes == 5 and ua.vote_streak == 1)
+
+        assert(engagement.UserActivity.streak_from_days([today - datetime.timedelta(days=5), today - datetime.timedelta(days=1), today]) == (today, 2))
+        assert(engagement.UserActivity.streak_from_days([]) == (None, 0))
+        session.close()
+        self.teardown()
+
     def test_consecutive_not_voting_days(self):
         session = dbsetup.Session()
         au = self.create_anon_user(session)
@@ -157,6 +188,8 @@ class TestEngagement(DatabaseTest):
             dt += datetime.timedelta(days=1)
 
         session.commit()
+        RewardMgr.RewardManager.backfill_user_activity(session, [au.id]) # the rows were written directly
+        session.commit()
 
         # now see if we have consecutive days
         isConsecutive = RewardMgr.RewardManager.consecutive_voting_days(session, au, day_span=day_span)
@@ -186,6 +219,8 @@ class TestEngagement(DatabaseTest):
             dt += datetime.timedelta(hours=12)
 
         session.commit()
+        RewardMgr.RewardManager.backfill_user_activity(session, [au.id]) # the rows were written directly
+        session.commit()
 
         # now see if we have consecutive days
         isConsecutive = RewardMgr.RewardManager.consecutive_voting_days(session, au, day_span=day_span)
@@ -219,6 +254,8 @@ class TestEngagement(DatabaseTest):
             dt += datetime.timedelta(hours=12)
 
         session.commit()
+        RewardMgr.RewardManager.backfill_user_activity(session, [au.id]) # the rows were written directly
+        session.commit()
 
         # now see if we have consecutive days
         RewardMgr.RewardManager(user_id=au.id, rewardtype=engagement.RewardType.DAYSPLAYED_30).check_consecutive_day_rewards(session, au, engagement.RewardType.DAYSPLAYED_30)
@@ -336,6 +373,8 @@ class TestEngagement(DatabaseTest):
             dt += datetime.timedelta(days=1)
 
         session.commit()
+        RewardMgr.RewardManager.backfill_user_activity(session, [au.id]) # the rows were written directly
+        session.commit()
 
         RewardMgr.RewardManager().update_rewards_for_photo(session, au)
 
@@ -396,6 +435,8 @@ class TestEngagement(DatabaseTest):
             dt += datetime.timedelta(days=1)
 
         session.commit()
+        RewardMgr.RewardManager.backfill_user_activity(session, [au.id]) # the rows were written directly
+        session.commit()
 
         RewardMgr.RewardManager().update_rewards_for_photo(session, au)
 
@@ -456,6 +497,8 @@ class TestEngagement(DatabaseTest):
             dt += datetime.timedelta(days=1)
 
         session.commit()
+        RewardMgr.RewardManager.backfill_user_activity(session, [au.id]) # the rows were written directly
+        session.commit()
 
         RewardMgr.RewardManager().update_rewards_for_photo(session, au)
 
@@ -247,6 +247,44 @@ class TestEvent(DatabaseTest):
 
         self.teardown()
 
+    def test_event_list_photos(self):
+        self.setup()
+        start_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
+        au = self.create_anon_user(self.session)
+        em = eventmgr.EventManager(vote_duration=24, upload_duration=72, start_date=start_date, categories=['one', 'two'],
+                               name='EventList Photos', max_players=10, user=au, active=False)
+        e = em.create_event(self.session)
+        c1, c2 = em._cl
+        cm = categorymgr.CategoryManager()
+        cm._PHOTOLIST_MAXSIZE = 3
+
+        pids = []
+        for i in range(0, 4):
+            p = photo.Photo()
+            p.category_id = c1.id
+            p.filepath = 'boguspath'
+            p.filename = str(uuid.uuid1()).translate({ord(c): None for c in '-'})
+            p.user_id = au.id
+            p.score = i
+            self.session.add(p)
+            self.session.commit()
+            pids.append(p.id)
+
+        # the first page of each category in one query, limited in SQL
+        pages = cm.first_photo_pages(self.session, [c1.id, c2.id])
+        assert([row.id for row in pages[c1.id]] == pids[:3])
+        assert(pages[c2.id] == [])
+        assert([row.id for row in cm.category_photo_rows(self.session, 'prev', pids[3], c1.id)] == list(reversed(pids[:3])))
+        assert(len(cm.category_photo_list(self.session, 'next', 0, c1.id)) == 3)
+
+        d = eventmgr.EventManager.event_list(self.session, au, 'next', 0)
+        d_e = [d_event for d_event in d['events'] if d_event['id'] == e.id][0]
+        photos = {c['id']: c['photos'] for c in d_e['categories']}
+        assert([p['pid'] for p in photos[c1.id]] == pids)
+        assert(photos[c2.id] == [])
+        assert(photos[c1.id][0] == photo.Photo.photo_dict(self.session.query(photo.Photo).get(pids[0])))
+        self.teardown()
+
     def test_event_list_unknown(self):
         self.setup()
         # first create an event
@@ -479,6 +517,46 @@ class TestEvent(DatabaseTest):
 
         self.teardown()
 
+    def test_event_detail_stats(self):
+        self.setup()
+        start_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
+        au = self.create_anon_user(self.session)
+        au2 = self.create_anon_user(self.session)
+        em = eventmgr.EventManager(vote_duration=24, upload_duration=72, start_date=start_date, categories=['stats', 'empty'],
+                               name='EventDetail Stats', max_players=10, user=au, active=False)
+        e = em.create_event(self.session)
+        c1, c2 = em._cl
+        c1.state = category.CategoryState.UPLOAD.value
+        self.session.commit()
+
+        # the counters follow the uploads
+        p1 = self.write_photo_to_category(self.session, c1, au)
+        self.write_photo_to_category(self.session, c1, au)
+        self.write_photo_to_category(self.session, c1, au2)
+        e_dict = eventmgr.EventManager.event_details(self.session, au, e.id)
+        counts = {c['id']: (c['num_photos'], c['num_players']) for c in e_dict['categories']}
+        assert(counts[c1.id] == (3, 2))
+        assert(counts[c2.id] == (0, 0))
+
+        # nothing to repair
+        assert(categorymgr.CategoryManager.reconcile_category_stats(self.session, [c1.id, c2.id]) == 0)
+
+        # drift, and a photo de-activated behind our back
+        category.CategoryStats.add(self.session, c1.id, photos=5, voters=1)
+        p1.active = 0
+        self.session.commit()
+        assert(categorymgr.CategoryManager.reconcile_category_stats(self.session, [c1.id, c2.id]) == 1)
+        self.session.commit()
+        stats = category.CategoryStats.read_for_categories(self.session, [c1.id])[c1.id]
+        assert(stats == {'num_photos': 2, 'num_uploaders': 2, 'num_voters': 0})
+
+        # a voter is counted once, however many ballots they get
+        assert(category.CategoryVoter.add(self.session, c1.id, au2.id))
+        assert(not category.CategoryVoter.add(self.session, c1.id, au2.id))
+        self.session.commit()
+        assert(category.CategoryStats.read_for_categories(self.session, [c1.id])[c1.id]['num_voters'] == 1)
+        self.teardown()
+
     def test_accesskey_initialization(self):
         ak = event.AccessKey(id=47, passphrase='able walker', used=True)
         assert(ak.id == 47 and ak.passphrase == 'able walker' and ak.used)
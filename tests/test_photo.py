@@ -7,17 +7,21 @@ from models import resources
 from models import category, photo, usermgr, voting
 from tests import DatabaseTest
 from random import randint
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont, ImageChops
 from PIL.ExifTags import TAGS, GPSTAGS
 from io import BytesIO
 import piexif
 from sqlalchemy import func
 import base64
+import hashlib
 import dbsetup
 import iiServer
 from flask import Flask
 import subprocess
-from controllers import categorymgr
+import time
+import resource
+import multiprocessing
+from controllers import categorymgr, ThumbnailMgr
 from tests.utilities import get_photo_fullpath
 
 
@@ -185,6 +189,222 @@ class TestPhoto(DatabaseTest):
 
         self.teardown()
 
+    def create_upload_category_and_user(self) -> tuple:
+        guid = str(uuid.uuid1())
+        category_description = guid.upper().translate({ord(c): None for c in '-'})
+        start_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
+
+        cm = categorymgr.CategoryManager(start_date=start_date, upload_duration=24, vote_duration=72, description=category_description)
+        c = cm.create_category(self.session, category.CategoryType.OPEN.value)
+        c.state = category.CategoryState.UPLOAD.value
+
+        guid = str(uuid.uuid1())
+        anon_username = guid.upper().translate({ord(c): None for c in '-'})
+        au = usermgr.AnonUser.create_anon_user(self.session, anon_username)
+        assert(au is not None)
+        self.session.commit()
+        return c, au
+
+    def test_save_user_image_pipeline(self):
+        self.setup()
+        c, au = self.create_upload_category_and_user()
+
+        pi = photo.PhotoImage()
+        pi._extension = 'JPEG'
+        ft = open(get_photo_fullpath('SAMSUNG2.JPG'), 'rb')
+        pi._binary_image = ft.read()
+        ft.close()
+
+        pipeline = ThumbnailMgr.ThumbnailPipeline(max_workers=1)
+        fo = photo.Photo()
+        fo.category_id = c.id
+        d = fo.save_user_image(self.session, pi, au.id, c.id, pipeline=pipeline)
+        assert(d['error'] is None)
+        self.session.commit()
+
+        # stored, but not voteable & no thumbnail yet
+        pid = fo.id
+        assert(fo.active == photo.Photo.ACTIVE_PENDING)
+        assert(self.session.query(photo.PhotoMeta).get(pid) is None)
+
+        f = pipeline.submit(fo)
+        assert(pipeline.wait(pid, timeout=30))
+        assert(f.result())
+        assert(not pipeline.is_pending(pid))
+
+        self.session.expire_all()
+        fo = self.session.query(photo.Photo).get(pid)
+        assert(fo.active == 1)
+        assert(self.session.query(photo.PhotoMeta).get(pid) is not None)
+        assert(os.path.isfile(fo.create_thumb_filename()))
+        assert(pipeline.stats()['completed'] == 1)
+
+        os.remove(fo.filepath + "/" + fo.filename + ".JPEG")
+        os.remove(fo.create_thumb_filename())
+        self.teardown()
+
+    def test_read_thumbnail_info(self):
+        self.setup()
+        c, au = self.create_upload_category_and_user()
+
+        pi = photo.PhotoImage()
+        pi._extension = 'JPEG'
+        ft = open(get_photo_fullpath('SAMSUNG2.JPG'), 'rb')
+        pi._binary_image = ft.read()
+        ft.close()
+
+        pipeline = ThumbnailMgr.ThumbnailPipeline(processes=False)
+        fo = photo.Photo()
+        d = fo.save_user_image(self.session, pi, au.id, c.id, pipeline=pipeline)
+        assert(d['error'] is None)
+        self.session.commit()
+        pid = fo.id
+
+        # pending photos aren't served
+        assert(photo.Photo.read_thumbnail_info(self.session, str(pid), active_only=False) is None)
+        pipeline.submit(fo)
+        assert(pipeline.wait(timeout=30))
+
+        thumb_hash = self.session.query(photo.PhotoMeta).get(pid).thumb_hash
+        info = photo.Photo.read_thumbnail_info(self.session, thumb_hash)
+        assert(info['pid'] == pid)
+        assert(info['etag'] == thumb_hash)
+        assert(os.path.isfile(info['thumb_file']))
+        assert(photo.Photo.thumb_url(thumb_hash) == '/thumb/{0}'.format(thumb_hash))
+
+        info = photo.Photo.read_thumbnail_info(self.session, thumb_hash.lower())
+        assert(info['pid'] == pid)
+        assert(photo.Photo.read_thumbnail_info(self.session, 'nothumb') is None)
+        assert(photo.Photo.is_normalized_thumbnail(photo.Photo.read_thumbnail_file(info['thumb_file'])))
+
+        # photo ids are guessable, only /preview looks them up
+        assert(photo.Photo.read_thumbnail_info(self.session, str(pid)) is None)
+        assert(photo.Photo.read_thumbnail_info(self.session, str(pid), active_only=False)['pid'] == pid)
+
+        # a de-activated photo isn't served from the cached lookup
+        fo = self.session.query(photo.Photo).get(pid)
+        fo.active = 0
+        self.session.commit()
+        photo.Photo.invalidate_thumbnail_info(pid, thumb_hash)
+        assert(photo.Photo.read_thumbnail_info(self.session, thumb_hash) is None)
+
+        fo = self.session.query(photo.Photo).get(pid)
+        os.remove(fo.filepath + "/" + fo.filename + ".JPEG")
+        os.remove(fo.create_thumb_filename())
+        self.teardown()
+
+    def test_save_user_image_pipeline_bad_image(self):
+        self.setup()
+        c, au = self.create_upload_category_and_user()
+
+        pi = photo.PhotoImage()
+        pi._extension = 'JPEG'
+        ft = open(get_photo_fullpath('TEST1.JPG'), 'rb')
+        jpeg = ft.read()
+        pi._binary_image = jpeg[:len(jpeg) // 2] # header is fine, image data is truncated
+        ft.close()
+
+        pipeline = ThumbnailMgr.ThumbnailPipeline(processes=False)
+        fo = photo.Photo()
+        d = fo.save_user_image(self.session, pi, au.id, c.id, pipeline=pipeline)
+        assert(d['error'] is None)
+        self.session.commit()
+        pid = fo.id
+
+        f = pipeline.submit(fo)
+        assert(pipeline.wait(timeout=30))
+        assert(not f.result())
+
+        self.session.expire_all()
+        fo = self.session.query(photo.Photo).get(pid)
+        assert(fo.active == 0)
+        assert(pipeline.stats()['failed'] == 1)
+
+        os.remove(fo.filepath + "/" + fo.filename + ".JPEG")
+        self.teardown()
+
+    def test_save_user_image_pipeline_requeue(self):
+        self.setup()
+        c, au = self.create_upload_category_and_user()
+
+        pi = photo.PhotoImage()
+        pi._extension = 'JPEG'
+        ft = open(get_photo_fullpath('SAMSUNG2.JPG'), 'rb')
+        pi._binary_image = ft.read()
+        ft.close()
+
+        # the process pool keeps breaking, the photo isn't to blame
+        class BrokenPipeline(ThumbnailMgr.ThumbnailPipeline):
+            def _make_in_process(self, args: tuple) -> dict:
+                raise ThumbnailMgr.BrokenProcessPool('child died')
+
+        broken = BrokenPipeline(max_workers=1)
+        fo = photo.Photo()
+        d = fo.save_user_image(self.session, pi, au.id, c.id, pipeline=broken)
+        assert(d['error'] is None)
+        self.session.commit()
+        pid = fo.id
+
+        f = broken.submit(fo)
+        assert(broken.wait(pid, timeout=30))
+        assert(not f.result())
+        self.session.expire_all()
+        assert(self.session.query(photo.Photo).get(pid).active == photo.Photo.ACTIVE_PENDING)
+
+        # its worker went away, the recovery pass makes the thumbnail from the stored original
+        pipeline = ThumbnailMgr.ThumbnailPipeline(processes=False)
+        assert(pipeline.requeue_stale(self.session, minutes=10) == 0) # too new
+        fo = self.session.query(photo.Photo).get(pid)
+        fo.created_date = datetime.datetime.now() - datetime.timedelta(minutes=20)
+        fo.last_updated = fo.created_date
+        self.session.commit()
+
+        # a worker still holding the photo keeps its lease fresh
+        assert(photo.Photo.touch_pending(self.session, [pid]) == 1)
+        self.session.commit()
+        assert(pipeline.requeue_stale(self.session, minutes=10) == 0)
+
+        fo = self.session.query(photo.Photo).get(pid)
+        fo.last_updated = datetime.datetime.now() - datetime.timedelta(minutes=20)
+        self.session.commit()
+        assert(pipeline.requeue_stale(self.session, minutes=10) == 1)
+        assert(ThumbnailMgr.ThumbnailPipeline(processes=False).requeue_stale(self.session, minutes=10) == 0) # claimed
+        assert(pipeline.wait(timeout=30))
+
+        self.session.expire_all()
+        fo = self.session.query(photo.Photo).get(pid)
+        assert(fo.active == 1)
+        assert(self.session.query(photo.PhotoMeta).get(pid) is not None)
+        assert(pipeline.stats()['completed'] == 1)
+
+        os.remove(fo.filepath + "/" + fo.filename + ".JPEG")
+        os.remove(fo.create_thumb_filename())
+        self.teardown()
+
+    def test_ingest_image(self):
+        ft = open(get_photo_fullpath('SAMSUNG2.JPG'), 'rb')
+        jpeg = ft.read()
+        ft.close()
+
+        fo = photo.Photo()
+        pi = fo.ingest_image(jpeg[i:i + 65536] for i in range(0, len(jpeg), 65536))
+        assert(pi._size == len(jpeg))
+        assert(pi._binary_image is None)
+        assert(pi.md5_digest() == hashlib.md5(jpeg).hexdigest().upper())
+        with open(pi._stored_file, 'rb') as f:
+            assert(f.read() == jpeg)
+
+        # the thumbnail is made from the stored file
+        fo._photoimage = pi
+        fo.create_thumb_PIL(fn=None)
+        assert(fo._photometa.thumb_hash == pi.md5_digest())
+        assert(os.path.isfile(fo.create_thumb_filename()))
+        os.remove(fo.create_thumb_filename())
+
+        stored_file = pi._stored_file
+        pi.discard()
+        assert(not os.path.exists(stored_file))
+
     def test_save_fake_user_image(self):
 
         self.setup()
@@ -459,6 +679,31 @@ class TestPhoto(DatabaseTest):
         fn.write(binary_img)
         fn.close()
 
+    def test_read_preview_memoized(self):
+        self.setup()
+        pid = self.get_valid_photo_id(self.session)
+
+        p = photo.Photo()
+        wa = p.get_watermark_assets()
+        assert(p.get_watermark_assets() is wa) # loaded once
+
+        info = photo.Photo.read_thumbnail_info(self.session, pid, active_only=False)
+        etag = photo.Photo.preview_etag(info)
+        assert(etag.startswith('wm{0}-'.format(photo.WatermarkAssets.VERSION)))
+
+        first = p.read_thumbnail_by_id_with_watermark(self.session, pid)
+        assert(first is not None)
+        assert(photo._preview_cache.get(etag) is first)
+        assert(p.read_thumbnail_by_id_with_watermark(self.session, pid) is first)
+
+        # same as watermarking the thumbnail directly
+        main = Image.open(info['thumb_file'])
+        main = p.apply_watermark(main)
+        b = BytesIO()
+        main.save(b, 'JPEG')
+        assert(b.getvalue() == first)
+        self.teardown()
+
     def get_valid_photo_id(self, session):
 
         fo = photo.Photo()
@@ -551,6 +796,176 @@ class TestPhoto(DatabaseTest):
         expected_str = '40.0\xb044.0\'4.53\"N'
         assert(s_latitude == expected_str)
 
+    def test_is_normalized_thumbnail(self):
+        ft = open(get_photo_fullpath('TEST1.JPG'), 'rb')
+        jpeg = ft.read()
+        ft.close()
+        assert(photo.Photo.is_normalized_thumbnail(jpeg))
+
+        ft = open(get_photo_fullpath('ii_mainLogo_72.png'), 'rb')
+        png = ft.read()
+        ft.close()
+        assert(not photo.Photo.is_normalized_thumbnail(png))
+
+        # anything that isn't a JPEG comes back as one
+        normalized = photo.Photo.normalize_thumbnail(png)
+        assert(photo.Photo.is_normalized_thumbnail(normalized))
+
+    def test_thumbnail_strips_exif(self):
+        # an old style thumbnail, written with the upload's EXIF & GPS
+        image = Image.new('RGB', (80, 60), (10, 200, 30))
+        exif_bytes = piexif.dump({'0th': {piexif.ImageIFD.Orientation: 1, piexif.ImageIFD.Make: u"Unknown"},
+                                  'GPS': {piexif.GPSIFD.GPSLatitudeRef: u"N", piexif.GPSIFD.GPSLatitude: ((40, 1), (44, 1), (453, 100))}})
+        b = BytesIO()
+        image.save(b, format='JPEG', exif=exif_bytes)
+        t_fn = '/tmp/th_{0}.jpg'.format(uuid.uuid1())
+        with open(t_fn, 'wb') as f:
+            f.write(b.getvalue())
+
+        thumb = photo.Photo.read_thumbnail_file(t_fn)
+        assert(photo.Photo.is_normalized_thumbnail(thumb))
+        assert(b'Exif' not in thumb)
+        assert(Image.open(BytesIO(thumb)).size == (80, 60))
+
+        # the stored file too, nginx sends it as it is
+        assert(photo.Photo.strip_thumbnail_file(t_fn))
+        assert(not photo.Photo.strip_thumbnail_file(t_fn))
+        with open(t_fn, 'rb') as f:
+            assert(f.read() == thumb)
+        os.remove(t_fn)
+
+        # new thumbnails only carry their orientation
+        p = photo.Photo()
+        p._photoimage = photo.PhotoImage()
+        with open(get_photo_fullpath('TEST1.JPG'), 'rb') as f:
+            p._photoimage._binary_image = f.read()
+        t_fn = '/tmp/th_{0}.jpg'.format(uuid.uuid1())
+        p.create_thumb_PIL(fn=t_fn)
+        exif_dict = piexif.load(t_fn)
+        os.remove(t_fn)
+        assert(exif_dict['0th'] == {piexif.ImageIFD.Orientation: 1})
+        assert(len(exif_dict['GPS']) == 0 and exif_dict['thumbnail'] is None)
+
+    def test_thumbnail_passthrough_benchmark(self):
+        """
+        compare the old decode/re-encode thumbnail read against the
+        pass-through read on our fixture images
+        """
+        pictures = ['TEST1.JPG', 'TEST2.JPG', 'TEST3.JPG', 'TEST4.JPG', 'Portrait_1.jpg', 'Landscape_1.jpg', 'SAMSUNG2.JPG']
+        iterations = 5
+
+        reencode_time = 0.0
+        passthrough_time = 0.0
+        for pic in pictures:
+            full_path = get_photo_fullpath(pic)
+
+            ts = time.time()
+            for i in range(iterations):
+                image = Image.open(full_path)
+                b = BytesIO()
+                image.save(b, format='JPEG')
+                b64_reencoded = base64.standard_b64encode(b.getvalue())
+            reencode_time += time.time() - ts
+
+            ts = time.time()
+            for i in range(iterations):
+                with open(full_path, 'rb') as f:
+                    thumb = f.read()
+                assert(photo.Photo.is_normalized_thumbnail(thumb))
+                b64_passthrough = base64.standard_b64encode(thumb)
+            passthrough_time += time.time() - ts
+
+            # pass-through is lossless, it's the file on disk
+            assert(base64.standard_b64decode(b64_passthrough) == thumb)
+
+        num_reads = len(pictures) * iterations
+        print("\nthumbnail read, decode/re-encode: {0:.2f} ms/thumb, pass-through: {1:.2f} ms/thumb".
+              format(reencode_time * 1000 / num_reads, passthrough_time * 1000 / num_reads))
+        assert(passthrough_time < reencode_time)
+
+    @staticmethod
+    def thumb_full_decode(p: photo.Photo, jpeg: bytes) -> Image:
+        """the thumbnail the way create_thumb_PIL() used to make it, for comparison"""
+        pil_img = Image.open(BytesIO(jpeg))
+        if pil_img._getexif() is None:
+            exif_dict = p.make_dummy_exif()
+        else:
+            exif_dict = piexif.load(pil_img.info['exif'])
+        rotate, flip = p.get_rotation_and_flip_PIL(exif_dict)
+        scalefactor = p.compute_scalefactor(pil_img.height, pil_img.width)
+        new_size = (int(pil_img.width * scalefactor), int(pil_img.height*scalefactor))
+        th_img = pil_img.resize(new_size, resample=Image.LANCZOS)
+        if rotate is not None:
+            th_img = th_img.transpose(rotate)
+        if flip is not None:
+            th_img = th_img.transpose(flip)
+        return th_img
+
+    @staticmethod
+    def thumb_draft(p: photo.Photo, jpeg: bytes) -> Image:
+        pil_img = Image.open(BytesIO(jpeg))
+        exif_dict = p.get_exif_dict(pil_img)
+        return p.scale_and_orient_PIL(pil_img, exif_dict)
+
+    @staticmethod
+    def benchmark_pictures() -> list:
+        """every JPEG in the photos/ & tests/ folders"""
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        pictures = []
+        for folder in (os.path.dirname(get_photo_fullpath('TEST1.JPG')), dir_path):
+            for fn in sorted(os.listdir(folder)):
+                if fn.lower().endswith(('.jpg', '.jpeg')):
+                    pictures.append(os.path.join(folder, fn))
+        return pictures
+
+    def test_draft_thumbnail_matches(self):
+        p = photo.Photo()
+        for pic in ['Portrait_5.jpg', 'Landscape_7.jpg', 'SAMSUNG2.JPG', 'TEST1.JPG']:
+            with open(get_photo_fullpath(pic), 'rb') as f:
+                jpeg = f.read()
+            full = self.thumb_full_decode(p, jpeg).convert('RGB')
+            draft = self.thumb_draft(p, jpeg).convert('RGB')
+            assert(full.size == draft.size)
+
+            # DCT scaling is a little softer, but it's the same picture the same way up
+            diff = ImageChops.difference(full, draft).convert('L')
+            mean_diff = sum(i * n for i, n in enumerate(diff.histogram())) / (diff.width * diff.height)
+            assert(mean_diff < 8)
+
+    def test_thumbnail_engine_benchmark(self):
+        """
+        ms/thumbnail and peak RSS, full resolution decode vs. draft mode decoding.
+        Each engine runs in its own process so the peak RSS is its own.
+        """
+        pictures = self.benchmark_pictures()
+        assert(len(pictures) > 0)
+
+        def run_engine(engine, q):
+            start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            p = photo.Photo()
+            ts = time.time()
+            for pic in pictures:
+                with open(pic, 'rb') as f:
+                    jpeg = f.read()
+                b = BytesIO()
+                engine(p, jpeg).convert('RGB').save(b, format='JPEG')
+            elapsed = time.time() - ts
+            q.put((elapsed, start_rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+        results = {}
+        ctx = multiprocessing.get_context('fork')
+        for name, engine in (('full decode', self.thumb_full_decode), ('draft', self.thumb_draft)):
+            q = ctx.Queue()
+            proc = ctx.Process(target=run_engine, args=(engine, q))
+            proc.start()
+            results[name] = q.get(timeout=300)
+            proc.join()
+
+        for name, (elapsed, start_rss, peak_rss) in results.items():
+            print("\nthumbnail {0}: {1:.1f} ms/thumb, peak RSS {2:.1f} MB (+{3:.1f} MB) over {4} images".
+                  format(name, elapsed * 1000 / len(pictures), peak_rss / 1024, (peak_rss - start_rss) / 1024, len(pictures)))
+        assert(results['draft'][0] < results['full decode'][0])
+
     # def test_thumbnail_quality(self):
     #     self.setup()
     #     cwd = os.getcwd()
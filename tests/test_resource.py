@@ -26,3 +26,79 @@ class TestResource(DatabaseTest):
         resources.Resource.write_resource(self.session, r)
 
         self.teardown()
+
+    def test_resource_map(self):
+        self.setup()
+        r = resources.Resource.create_new_resource(self.session, 'EN', 'test_resource_map()')
+
+        rm = resources.ResourceMap()
+        rm.load(self.session)
+        assert(rm.get_string(r.resource_id, 'EN', self.session) == 'test_resource_map()')
+        assert(rm.stats()['hits'] == 1 and rm.stats()['misses'] == 0)
+
+        # created after the load, read on the miss
+        r2 = resources.Resource.create_new_resource(self.session, 'EN', 'test_resource_map() #2')
+        assert(rm.get_string(r2.resource_id, 'EN', self.session) == 'test_resource_map() #2')
+        assert(rm.stats()['misses'] == 1)
+        assert(rm.get_string(r2.resource_id, 'EN', self.session) == 'test_resource_map() #2')
+        assert(rm.stats()['misses'] == 1)
+
+        # changes are picked up by the refresh
+        r.resource_string = 'test_resource_map() changed'
+        self.session.commit()
+        rm.refresh(self.session)
+        assert(rm.get_string(r.resource_id, 'EN', self.session) == 'test_resource_map() changed')
+        self.teardown()
+
+    def test_resource_map_tags(self):
+        self.setup()
+        c = category.Category(rid=resources.Resource.create_new_resource(self.session, 'EN', 'test_resource_map_tags()').resource_id)
+        c.start_date = datetime.datetime.now()
+        c.end_date = c.start_date
+        self.session.add(c)
+        self.session.commit()
+
+        rm = resources.ResourceMap()
+        assert(rm.get_tags(c.id, self.session) == [])  # read once & remembered
+
+        r = resources.Resource.create_new_resource(self.session, 'EN', 'test_resource_map_tags() tag')
+        self.session.add(category.CategoryTag(category_id=c.id, resource_id=r.resource_id))
+        self.session.commit()
+        rm.refresh(self.session)
+        assert(rm.get_tags(c.id, self.session) == ['test_resource_map_tags() tag'])
+        self.teardown()
+
+    def test_resource_map_missing_and_deleted(self):
+        self.setup()
+        c = category.Category(rid=resources.Resource.create_new_resource(self.session, 'EN', 'test_resource_map_missing_and_deleted()').resource_id)
+        c.start_date = datetime.datetime.now()
+        c.end_date = c.start_date
+        self.session.add(c)
+        self.session.commit()
+        r = resources.Resource.create_new_resource(self.session, 'EN', 'test_resource_map_missing_and_deleted() tag')
+        ct = category.CategoryTag(category_id=c.id, resource_id=r.resource_id)
+        self.session.add(ct)
+        self.session.commit()
+
+        rm = resources.ResourceMap()
+        rm.load(self.session)
+        assert(rm.get_tags(c.id, self.session) == ['test_resource_map_missing_and_deleted() tag'])
+
+        # a string that isn't there is remembered, no query for the next one
+        assert(rm.get_string(r.resource_id, 'XX', self.session) is None)
+        misses = rm.stats()['misses']
+        assert(rm.get_string(r.resource_id, 'XX', self.session) is None)
+        assert(rm.stats()['misses'] == misses + 1)
+        assert((r.resource_id, 'XX') in rm._missing)
+
+        # deleted tags drop out on the next refresh, deleted strings on the next full reload
+        self.session.delete(ct)
+        self.session.commit()
+        rm.refresh(self.session)
+        assert(rm.get_tags(c.id, self.session) == [])
+        self.session.delete(r)
+        self.session.commit()
+        rm._loaded = 0
+        rm.refresh(self.session)
+        assert(rm.get_string(r.resource_id, 'EN', self.session) is None)
+        self.teardown()
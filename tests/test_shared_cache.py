@@ -0,0 +1,210 @@
+from unittest import TestCase
+import time
+import queue
+import threading
+from cache.ExpiryCache import ExpiryCache
+from cache.SharedCache import SharedCache
+
+
+class FakePubSub(object):
+
+    def __init__(self, server):
+        self._server = server
+        self._messages = queue.Queue()
+        self._closed = False
+
+    def subscribe(self, channel: str) -> None:
+        self._server.subscribers.setdefault(channel, []).append(self)
+
+    def get_message(self, timeout=0):
+        if self._closed:
+            raise ConnectionError('pubsub closed')
+        if self._server.read_timeouts > 0:
+            # like redis-py when the socket read times out on a quiet channel
+            self._server.read_timeouts -= 1
+            raise TimeoutError('Timeout reading from socket')
+        try:
+            return self._messages.get(timeout=min(timeout, 0.05))
+        except queue.Empty:
+            return None
+
+    def close(self) -> None:
+        self._closed = True
+
+
+class FakeRedis(object):
+    """just enough of redis.Redis for the shared cache, stands in for the server the workers share"""
+
+    def __init__(self):
+        self.store = {}
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.down = False
+        self.read_timeouts = 0
+
+    def check(self) -> None:
+        if self.down:
+            raise ConnectionError('redis is down')
+
+    def set(self, key, value, px=None):
+        self.check()
+        with self.lock:
+            expires = None if px is None else time.time() + px / 1000.0
+            self.store[key] = (value, expires)
+
+    def get(self, key):
+        self.check()
+        with self.lock:
+            value, expires = self.store.get(key, (None, None))
+            if expires is not None and expires < time.time():
+                del self.store[key]
+                return None
+            return value
+
+    def delete(self, key):
+        self.check()
+        with self.lock:
+            self.store.pop(key, None)
+
+    def publish(self, channel, message):
+        self.check()
+        for ps in self.subscribers.get(channel, []):
+            ps._messages.put({'type': 'message', 'channel': channel, 'data': message.encode('utf-8')})
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakePubSub(self)
+
+
+def wait_for(f, timeout: float=2.0) -> bool:
+    end = time.time() + timeout
+    while time.time() < end:
+        if f():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TestSharedCache(TestCase):
+
+    def make_worker(self, server: FakeRedis) -> SharedCache:
+        return SharedCache(local=ExpiryCache(schedule=False), f_redis=lambda: server)
+
+    def test_shared_between_workers(self):
+        server = FakeRedis()
+        w1 = self.make_worker(server)
+        w2 = self.make_worker(server)
+
+        w1.put('ALL_CATEGORIES', ['cat1', 'cat2'], ttl=60)
+        assert(w2.get('ALL_CATEGORIES') == ['cat1', 'cat2'])
+        assert(w2.stats()['shared_hits'] == 1)
+
+        # now it's in w2's local tier
+        assert(w2.get('ALL_CATEGORIES') == ['cat1', 'cat2'])
+        assert(w2.stats()['shared_hits'] == 1)
+
+    def test_broadcast_invalidation(self):
+        server = FakeRedis()
+        w1 = self.make_worker(server)
+        w2 = self.make_worker(server)
+
+        w1.put('LEADERBOARD_THUMBNAILS1', [{'pid': 1}], ttl=60)
+        assert(w2.get('LEADERBOARD_THUMBNAILS1') is not None)
+
+        w1.expire_key('LEADERBOARD_THUMBNAILS1')
+        assert(wait_for(lambda: w2.stats()['invalidations_received'] >= 1))
+        assert(w2.get('LEADERBOARD_THUMBNAILS1') is None)
+        assert(w1.get('LEADERBOARD_THUMBNAILS1') is None)
+
+    def test_listener_survives_read_timeouts(self):
+        server = FakeRedis()
+        w1 = self.make_worker(server)
+        w2 = self.make_worker(server)
+
+        w1.put('IDENTITY1', {'id': 1}, ttl=60)
+        assert(w2.get('IDENTITY1') is not None)
+
+        # a quiet channel times out, the listener keeps its subscription
+        server.read_timeouts = 3
+        assert(wait_for(lambda: server.read_timeouts == 0))
+        w1.expire_key('IDENTITY1')
+        assert(wait_for(lambda: w2.stats()['invalidations_received'] >= 1))
+        assert(w2.get('IDENTITY1') is None)
+        assert(w2.stats()['shared_errors'] == 0)
+        assert(w2.stats()['shared_connected'])
+
+    def test_follows_server_to_new_connection(self):
+        old_server = FakeRedis()
+        new_server = FakeRedis()
+        servers = [old_server]
+        w1 = SharedCache(local=ExpiryCache(schedule=False), f_redis=lambda: servers[0])
+        w2 = SharedCache(local=ExpiryCache(schedule=False), f_redis=lambda: servers[0])
+        w1.put('IDENTITY1', {'id': 1}, ttl=60)
+        assert(w2.get('IDENTITY1') is not None)
+
+        # redis moved, the pool was rebuilt
+        servers[0] = new_server
+        w1.put('IDENTITY2', {'id': 2}, ttl=60)
+        assert('iicache:IDENTITY2' in new_server.store)
+        assert(w2.get('IDENTITY2') is not None)
+        w1.expire_key('IDENTITY1')
+        assert(wait_for(lambda: w2.stats()['invalidations_received'] >= 1))
+        assert(w2.get('IDENTITY1') is None)
+
+    def test_local_only_and_size_budget(self):
+        server = FakeRedis()
+        w1 = SharedCache(local=ExpiryCache(schedule=False), f_redis=lambda: server, max_shared_bytes=1024)
+        w2 = self.make_worker(server)
+
+        w1.put('photo.jpeg', 'b64', ttl=60, local_only=True)
+        w1.put('big', 'x' * 2048, ttl=60)
+        w1.put('small', 'x', ttl=60)
+        assert(w1.get('photo.jpeg') == 'b64' and w1.get('big') is not None)
+        assert(w2.get('photo.jpeg') is None)
+        assert(w2.get('big') is None)
+        assert(w2.get('small') == 'x')
+
+        w2.put('photo.jpeg', 'b64', ttl=60, local_only=True)
+        w1.expire_key('photo.jpeg') # still dropped everywhere
+        assert(wait_for(lambda: w2.stats()['invalidations_received'] >= 1))
+        assert(w2.get('photo.jpeg') is None)
+
+    def test_expire_missing_key(self):
+        w = self.make_worker(FakeRedis())
+        w.expire_key('nothere') # no KeyError
+
+    def test_promoted_entry_keeps_deadline(self):
+        server = FakeRedis()
+        w1 = self.make_worker(server)
+        w2 = self.make_worker(server)
+
+        w1.put('thumb', 'xyz', ttl=0.2)
+        assert(w2.get('thumb') == 'xyz')
+        time.sleep(0.3)
+        assert(w2.get('thumb') is None)
+
+    def test_get_with_time(self):
+        server = FakeRedis()
+        w1 = self.make_worker(server)
+        w2 = self.make_worker(server)
+
+        w1.put('LEADERBOARD1', [1, 2, 3], ttl=60)
+        v, t = w2.get_with_time('LEADERBOARD1')
+        assert(v == [1, 2, 3])
+        assert(t is not None)
+
+    def test_redis_down_local_only(self):
+        server = FakeRedis()
+        server.down = True
+        w = self.make_worker(server)
+        w.put('key', 'value', ttl=60)
+        assert(w.get('key') == 'value')
+        assert(w.stats()['shared_errors'] >= 1)
+
+    def test_unavailable_at_connect(self):
+        def no_redis():
+            raise ConnectionError('no redis here')
+
+        w = SharedCache(local=ExpiryCache(schedule=False), f_redis=no_redis)
+        w.put('key', 'value')
+        assert(w.get('key') == 'value')
+        assert(not w.stats()['shared_connected'])
@@ -0,0 +1,101 @@
+from unittest import TestCase
+import logging
+import threading
+import time
+from handlers import sql_handler
+
+
+class TestAsyncSQLHandler(TestCase):
+
+    def make_record(self, msg: str) -> logging.LogRecord:
+        return logging.LogRecord(name='SQL_log', level=logging.INFO, pathname=__file__, lineno=0,
+                                 msg=msg, args=None, exc_info=None)
+
+    def test_batched_write(self):
+        batches = []
+        hndlr = sql_handler.AsyncSQLAlchemyHandler(f_write=batches.append, batch_size=10,
+                                                   flush_interval=0.1, register_atexit=False)
+        for i in range(25):
+            hndlr.emit(self.make_record('message #{0}'.format(i)))
+
+        hndlr.close()
+        rows = [row for batch in batches for row in batch]
+        assert(len(rows) == 25)
+        assert(max([len(b) for b in batches]) <= 10)
+        assert(rows[0]['msg'] == 'message #0')
+        assert(rows[0]['level'] == 'INFO')
+        assert(rows[0]['host'] is not None)
+
+        d = hndlr.stats()
+        assert(d['written'] == 25)
+        assert(d['dropped'] == 0)
+
+    def test_flush(self):
+        batches = []
+        hndlr = sql_handler.AsyncSQLAlchemyHandler(f_write=batches.append, flush_interval=60,
+                                                   register_atexit=False)
+        hndlr.emit(self.make_record('flush me'))
+        hndlr.flush()
+        assert(len(batches) == 1)
+        hndlr.close()
+
+    def blocked_writer(self, gate: threading.Event, batches: list):
+        def writer(rows):
+            gate.wait()
+            batches.append(rows)
+        return writer
+
+    def test_overflow_drop_new(self):
+        gate = threading.Event()
+        batches = []
+        hndlr = sql_handler.AsyncSQLAlchemyHandler(f_write=self.blocked_writer(gate, batches), batch_size=1,
+                                                   max_queue_size=5, flush_interval=0.01, register_atexit=False)
+        hndlr.emit(self.make_record('in flight'))
+        time.sleep(0.2) # let the worker pick it up and block
+        for i in range(10):
+            hndlr.emit(self.make_record('queued #{0}'.format(i)))
+
+        d = hndlr.stats()
+        assert(d['dropped'] == 5)
+        gate.set()
+        hndlr.close()
+        msgs = [row['msg'] for batch in batches for row in batch]
+        assert('queued #0' in msgs)
+        assert('queued #9' not in msgs)
+
+    def test_overflow_drop_old(self):
+        gate = threading.Event()
+        batches = []
+        hndlr = sql_handler.AsyncSQLAlchemyHandler(f_write=self.blocked_writer(gate, batches), batch_size=1,
+                                                   max_queue_size=5, flush_interval=0.01, overflow=sql_handler.DROP_OLD,
+                                                   register_atexit=False)
+        hndlr.emit(self.make_record('in flight'))
+        time.sleep(0.2)
+        for i in range(10):
+            hndlr.emit(self.make_record('queued #{0}'.format(i)))
+
+        assert(hndlr.stats()['dropped'] == 5)
+        gate.set()
+        hndlr.close()
+        msgs = [row['msg'] for batch in batches for row in batch]
+        assert('queued #0' not in msgs)
+        assert('queued #9' in msgs)
+
+    def test_write_failure_counted(self):
+        def failing_writer(rows):
+            raise Exception('database went away')
+
+        hndlr = sql_handler.AsyncSQLAlchemyHandler(f_write=failing_writer, flush_interval=0.05,
+                                                   register_atexit=False)
+        hndlr.emit(self.make_record('lost'))
+        hndlr.close()
+        d = hndlr.stats()
+        assert(d['errors'] == 1)
+        assert(d['dropped'] == 1)
+
+    def test_bad_overflow_policy(self):
+        try:
+            sql_handler.AsyncSQLAlchemyHandler(f_write=list, overflow='explode', register_atexit=False)
+            assert(False)
+        except ValueError:
+            pass
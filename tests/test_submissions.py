@@ -1,10 +1,12 @@
-from unittest import TestCase
+from unittest import TestCase, skipUnless
 from models import userprofile
 from models import category, photo, usermgr, resources
 from tests import DatabaseTest
 import json
 import uuid
 import datetime
+import os
+import time
 from controllers import categorymgr, RewardMgr
 from models import engagement
 
@@ -56,7 +58,7 @@ class TestSubmissions(DatabaseTest):
 
     _photo_idx = None
 
-    def photos_for_categories(self, session, dir: str, cid: int) -> list:
+    def photos_for_categories(self, session, dir: str, cid: int, end_cid: int=None) -> list:
         pl = []
         for c in self._category_list:
             for i in range(1, c.id):
@@ -235,9 +237,10 @@ class TestSubmissions(DatabaseTest):
         profile = userprofile.Submissions(uid=uid)
         d = profile.get_user_submissions(self.session, 'next', 0, num_categories//2)
         assert(d is not None)
-        assert(len(d) == 2)
+        assert(len(d) == 3) # there's another page, so a cursor
         submissions = d['submissions']
         assert(len(submissions) == num_categories//2)
+        assert(d['cursor'] == {'dir': 'next', 'cid': submissions[-1]['category']['id']})
         json_d = json.dumps(d)
 
         self.teardown()
@@ -252,13 +255,111 @@ class TestSubmissions(DatabaseTest):
         profile = userprofile.Submissions(uid=uid)
         d = profile.get_user_submissions(self.session, 'prev', cid, num_categories//2)
         assert(d is not None)
-        assert(len(d) == 2)
+        assert(len(d) == 2) # all the categories before cid, no more pages
         submissions = d['submissions']
         assert(len(submissions) == num_categories//2)
         json_d = json.dumps(d)
 
         self.teardown()
 
+    def test_submissions_cursor(self):
+        self.setup()
+
+        num_categories = 7
+        num_photos = 3
+        uid = self.create_submissions_tst_data(num_categories=num_categories, num_photos=num_photos)
+        profile = userprofile.Submissions(uid=uid)
+
+        # walk the pages with the cursor, every category once, in order, with all its photos
+        cids = []
+        d = profile.get_user_submissions(self.session, 'next', 0, 3)
+        while True:
+            for submission in d['submissions']:
+                cids.append(submission['category']['id'])
+                assert(len(submission['photos']) == num_photos)
+            if 'cursor' not in d:
+                break
+            d = profile.get_user_submissions(self.session, d['cursor']['dir'], d['cursor']['cid'], 3)
+
+        assert(cids == sorted([c.id for c in self._cl]))
+
+        # and back again
+        d = profile.get_user_submissions(self.session, 'prev', cids[-1] + 1, 4)
+        assert([s['category']['id'] for s in d['submissions']] == list(reversed(cids))[:4])
+        d = profile.get_user_submissions(self.session, 'prev', d['cursor']['cid'], 4)
+        assert([s['category']['id'] for s in d['submissions']] == list(reversed(cids))[4:])
+        assert('cursor' not in d)
+        self.teardown()
+
+    def legacy_user_submissions(self, session, uid: int, cid: int, num_categories: int) -> list:
+        """how /submissions/next/<cid> used to do it, for the benchmark"""
+        e = session.query(category.Category.id).filter(category.Category.id > cid). \
+            join(photo.Photo, photo.Photo.category_id == category.Category.id). \
+            filter(photo.Photo.user_id == uid). \
+            order_by(category.Category.id.asc()). \
+            distinct(category.Category.id)
+        cl = session.query(category.Category).filter(category.Category.id.in_(e)). \
+            order_by(category.Category.id.asc()).all()[:num_categories]
+        pl = session.query(photo.Photo).filter(photo.Photo.user_id == uid). \
+            join(category.Category, category.Category.id == photo.Photo.category_id). \
+            filter(category.Category.id > cid).all()
+        submissions = []
+        for c in cl:
+            photos = [p.to_dict() for p in pl if p.category_id == c.id]
+            if photos:
+                submissions.append({'category': {'id': c.id}, 'photos': photos})
+        return submissions
+
+    @skipUnless(os.environ.get('IIBENCHMARK'), 'set IIBENCHMARK=1 to run, seeds 10k photos')
+    def test_submissions_benchmark(self):
+        """
+        first page & a page from the middle of a long time user's submissions,
+        10k photos over 1k categories, before vs. the paginated engine
+        """
+        self.setup()
+        num_categories = 1000
+        num_photos = 10000
+        page_size = 10
+        au = self.create_anon_user()
+        rid = resources.Resource.create_new_resource(self.session, 'EN', 'test_submissions_benchmark').resource_id
+        start_date = datetime.datetime.now()
+        rows = [{'resource_id': rid, 'start_date': start_date, 'end_date': start_date, 'state': category.CategoryState.CLOSED.value,
+                 'type': category.CategoryType.OPEN.value, 'duration_upload': 24, 'duration_vote': 72} for i in range(num_categories)]
+        self.session.execute(category.Category.__table__.insert(), rows)
+        cids = [row[0] for row in self.session.query(category.Category.id).filter(category.Category.resource_id == rid).order_by(category.Category.id.asc()).all()]
+
+        rows = [{'user_id': au.id, 'category_id': cids[i % num_categories], 'filepath': '/benchmark', 'filename': 'sb{0}.jpeg'.format(i),
+                 'score': i % 500, 'likes': i % 3, 'times_voted': 1, 'active': 1} for i in range(num_photos)]
+        for i in range(0, num_photos, 5000):
+            self.session.execute(photo.Photo.__table__.insert(), rows[i:i + 5000])
+        self.session.commit()
+
+        profile = userprofile.Submissions(uid=au.id)
+        try:
+            for label, cid in (('first page', 0), ('middle page', cids[num_categories // 2])):
+                num_runs = 10
+                start = time.perf_counter()
+                for i in range(num_runs):
+                    before_pages = self.legacy_user_submissions(self.session, au.id, cid, page_size)
+                before = (time.perf_counter() - start) / num_runs
+
+                start = time.perf_counter()
+                for i in range(num_runs):
+                    d = profile.get_user_submissions(self.session, 'next', cid, page_size)
+                after = (time.perf_counter() - start) / num_runs
+
+                assert([s['category']['id'] for s in d['submissions']] == [s['category']['id'] for s in before_pages])
+                by_pid = lambda pl: sorted(pl, key=lambda p: p['pid'])
+                assert([by_pid(s['photos']) for s in d['submissions']] == [by_pid(s['photos']) for s in before_pages])
+                print('\n/submissions {0}, {1} photos in {2} categories: before {3:.1f}ms, paginated {4:.1f}ms'.
+                      format(label, num_photos, num_categories, before * 1000, after * 1000))
+        finally:
+            self.session.rollback()
+            self.session.execute('DELETE FROM photo WHERE user_id = :uid', {'uid': au.id})
+            self.session.execute('DELETE FROM category WHERE resource_id = :rid', {'rid': rid})
+            self.session.commit()
+            self.teardown()
+
     def test_user_likes(self):
         self.setup()
 
@@ -385,4 +486,38 @@ class TestSubmissions(DatabaseTest):
         prev_user_likes = userprofile.Submissions.get_user_likes(self.session, au=au, dir='prev', cid = cid)
         assert(self.count_liked_photos(prev_user_likes['likes']) == userprofile._MAX_PHOTOS_TO_RETURN) # NOTE: The # photos per category needs to be be a factor of this value for the test to work
 
-        self.teardown()
\ No newline at end of file
+        self.teardown()
+
+    def test_user_likes_cursor(self):
+        self.setup()
+
+        # one category with more likes than fit on a page, then a small one
+        cl = self.create_category_list(2)
+        self.session.commit()
+        owner = self.create_anon_user()
+        big = self.create_photos_for_category(owner.id, cl[0], userprofile._MAX_PHOTOS_TO_RETURN + 10)
+        small = self.create_photos_for_category(owner.id, cl[1], 5)
+
+        au = self.create_anon_user()
+        for p in big + small:
+            fm = RewardMgr.FeedbackManager(uid=au.id, pid=p.id, like=True)
+            fm.create_feedback(self.session)
+        self.session.commit()
+
+        cid = min(c.id for c in cl) - 1
+        user_likes = userprofile.Submissions.get_user_likes(self.session, au=au, dir='next', cid=cid)
+        assert(len(user_likes['likes']) == 1)
+        assert(self.count_liked_photos(user_likes['likes']) == userprofile._MAX_PHOTOS_TO_RETURN)
+        cursor = user_likes['cursor']
+        assert(cursor['cid'] == cl[0].id and 'pid' in cursor)
+
+        # resume in the middle of the big category
+        user_likes = userprofile.Submissions.get_user_likes(self.session, au=au, dir=cursor['dir'], cid=cursor['cid'], pid=cursor['pid'])
+        assert([l['category']['id'] for l in user_likes['likes']] == [cl[0].id, cl[1].id])
+        assert(len(user_likes['likes'][0]['photos']) == 10)
+        assert(len(user_likes['likes'][1]['photos']) == 5)
+        assert('cursor' not in user_likes)
+
+        seen = [p['pid'] for l in user_likes['likes'] for p in l['photos']]
+        assert(len(set(seen)) == 15)
+        self.teardown()
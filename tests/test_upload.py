@@ -0,0 +1,64 @@
+from unittest import TestCase
+import os
+import json
+import base64
+import binascii
+from io import BytesIO
+from controllers import UploadMgr
+
+
+def split(b: bytes, size: int) -> list:
+    return [b[i:i + size] for i in range(0, len(b), size)]
+
+
+class TestUploadStream(TestCase):
+
+    def test_request_chunks(self):
+        body = os.urandom(200000)
+        chunks = list(UploadMgr.request_chunks(BytesIO(body), chunk_size=65536))
+        assert(len(chunks) == 4)
+        assert(b''.join(chunks) == body)
+
+    def test_base64_decoder(self):
+        image = os.urandom(10001)
+        for encoded in (base64.b64encode(image), base64.encodebytes(image)):
+            for size in (1, 3, 4, 1000):
+                decoder = UploadMgr.Base64Decoder()
+                decoded = b''.join(decoder.decode(piece) for piece in split(encoded, size)) + decoder.finish()
+                assert(decoded == image)
+
+    def test_base64_decoder_bad_padding(self):
+        decoder = UploadMgr.Base64Decoder()
+        decoder.decode(b'QUJDRA')
+        try:
+            decoder.finish()
+            assert(False)
+        except binascii.Error:
+            pass
+
+    def test_json_image_stream(self):
+        image = os.urandom(50000)
+        d = {'category_id': 12, 'extension': 'JPEG', 'tags': ['image', {'image': 1}], 'image': base64.b64encode(image).decode('utf-8')}
+        body = json.dumps(d).replace('/', '\\/').encode('utf-8') # some encoders escape '/'
+        for size in (7, 4096, len(body)):
+            s = UploadMgr.JsonImageStream(split(body, size))
+            assert(b''.join(s.image_chunks()) == image)
+            fields = s.fields()
+            assert(fields['category_id'] == 12)
+            assert(fields['extension'] == 'JPEG')
+            assert(fields['image'] == '')
+
+    def test_json_image_first(self):
+        image = os.urandom(3000)
+        body = '{"image": "' + base64.encodebytes(image).decode('utf-8').replace('\n', '\\n') + '", "category_id": 3, "extension": "JPEG"}'
+        s = UploadMgr.JsonImageStream(split(body.encode('utf-8'), 100))
+        assert(b''.join(s.image_chunks()) == image)
+        assert(s.fields()['category_id'] == 3)
+
+    def test_json_no_image(self):
+        s = UploadMgr.JsonImageStream([b'{"category_id": 3, "extension": "JPEG", "tags": {"image": "nested"}}'])
+        try:
+            list(s.image_chunks())
+            assert(False)
+        except KeyError:
+            pass
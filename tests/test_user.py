@@ -10,6 +10,8 @@ import dbsetup
 import logsetup
 import logging
 from sqlalchemy.sql import func
+from sqlalchemy import inspect
+from cache.ExpiryCache import _expiry_cache
 from handlers import dbg_handler
 from logsetup import logger
 
@@ -39,6 +41,30 @@ class TestUserMgr(DatabaseTest):
         assert(first_hashedPWD != u2_pwd.hashedPWD)
 
         self.teardown()
+    def test_identity_cached(self):
+        self.setup()
+        au = usermgr.AnonUser.create_anon_user(self.session, str(uuid.uuid1()))
+        self.session.commit()
+        key = usermgr.AnonUser.IDENTITY_KEY.format(au.id)
+        usermgr.AnonUser.invalidate_identity(au.id)
+
+        au1 = usermgr.identity({'identity': au.id})
+        assert(au1.guid == au.guid)
+        assert(_expiry_cache.get(key) is not None)
+
+        # from the snapshot, a new detached user every time
+        au2 = usermgr.identity({'identity': au.id})
+        assert(au2 is not au1)
+        assert(au2.id == au.id and au2.guid == au.guid and au2.usertype == au.usertype)
+        assert(inspect(au2).detached)
+
+        # registering the user drops the snapshot
+        u = usermgr.User.create_user(self.session, au.guid, '{0}@gmail.com'.format(au.guid), 'pa55w0rd')
+        assert(u is not None)
+        self.session.commit()
+        assert(_expiry_cache.get(key) is None)
+        self.teardown()
+
     def test_usertype_normal(self):
         ut = usermgr.UserType.to_str(0)
         assert(ut == 'PLAYER')
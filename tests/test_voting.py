@@ -1,4 +1,4 @@
-from unittest import TestCase
+from unittest import TestCase, skipUnless
 import initschema
 import datetime
 import os, errno
@@ -13,9 +13,48 @@ from handlers import dbg_handler
 from logsetup import logger
 from flask import Flask, jsonify
 import json
+import time
+import threading
+import redis
 import dbsetup
+from leaderboard.leaderboard import Leaderboard
 from controllers import categorymgr, BallotMgr, RewardMgr
 from tests.utilities import get_photo_fullpath
+from random import shuffle
+
+
+def read_photos_by_ballots_round2(session, uid: int, current_category: category.Category, num_votes: int, count: int) -> list:
+    """
+    the original round #2 selection, a query per section for each num_votes,
+    only kept for test_round2_ballot_benchmark to measure the section queues against
+    """
+    section_list = list(range(voting._NUM_SECTONS_ROUND2))
+    shuffle(section_list)
+    oversize = count * 20
+    ballot_photo_list = []
+    for section in section_list:
+        query = session.query(photo.Photo).filter(photo.Photo.user_id != uid). \
+            filter(photo.Photo.category_id == current_category.id). \
+            filter(photo.Photo.active == 1). \
+            join(voting.VotingRound, voting.VotingRound.photo_id == photo.Photo.id). \
+            filter(voting.VotingRound.section == section). \
+            filter(voting.VotingRound.times_voted == num_votes).limit(oversize)
+        ballot_photo_list.extend(query.all())
+        if len(ballot_photo_list) >= count:
+            return ballot_photo_list
+
+    if num_votes == voting._MAX_VOTING_ROUNDS:
+        for section in section_list:
+            query = session.query(photo.Photo).filter(photo.Photo.user_id != uid). \
+                filter(photo.Photo.category_id == current_category.id). \
+                filter(photo.Photo.active == 1). \
+                join(voting.VotingRound, voting.VotingRound.photo_id == photo.Photo.id). \
+                filter(voting.VotingRound.section == section).limit(oversize)
+            ballot_photo_list.extend(query.all())
+            if len(ballot_photo_list) >= count:
+                return ballot_photo_list
+    return ballot_photo_list
+
 
 class TestVoting(DatabaseTest):
 
@@ -109,6 +148,114 @@ class TestVoting(DatabaseTest):
         assert(name == 'anonymous{}'.format(au.id))
         self.teardown()
 
+    def test_create_displaynames_anonymous(self):
+        self.setup()
+        tm = RewardMgr.TallyMan()
+
+        guid = str(uuid.uuid1())
+        guid = guid.upper().translate({ord(c): None for c in '-'})
+        au = usermgr.AnonUser.create_anon_user(self.session, guid)
+        self.session.flush()
+
+        names = tm.create_displaynames(self.session, [au.id])
+        assert(names[au.id] == tm.create_displayname(self.session, au.id))
+        assert(tm.create_displaynames(self.session, []) == {})
+        self.teardown()
+
+    def test_leaderboard_overlay(self):
+        tm = RewardMgr.TallyMan()
+        lb_core = [{'username': 'me', 'score': 10, 'rank': 1, 'pid': 1, 'orientation': 1, 'votes': 1, 'likes': 0, 'image': 'x', 'uid': 5},
+                   {'username': 'also me', 'score': 9, 'rank': 2, 'pid': 2, 'orientation': 1, 'votes': 1, 'likes': 0, 'image': 'y', 'uid': 5}]
+
+        lb_list = tm.overlay_leaderboard(None, usermgr.AnonUser(uid=5), lb_core)
+        assert(len(lb_list) == 2)
+        assert(lb_list[0]['you'] and lb_list[1]['you'])
+        assert('uid' not in lb_list[0])
+
+        # the shared core isn't touched
+        assert('you' not in lb_core[0])
+        assert(lb_core[0]['uid'] == 5)
+
+    def test_leaderboard_overlay_thumb_urls(self):
+        tm = RewardMgr.TallyMan()
+        lb_core = [{'username': 'me', 'score': 10, 'rank': 1, 'pid': 1, 'orientation': 1, 'votes': 1, 'likes': 0, 'image': 'x',
+                    'thumb': '/thumb/ABC', 'uid': 5},
+                   {'username': 'old', 'score': 5, 'rank': 2, 'pid': 2, 'orientation': 1, 'votes': 1, 'likes': 0, 'image': 'y',
+                    'thumb': None, 'uid': 5}]
+
+        lb_list = tm.overlay_leaderboard(None, usermgr.AnonUser(uid=5), lb_core, thumb_urls=True)
+        assert('image' not in lb_list[0])
+        assert(lb_list[0]['thumb'] == '/thumb/ABC')
+        # no thumb_hash, the base64 thumbnail it is
+        assert(lb_list[1]['image'] == 'y')
+        assert('thumb' not in lb_list[1])
+        assert(lb_core[0]['image'] == 'x')
+
+        lb_list = tm.overlay_leaderboard(None, usermgr.AnonUser(uid=5), lb_core)
+        assert('thumb' not in lb_list[0])
+
+    class FakeVersionRedis(object):
+        def __init__(self):
+            self.store = {}
+            self.gets = 0
+
+        def get(self, key):
+            self.gets += 1
+            v = self.store.get(key)
+            return None if v is None else str(v).encode('utf-8')
+
+        def setnx(self, key, value):
+            self.store.setdefault(key, value)
+
+        def incr(self, key):
+            self.store[key] = int(self.store[key]) + 1
+
+        def pipeline(self, transaction=True):
+            return self # commands just run immediately
+
+        def execute(self):
+            pass
+
+    class CountingTallyMan(RewardMgr.TallyMan):
+        builds = 0
+
+        def get_leaderboard_by_category(self, session, c, check_exist=True):
+            class LB(object):
+                def leaders(self, *args, **kwargs):
+                    return []
+            return LB()
+
+        def build_leaderboard_core(self, session, dl):
+            self.builds += 1
+            return [{'username': 'someone', 'score': 10, 'rank': 1, 'pid': 1, 'orientation': 1, 'votes': 1, 'likes': 0, 'image': 'x', 'uid': 7}]
+
+    def test_leaderboard_versioned_cache(self):
+        tm = self.CountingTallyMan()
+        tm._redis_conn = self.FakeVersionRedis()
+        c = category.Category()
+        c.id = 87654320
+        c.state = category.CategoryState.VOTING.value
+        au = usermgr.AnonUser(uid=7)
+        RewardMgr._shared_cache.expire_key('LEADERBOARD_THUMBNAILS{0}'.format(c.id))
+
+        d = tm.fetch_leaderboard(None, au, c)
+        assert(len(d) == 1 and d[0]['you'])
+        tm.fetch_leaderboard(None, au, c)
+        assert(tm.builds == 1)  # version unchanged, cache hit
+
+        tm.bump_leaderboard_version(None, c)
+        tm.fetch_leaderboard(None, au, c)
+        assert(tm.builds == 2)  # a vote was cast, rebuilt
+
+        # closed leaderboards don't check the version at all
+        c.state = category.CategoryState.CLOSED.value
+        gets = tm._redis_conn.gets
+        tm.bump_leaderboard_version(None, c)
+        tm.fetch_leaderboard(None, au, c)
+        assert(tm.builds == 2)
+        assert(tm._redis_conn.gets == gets)
+        RewardMgr._shared_cache.expire_key('LEADERBOARD_THUMBNAILS{0}'.format(c.id))
+
     def create_category(self, category_name):
         # first we need a resource
         max_resource_id = self.session.query(func.max(resources.Resource.resource_id)).one()
@@ -317,6 +464,15 @@ class TestVoting(DatabaseTest):
 
         j = json.dumps(d)
         assert(j is not None)
+
+        b = voting.Ballot(c.id, au.id)
+        b.append_ballotentry(be)
+        b.read_photos_for_ballots(self.session, thumb_urls=True)
+        thumb_hash = self.session.query(photo.PhotoMeta).get(p.id).thumb_hash
+        d = be.to_json(thumb_urls=True)
+        assert(d['thumb'] == '/thumb/{0}'.format(thumb_hash))
+        assert('image' not in d)
+        assert('tags' in d)
         self.teardown()
 
 
@@ -425,6 +581,199 @@ class TestVoting(DatabaseTest):
 
         self.teardown()
 
+    def vote_one_ballot(self, bm: BallotMgr.BallotManager, category_name: str) -> list:
+        c = self.create_category(category_name)
+        u, au = self.create_user()
+        ft = open(get_photo_fullpath('TEST6.JPG'), 'rb')
+        pi = photo.PhotoImage()
+        pi._binary_image = ft.read()
+        pi._extension = 'JPEG'
+        ft.close()
+        for i in range(0, 4):
+            self.upload_image(self.session, pi, c, u)
+
+        c.state = category.CategoryState.VOTING.value
+        self.session.flush()
+
+        nu, au = self.create_user()
+        b = bm.create_ballot(self.session, nu.id, c)
+        self.session.flush()
+        j_votes = []
+        idx = 1
+        for be in b._ballotentries:
+            j_votes.append({'bid': be.id, 'vote': idx, 'like': str(idx%2)})
+            idx += 1
+
+        bel = bm.tabulate_votes(self.session, au, j_votes)
+        assert([be.id for be in bel] == [j['bid'] for j in j_votes])
+        self.session.flush()
+
+        # score & times voted by ballot position
+        return [(self.session.query(photo.Photo).get(be.photo_id).score,
+                 self.session.query(photo.Photo).get(be.photo_id).times_voted, be.vote, be.like) for be in bel]
+
+    def test_batched_tabulation_matches(self):
+        self.setup()
+        by_entry = self.vote_one_ballot(BallotMgr.BallotManager(batched=False), 'test_tabulation_by_entry')
+        batched = self.vote_one_ballot(BallotMgr.BallotManager(batched=True), 'test_tabulation_batched')
+        assert(len(batched) == 4)
+        assert(batched == by_entry)
+        self.teardown()
+
+    def test_redis_server_address_cached(self):
+        reads = []
+        def f_address(session):
+            reads.append(1)
+            return {'ip': '127.0.0.1', 'port': 6379}
+
+        rs = RewardMgr.RedisServer(f_address=f_address)
+        conn = rs.connection(None)
+        assert(rs.connection(None) is conn)
+        assert(len(reads) == 1)
+
+        lb = rs.leaderboard(None, 'leaderboard_category1')
+        assert(rs.leaderboard(None, 'leaderboard_category1') is lb)
+        assert(rs.leaderboard(None, 'leaderboard_category2') is not lb)
+        assert(lb.redis_connection is conn)
+
+        # only connection failures make us go back to ServerList
+        rs.connection_failed(ValueError('not a redis problem'))
+        assert(rs.connection(None) is conn)
+        rs.connection_failed(redis.exceptions.ConnectionError('gone'))
+        assert(rs.connection(None) is not conn)
+        assert(len(reads) == 2)
+
+    def test_redis_server_address_ttl(self):
+        addresses = [{'ip': '127.0.0.1', 'port': 6379}, {'ip': '127.0.0.1', 'port': 6379}, {'ip': '10.0.0.2', 'port': 6379}]
+        rs = RewardMgr.RedisServer(f_address=lambda session: addresses.pop(0), address_ttl=0)
+        conn = rs.connection(None)
+        assert(rs.connection(None) is conn)     # re-read, same server, keep the pool
+        assert(rs.connection(None) is not conn) # server moved
+
+    def test_redis_server_refresh_outside_lock(self):
+        reading = threading.Event()
+        release = threading.Event()
+        addresses = [{'ip': '127.0.0.1', 'port': 6379}, {'ip': '10.0.0.2', 'port': 6379}, {'ip': '10.0.0.2', 'port': 6379}]
+        def f_address(session):
+            if len(addresses) == 2:
+                reading.set()
+                release.wait(5)
+            return addresses.pop(0)
+
+        rs = RewardMgr.RedisServer(f_address=f_address, address_ttl=0)
+        assert(rs.address(None)['ip'] == '127.0.0.1')
+
+        # one thread re-reads ServerList, the others keep using the address they have
+        t = threading.Thread(target=rs.address, args=(None,))
+        t.start()
+        assert(reading.wait(5))
+        assert(rs.address(None)['ip'] == '127.0.0.1')
+        release.set()
+        t.join(5)
+        assert(rs.address(None)['ip'] == '10.0.0.2')
+
+    def test_leaderboard_update_benchmark(self):
+        """
+        per vote Redis overhead, the way a vote used to do it (ServerList read,
+        new Leaderboard, EXISTS, rank) vs. the shared pooled handles
+        """
+        self.setup()
+        c = category.Category()
+        c.id = 87654319
+        p = photo.Photo()
+        p.user_id = 1
+        num_votes = 200
+
+        start = time.perf_counter()
+        for i in range(num_votes):
+            d = voting.ServerList().get_redis_server(self.session)
+            conn = redis.Redis(host=d['ip'], port=d['port'])
+            conn.exists('leaderboard_category{0}'.format(c.id))
+            lb = Leaderboard('leaderboard_category{0}'.format(c.id), host=d['ip'], port=d['port'], page_size=10)
+            lb.rank_member(i, i, '1')
+        before = (time.perf_counter() - start) / num_votes
+
+        start = time.perf_counter()
+        for i in range(num_votes):
+            tm = RewardMgr.TallyMan()
+            p.id = i
+            p.score = i
+            tm.update_leaderboard(self.session, c, p)
+        after = (time.perf_counter() - start) / num_votes
+
+        print('\nper vote leaderboard update: before {0:.3f}ms, pooled {1:.3f}ms'.format(before * 1000, after * 1000))
+        RewardMgr.TallyMan().get_leaderboard_by_category(self.session, c).delete_leaderboard()
+        self.teardown()
+
+    @skipUnless(os.environ.get('IIBENCHMARK'), 'set IIBENCHMARK=1 to run, seeds 100k photos')
+    def test_round2_ballot_benchmark(self):
+        """
+        round #2 ballot selection over a 100k photo category seeded by
+        sp_initialize_round2, old per num_votes/per section query loop vs.
+        the section queues and the single query fallback
+        """
+        self.setup()
+        num_photos = 100000
+        num_ballots = 50
+        c = self.create_category('test_round2_benchmark')
+        u, au = self.create_user()
+        nu, nau = self.create_user()
+        self.session.commit()
+
+        rows = [{'user_id': u.id, 'category_id': c.id, 'filepath': '/benchmark', 'filename': 'bm{0}.jpeg'.format(i),
+                 'score': 1 + i % 500, 'likes': i % 3, 'times_voted': 1, 'active': 1} for i in range(num_photos)]
+        for i in range(0, num_photos, 5000):
+            self.session.execute(photo.Photo.__table__.insert(), rows[i:i + 5000])
+        self.session.commit()
+
+        connection = dbsetup.ENGINE.raw_connection()
+        cursor = connection.cursor()
+        cursor.callproc("sp_initialize_round2", [voting._NUM_SECTONS_ROUND2, c.id])
+        cursor.close()
+        connection.commit()
+
+        c.state = category.CategoryState.VOTING.value
+        c.round = 1
+        self.session.commit()
+        bm = BallotMgr.BallotManager()
+
+        try:
+            start = time.perf_counter()
+            for i in range(num_ballots):
+                photos_for_ballot = []
+                for num_votes in range(0, voting._MAX_VOTING_ROUNDS + 1):
+                    photos_for_ballot.extend(read_photos_by_ballots_round2(self.session, nu.id, c, num_votes, voting._NUM_BALLOT_ENTRIES))
+                    if len(photos_for_ballot) >= voting._NUM_BALLOT_ENTRIES:
+                        break
+                pl = bm.cleanup_list(photos_for_ballot, voting._NUM_BALLOT_ENTRIES)
+                for p in pl:
+                    self.session.query(voting.VotingRound).filter(voting.VotingRound.photo_id == p.id).update(
+                        {"times_voted": voting.VotingRound.times_voted + 1}, synchronize_session=False)
+            before = (time.perf_counter() - start) / num_ballots
+
+            start = time.perf_counter()
+            for i in range(num_ballots):
+                pl = bm.cleanup_list(bm.read_photos_round2(self.session, nu.id, c, voting._NUM_BALLOT_ENTRIES), voting._NUM_BALLOT_ENTRIES)
+                bm.update_votinground(self.session, c, pl)
+            single_query = (time.perf_counter() - start) / num_ballots
+
+            start = time.perf_counter()
+            for i in range(num_ballots):
+                pl = bm.create_ballot_list(self.session, nu.id, c, allow_upload=False)
+                assert(len(pl) == voting._NUM_BALLOT_ENTRIES)
+                bm.update_votinground(self.session, c, pl)
+                bm.update_ballot_queue(self.session, c, pl)
+            queued = (time.perf_counter() - start) / num_ballots
+
+            print('\nround 2 ballot, {0} photos: before {1:.1f}ms, single query {2:.1f}ms, section queues {3:.1f}ms'.
+                  format(num_photos, before * 1000, single_query * 1000, queued * 1000))
+        finally:
+            self.session.rollback()
+            self.session.execute('DELETE vr FROM voting_round vr JOIN photo p ON p.id = vr.photo_id WHERE p.category_id = :cid', {'cid': c.id})
+            self.session.execute('DELETE FROM photo WHERE category_id = :cid', {'cid': c.id})
+            self.session.commit()
+            self.teardown()
+
     # NOTE: Hashing test for duplicates eliminated
     # def test_cleanup_list_noduplicates(self):
     #     bm = voting.BallotManager()
@@ -569,6 +918,8 @@ class TestVoting(DatabaseTest):
         b = voting.Ballot(cid=c.id, uid=u.id)
         self.session.add(b)
         self.session.commit()
+        RewardMgr.RewardManager.backfill_user_activity(self.session, [u.id]) # the ballots were written directly
+        self.session.commit()
 
         bm = BallotMgr.BallotManager()
         threshold, num_badges = bm.badges_for_votes(self.session, u.id)
@@ -589,6 +940,8 @@ class TestVoting(DatabaseTest):
             b = voting.Ballot(cid=c.id, uid=u.id)
             self.session.add(b)
         self.session.commit()
+        RewardMgr.RewardManager.backfill_user_activity(self.session, [u.id]) # the ballots were written directly
+        self.session.commit()
 
         bm = BallotMgr.BallotManager()
         reward_threshold, num_badges = bm.badges_for_votes(self.session, u.id)
@@ -611,6 +964,8 @@ class TestVoting(DatabaseTest):
             b = voting.Ballot(cid=c.id, uid=u.id)
             self.session.add(b)
         self.session.commit()
+        RewardMgr.RewardManager.backfill_user_activity(self.session, [u.id]) # the ballots were written directly
+        self.session.commit()
 
         bm = BallotMgr.BallotManager()
         threshold, num_badges = bm.badges_for_votes(self.session, u.id)
@@ -631,6 +986,8 @@ class TestVoting(DatabaseTest):
             b = voting.Ballot(cid=c.id, uid=u.id)
             self.session.add(b)
         self.session.commit()
+        RewardMgr.RewardManager.backfill_user_activity(self.session, [u.id]) # the ballots were written directly
+        self.session.commit()
 
         bm = BallotMgr.BallotManager()
         reward_threshold, num_badges = bm.badges_for_votes(self.session, u.id)